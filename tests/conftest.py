@@ -0,0 +1,20 @@
+import importlib.util
+import os.path
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope='session')
+def tt():
+    # tt-ratings.py is a script, so it is loaded from its path instead of imported.
+    spec = importlib.util.spec_from_file_location('tt_ratings', os.path.join(ROOT, 'tt-ratings.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def players_json():
+    return os.path.join(ROOT, 'players.json')
@@ -0,0 +1,88 @@
+from datetime import datetime
+
+import mongomock
+import pymongo
+import pytest
+
+
+class Operation():
+    # Stands in for the pymongo bulk operations, which keep their arguments in private attributes.
+
+    def __init__(self, *args, upsert=False):
+        self.args = args
+        self.upsert = upsert
+        return
+
+
+class UpdateOne(Operation):
+    def apply(self, collection):
+        collection.update_one(*self.args, upsert=self.upsert)
+        return
+
+
+class ReplaceOne(Operation):
+    def apply(self, collection):
+        collection.replace_one(*self.args, upsert=self.upsert)
+        return
+
+
+class DeleteMany(Operation):
+    def apply(self, collection):
+        collection.delete_many(*self.args)
+        return
+
+
+class InsertOne(Operation):
+    def apply(self, collection):
+        collection.insert_one(dict(*self.args))
+        return
+
+
+def bulk_write(collection):
+    def write(operations, ordered=True):
+        for o in operations:
+            o.apply(collection)
+        return
+    return write
+
+
+@pytest.fixture
+def storage(tt, monkeypatch):
+    # The storage imports the operations from pymongo when it writes.
+    for operation in (UpdateOne, ReplaceOne, DeleteMany, InsertOne):
+        monkeypatch.setattr(pymongo, operation.__name__, operation)
+    storage = tt.BucketedMongoDB.__new__(tt.BucketedMongoDB)
+    tt.RatingsStorage.__init__(storage, '01/08/2024')
+    db = mongomock.MongoClient().db
+    storage.collection = db['player_states']
+    storage.buckets = db['rating_buckets']
+    storage.matches = db['matches']
+    for c in (storage.collection, storage.buckets, storage.matches):
+        c.bulk_write = bulk_write(c)
+    return storage
+
+
+def test_insert_then_update_in_one_batch(tt, storage):
+    first, second = datetime(2024, 1, 1), datetime(2024, 1, 8)
+    storage.insert_documents([tt.new_player_document('Old Timer', 1500, datetime(2023, 12, 18), '')])
+    storage.apply_rating_updates(
+        [('Newbie', 1200, first, '')],
+        [('Old Timer', 1510, first), ('Newbie', 1215, second), ('Old Timer', 1490, second)],
+        True
+    )
+    newbie = storage.collection.find_one({'name': 'Newbie'})
+    assert newbie['current_rating'] == 1215
+    assert newbie['leagues_played'] == 2
+    assert newbie['last_played'] == second
+    assert storage.get_player_history('Newbie') == [[1200, first], [1215, second]]
+    old_timer = storage.collection.find_one({'name': 'Old Timer'})
+    assert old_timer['current_rating'] == 1490
+    assert old_timer['leagues_played'] == 3
+
+
+def test_later_night_already_applied_is_skipped(tt, storage):
+    first, second = datetime(2024, 1, 1), datetime(2024, 1, 8)
+    storage.insert_documents([tt.new_player_document('Old Timer', 1500, second, '')])
+    storage.apply_rating_updates([], [('Old Timer', 1510, first)], True)
+    assert storage.collection.find_one({'name': 'Old Timer'})['current_rating'] == 1500
+    assert storage.get_player_history('Old Timer') == [[1500, second]]
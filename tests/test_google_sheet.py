@@ -0,0 +1,91 @@
+import os.path
+
+import numpy as np
+import pytest
+
+LEAGUES = 4
+DATE = '2022-11-05'
+
+
+class Request():
+    def __init__(self, service, method, kwargs):
+        self.service = service
+        self.method = method
+        self.kwargs = kwargs
+        return
+
+    def execute(self):
+        self.service.calls.append(self.method)
+        return getattr(self.service, self.method)(**self.kwargs)
+
+
+class Values():
+    def __init__(self, service):
+        self.service = service
+        return
+
+    def __getattr__(self, method):
+        return lambda **kwargs: Request(self.service, method, kwargs)
+
+
+class FakeSheetsService():
+    # The spreadsheets() resource of the Sheets API, with the values of every range in a dict. Every executed
+    # request is counted, one request is one HTTP call to the real service.
+
+    def __init__(self, ranges: dict):
+        self.ranges = ranges
+        self.calls = []
+        return
+
+    def values(self):
+        return Values(self)
+
+    def batchGet(self, spreadsheetId, ranges, valueRenderOption=None):
+        return {'valueRanges': [{'range': r, 'values': self.ranges.get(r, [])} for r in ranges]}
+
+    def batchClear(self, spreadsheetId, body):
+        for r in body['ranges']:
+            self.ranges.pop(r, None)
+        return {}
+
+    def batchUpdate(self, spreadsheetId, body):
+        for d in body['data']:
+            self.ranges[d['range']] = d['values']
+        return {}
+
+
+@pytest.fixture
+def service(tt, players_json):
+    # A league night of the players in players.json, laid out the way GoogleSheet reads the date tab.
+    club = tt.MemoryStorage(DATE, players_json).get_current_ratings()
+    rows = tt.generate_league_night(club, LEAGUES, np.random.default_rng(1))
+    ranges = {}
+    matches = len(rows) // LEAGUES
+    for league in range(LEAGUES):
+        first_row = league * tt.GoogleSheet.LEAGUE_ROWS + 2
+        league_rows = rows[league * matches:(league + 1) * matches]
+        players = list(dict.fromkeys(p for row in league_rows for p in row[:2]))
+        ranges[f'{DATE}!H{first_row}:S{first_row + 14}'] = league_rows
+        ranges[f'{DATE}!B{first_row}:B{first_row + 5}'] = [[p] for p in players]
+    return FakeSheetsService(ranges)
+
+
+def test_one_call_per_read_and_write(tt, players_json, service, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    # The service of the credentials file is taken from the cache instead of being authorized.
+    monkeypatch.setitem(tt.GoogleSheet.SERVICES, os.path.abspath('google_cred.json'), service)
+    storage = tt.MemoryStorage(DATE, players_json)
+    plan_file = str(tmp_path / 'plan.json.gz')
+
+    tt.new_league(DATE, None, 'google_cred.json', 60, False, False, LEAGUES, storage, plan_file, assume_yes=True)
+    assert service.calls == ['batchGet']
+
+    service.calls.clear()
+    tt.apply_new_league_plan(plan_file, 'google_cred.json', True, storage)
+    assert service.calls == ['batchClear', 'batchUpdate']
+    # Every league of the date tab and the Ratings tab are written by the single batchUpdate.
+    for league in range(LEAGUES):
+        first_row = league * tt.GoogleSheet.LEAGUE_ROWS + 2
+        assert f'{DATE}!C{first_row}:E{first_row + 5}' in service.ranges
+    assert tt.GoogleSheet.RATINGS_RANGE in service.ranges
+    assert storage.get_last_update_date().strftime('%Y-%m-%d') == DATE
@@ -1,26 +1,194 @@
 #!/usr/bin/env python3
 
-from ast import arg
-from bson.json_util import dumps
-from pymongo import MongoClient, ASCENDING, DESCENDING
-from datetime import datetime
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
-from google.auth.exceptions import RefreshError
-import numpy as np
-import pandas as pd
+# pymongo, bson, the Google API client and the executors are imported by the code that needs them, so that
+# commands which do not talk to MongoDB or the spreadsheet, or run in parallel, start without loading them.
+from datetime import datetime, timedelta, timezone
 import argparse
+import atexit
+import contextlib
 import copy
+import functools
+import gzip
+import hashlib
+import inspect
+import io
+import itertools
+import json
 import os.path
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+DAEMON_SOCKET_FILE = os.path.expanduser('~/.tt-ratings.sock')
+# The commands run by the daemon, and the options that keep a command in this process.
+DAEMON_COMMAND_OPTIONS = ('-s', '--show-ratings', '-n', '--new-league', '-u', '--update')
+LOCAL_COMMAND_OPTIONS = ('--daemon', '--no-daemon', '--profile', '--profile-output', '--profile-cprofile', '-h', '--help')
+
+
+def get_daemon_client_socket(argv: list):
+    # A quick look at the arguments before numpy is imported, a command forwarded to the daemon does not load it.
+    # Other spellings of the options are still forwarded by main() after the arguments are parsed.
+    socket_file = DAEMON_SOCKET_FILE
+    forward = False
+    for i, arg in enumerate(argv):
+        option = arg.split('=', 1)[0]
+        if arg == '--':
+            break
+        elif option in LOCAL_COMMAND_OPTIONS:
+            return None
+        elif option in DAEMON_COMMAND_OPTIONS:
+            forward = True
+        elif arg == '--socket' and i + 1 < len(argv):
+            socket_file = argv[i + 1]
+        elif option == '--socket':
+            socket_file = arg.split('=', 1)[1]
+    return socket_file if forward else None
+
+
+def run_daemon_client(socket_file, argv: list):
+    # Returns the exit code of the command run by the daemon, or None when no daemon is listening.
+    import socket
+    import threading
+    if not os.path.exists(socket_file):
+        return None
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_file)
+    except OSError:
+        client.close()
+        return None
+
+    def forward_input():
+        # Reads the file descriptor, a thread blocked in sys.stdin would hold its lock when exit() closes it.
+        try:
+            while True:
+                data = os.read(sys.stdin.fileno(), 4096)
+                if len(data) == 0:
+                    break
+                client.sendall(data)
+        except (OSError, ValueError):
+            pass
+        return
+
+    with client:
+        client.sendall((json.dumps({'argv': argv, 'cwd': os.getcwd()}) + '\n').encode('utf-8'))
+        threading.Thread(target=forward_input, daemon=True).start()
+        for line in client.makefile('r', encoding='utf-8'):
+            message = json.loads(line)
+            if 'exit' in message:
+                return message['exit']
+            sys.stdout.write(message['out'])
+            sys.stdout.flush()
+    print('The daemon closed the connection.')
+    return 1
+
+
+if __name__ == '__main__':
+    client_socket_file = get_daemon_client_socket(sys.argv[1:])
+    if client_socket_file is not None:
+        client_exit_code = run_daemon_client(client_socket_file, sys.argv[1:])
+        if client_exit_code is not None:
+            exit(client_exit_code)
+
+# numpy is only imported after the daemon client above, the other modules are in the standard library.
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Upper bounds of the rating difference buckets, anything above the last one falls in bucket 32.
+RATING_RANGE_LIST = np.array([14, 27.75, 41.25, 54.5, 67.5, 80.25, 92.75, 105, 117, 128.75, 140.25, 151.5, 162.5,
+                              173.25, 183.75, 194, 204, 213.75, 223.25, 232.5, 241.5, 250.25, 258.75, 267, 275,
+                              282.75, 290.25, 297.5, 304.5, 311.25, 317.75, 324])
+
+# Rating change per bucket for winning by 1, 2 or 3 games.
+RATING_CHANGE_EXPECTED = np.array([[4, 6, 8],
+                                   [3.25, 5.5, 7.75],
+                                   [2.5, 5, 7.5],
+                                   [1.75, 4.5, 7.25],
+                                   [1, 4, 7],
+                                   [0.25, 3.5, 6.75],
+                                   [-0.5, 3, 6.5],
+                                   [-1.25, 2.5, 6.25],
+                                   [-2, 2, 6],
+                                   [-2.75, 1.5, 5.75],
+                                   [-3.5, 1, 5.5],
+                                   [-4.25, 0.5, 5.25],
+                                   [-5, 0, 5],
+                                   [-5.75, -0.5, 4.75],
+                                   [-6.5, -1, 4.5],
+                                   [-7.25, -1.5, 4.25],
+                                   [-8, -2, 4],
+                                   [-8.75, -2.5, 3.75],
+                                   [-9.5, -3, 3.5],
+                                   [-10.25, -3.5, 3.25],
+                                   [-11, -4, 3],
+                                   [-11.75, -4.5, 2.75],
+                                   [-12.5, -5, 2.5],
+                                   [-13.25, -5.5, 2.25],
+                                   [-14, -6, 2],
+                                   [-14.75, -6.5, 1.75],
+                                   [-15.5, -7, 1.5],
+                                   [-16.25, -7.5, 1.25],
+                                   [-17, -8, 1],
+                                   [-17.75, -8.5, 0.75],
+                                   [-18.5, -9, 0.5],
+                                   [-19.25, -9.5, 0.25],
+                                   [-20, -10, 0]])
+
+RATING_CHANGE_UNEXPECTED = np.array([[4, 6, 8],
+                                     [5, 7.25, 9.5],
+                                     [6, 8.5, 11],
+                                     [7.25, 10, 12.75],
+                                     [8.5, 11.5, 14.5],
+                                     [10, 13.25, 16.5],
+                                     [11.5, 15, 18.5],
+                                     [13.25, 17, 20.75],
+                                     [15, 19, 23],
+                                     [17, 21.25, 25.5],
+                                     [19, 23.5, 28],
+                                     [21.25, 26, 30.75],
+                                     [23.5, 28.5, 33.5],
+                                     [26, 31.25, 36.5],
+                                     [28.5, 34, 39.5],
+                                     [31.25, 37, 42.75],
+                                     [34, 40, 46],
+                                     [37, 43.25, 49.5],
+                                     [40, 46.5, 53],
+                                     [43.25, 50, 56.75],
+                                     [46.5, 53.5, 60.5],
+                                     [50, 57.25, 64.5],
+                                     [53.5, 61, 68.5],
+                                     [57.25, 65, 72.75],
+                                     [61, 69, 77],
+                                     [65, 73.25, 81.5],
+                                     [69, 77.5, 86],
+                                     [73.25, 82, 90.75],
+                                     [77.5, 86.5, 95.5],
+                                     [82, 91.25, 100.5],
+                                     [86.5, 96, 105.5],
+                                     [91.25, 101, 110.75],
+                                     [96, 106, 116]])
+
 
 class ELO:
 
-    def __init__(self):
+    def __init__(self, rating_range_list=RATING_RANGE_LIST, rating_change_expected=RATING_CHANGE_EXPECTED,
+                 rating_change_unexpected=RATING_CHANGE_UNEXPECTED, scale=400.0):
         self.match_K = 5
         self.game_K = 40
+        # The rating change tables, other values are tried out by the backtest.
+        self.rating_range_list = rating_range_list
+        self.rating_change_expected = rating_change_expected
+        self.rating_change_unexpected = rating_change_unexpected
+        self.scale = scale
         return
 
     def update_rating(self, player1_rating, player2_rating, score_differentials):
@@ -50,9 +218,8 @@ class ELO:
 
         results = [0 if diff < 0 else 1 for diff in score_differentials]
 
-        win_dict = {0: 0, 1: 0}
-        win_dict.update(pd.Series(results).value_counts().to_dict())
-        game_score_diff = win_dict[1] - win_dict[0]
+        game_wins = sum(results)
+        game_score_diff = game_wins - (len(results) - game_wins)
         rating_diff = player1_rating - player2_rating
         rating_change = self.rating_change(rating_diff, game_score_diff)
         # g = np.log(np.abs(game_score_diff) + 1) * (2.2 / ((rating_winner - rating_loser) * 0.001 + 2.2))
@@ -62,7 +229,7 @@ class ELO:
         return player1_rating + rating_change
 
     def expected_result(self, player1_rating, player2_rating):
-        exp = (player2_rating - player1_rating) / 400.0
+        exp = (player2_rating - player1_rating) / self.scale
         return 1 / ((10.0 ** (exp)) + 1)
 
     def rating_change(self, rating_diff, game_score_diff):
@@ -75,92 +242,34 @@ class ELO:
         if games_left < 0:
             return 0
 
-        rating_range_list = [14, 27.75, 41.25, 54.5, 67.5, 80.25, 92.75, 105, 117, 128.75, 140.25, 151.5, 162.5,
-                             173.25, 183.75, 194, 204, 213.75, 223.25, 232.5, 241.5, 250.25, 258.75, 267, 275,
-                             282.75, 290.25, 297.5, 304.5, 311.25, 317.75, 324]
-
-        rating_change_expected_dict = {0: [4, 6, 8],
-                                       1: [3.25, 5.5, 7.75],
-                                       2: [2.5, 5, 7.5],
-                                       3: [1.75, 4.5, 7.25],
-                                       4: [1, 4, 7],
-                                       5: [0.25, 3.5, 6.75],
-                                       6: [-0.5, 3, 6.5],
-                                       7: [-1.25, 2.5, 6.25],
-                                       8: [-2, 2, 6],
-                                       9: [-2.75, 1.5, 5.75],
-                                       10: [-3.5, 1, 5.5],
-                                       11: [-4.25, 0.5, 5.25],
-                                       12: [-5, 0, 5],
-                                       13: [-5.75, -0.5, 4.75],
-                                       14: [-6.5, -1, 4.5],
-                                       15: [-7.25, -1.5, 4.25],
-                                       16: [-8, -2, 4],
-                                       17: [-8.75, -2.5, 3.75],
-                                       18: [-9.5, -3, 3.5],
-                                       19: [-10.25, -3.5, 3.25],
-                                       20: [-11, -4, 3],
-                                       21: [-11.75, -4.5, 2.75],
-                                       22: [-12.5, -5, 2.5],
-                                       23: [-13.25, -5.5, 2.25],
-                                       24: [-14, -6, 2],
-                                       25: [-14.75, -6.5, 1.75],
-                                       26: [-15.5, -7, 1.5],
-                                       27: [-16.25, -7.5, 1.25],
-                                       28: [-17, -8, 1],
-                                       29: [-17.75, -8.5, 0.75],
-                                       30: [-18.5, -9, 0.5],
-                                       31: [-19.25, -9.5, 0.25],
-                                       32: [-20, -10, 0]
-                                       }
-
-        rating_change_unexpected_dict = {0: [4, 6, 8],
-                                         1: [5, 7.25, 9.5],
-                                         2: [6, 8.5, 11],
-                                         3: [7.25, 10, 12.75],
-                                         4: [8.5, 11.5, 14.5],
-                                         5: [10, 13.25, 16.5],
-                                         6: [11.5, 15, 18.5],
-                                         7: [13.25, 17, 20.75],
-                                         8: [15, 19, 23],
-                                         9: [17, 21.25, 25.5],
-                                         10: [19, 23.5, 28],
-                                         11: [21.25, 26, 30.75],
-                                         12: [23.5, 28.5, 33.5],
-                                         13: [26, 31.25, 36.5],
-                                         14: [28.5, 34, 39.5],
-                                         15: [31.25, 37, 42.75],
-                                         16: [34, 40, 46],
-                                         17: [37, 43.25, 49.5],
-                                         18: [40, 46.5, 53],
-                                         19: [43.25, 50, 56.75],
-                                         20: [46.5, 53.5, 60.5],
-                                         21: [50, 57.25, 64.5],
-                                         22: [53.5, 61, 68.5],
-                                         23: [57.25, 65, 72.75],
-                                         24: [61, 69, 77],
-                                         25: [65, 73.25, 81.5],
-                                         26: [69, 77.5, 86],
-                                         27: [73.25, 82, 90.75],
-                                         28: [77.5, 86.5, 95.5],
-                                         29: [82, 91.25, 100.5],
-                                         30: [86.5, 96, 105.5],
-                                         31: [91.25, 101, 110.75],
-                                         32: [96, 106, 116]
-                                         }
+        rating_change_index = int(np.searchsorted(self.rating_range_list, rating_diff, side='left'))
+        rating_change_table = self.rating_change_expected if is_expected else self.rating_change_unexpected
+        rating_change = float(rating_change_table[rating_change_index, games_left])
 
-        try:
-            rating_change_index = next(i for i, x in enumerate(rating_range_list) if rating_diff <= x)
-        except StopIteration:
-            rating_change_index = 32
+        rating_offset = rating_change if is_winner else -rating_change
+
+        return rating_offset
 
-        rating_change_dict = rating_change_expected_dict if is_expected else rating_change_unexpected_dict
+    def rating_changes(self, rating_diffs, game_score_diffs):
+        # Batch version of rating_change, returns the rating change of every (rating_diff, game_score_diff) pair.
+        rating_diffs = np.asarray(rating_diffs, dtype=np.float64)
+        game_score_diffs = np.asarray(game_score_diffs, dtype=np.int64)
+        is_higher_rated = rating_diffs >= 0
+        is_winner = game_score_diffs > 0
+        is_expected = is_higher_rated == is_winner
+        games_left = np.abs(game_score_diffs) - 1
 
-        rating_change_list = rating_change_dict[rating_change_index]
+        if np.any(games_left > 2):
+            raise IndexError('game score difference must be between -3 and 3')
 
-        rating_offset = rating_change_list[games_left] if is_winner else -rating_change_list[games_left]
+        rating_change_index = np.searchsorted(self.rating_range_list, np.abs(rating_diffs), side='left')
+        rating_change = np.where(is_expected,
+                                 self.rating_change_expected[rating_change_index, games_left.clip(0)],
+                                 self.rating_change_unexpected[rating_change_index, games_left.clip(0)])
 
-        return rating_offset
+        rating_offsets = np.where(is_winner, rating_change, -rating_change)
+        rating_offsets[games_left < 0] = 0.0
+        return rating_offsets
 
 
 class Player:
@@ -179,591 +288,3671 @@ class Player:
         e = ELO()
         new_rating = e.update_rating(self.rating, player.rating, score_differentials)
         if print_out:
-            p1_info = f'{self.name} [{round(self.rating, 2): >7.02f}]'
-            p2_info = f'{player.name} [{round(player.rating, 2): >7.02f}]'
-            score_diffs = ''
-            for i in range(len(score_differentials)):
-                diff = score_differentials[i]
-                if i != 0:
-                    score_diffs += ', '
-                score_diffs += f'{diff: >3}'
-            rating_change_str = f'{p1_info: >30} : {p2_info: >30}  =>  {score_diffs: <25}  =>  {round(new_rating - self.rating, 2):+.02f}'
-            print(rating_change_str)
+            print_match_result(self.name, self.rating, player.name, player.rating, score_differentials,
+                               new_rating - self.rating)
         return new_rating
 
 
-class MongoDB():
+def print_match_result(p1_name, p1_rating, p2_name, p2_rating, score_differentials: list, rating_change):
+    p1_info = f'{p1_name} [{round(p1_rating, 2): >7.02f}]'
+    p2_info = f'{p2_name} [{round(p2_rating, 2): >7.02f}]'
+    score_diffs = ''
+    for i in range(len(score_differentials)):
+        diff = score_differentials[i]
+        if i != 0:
+            score_diffs += ', '
+        score_diffs += f'{diff: >3}'
+    rating_change_str = f'{p1_info: >30} : {p2_info: >30}  =>  {score_diffs: <25}  =>  {round(rating_change, 2):+.02f}'
+    print(rating_change_str)
+    return
 
-    CONNECTION_URI = 'mongodb+srv://duke-cluster.ops3ljm.mongodb.net/?authSource=%24external&authMechanism=MONGODB-X509&retryWrites=true&w=majority'
 
-    def __init__(self, date_str, cert_file='mongodb_cert.pem'):
-        # client = MongoClient('localhost', 27017)
-        if not os.path.exists(cert_file):
-            print(f'Missing mongodb cert file: {cert_file}')
+BACKUP_MANIFEST_FILE = 'backup_manifest.json'
+# A full backup is taken again after this many incremental backups.
+BACKUP_FULL_EVERY = 10
+BACKUP_EXTENSIONS = {'none': '.json', 'gzip': '.json.gz', 'zstd': '.json.zst'}
+
+
+def open_backup_file(file_name, mode='r'):
+    # Backups are extended JSON lines like mongoexport, use "gunzip -c" or "zstd -dc" to pipe them to "mongoimport".
+    if file_name.endswith('.gz'):
+        return gzip.open(file_name, mode + 't', encoding='utf-8')
+    if file_name.endswith('.zst'):
+        if zstandard is None:
+            print('The zstandard package is needed for zstd backups.')
             exit(1)
-        client = MongoClient(self.CONNECTION_URI, tls=True, tlsCertificateKeyFile=cert_file)
-        db = client['ccttc_ratings']
-        self.collection = db['players']
+        if mode == 'w':
+            return io.TextIOWrapper(zstandard.ZstdCompressor().stream_writer(open(file_name, 'wb')), encoding='utf-8')
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(file_name, 'rb')), encoding='utf-8')
+    return open(file_name, mode)
 
-        self.all_players = None
-        self.current_ratings = {}
-        self.date_str = date_str
 
-        return
+def load_backup_manifest(backup_dir):
+    manifest_file = os.path.join(backup_dir, BACKUP_MANIFEST_FILE)
+    if not os.path.exists(manifest_file):
+        return {'backups': []}
+    with open(manifest_file, 'r') as in_file:
+        return json.load(in_file)
 
-    def backup(self):
-        cursor = self.collection.find()
-        backup_file_name = f'ratings_before_{self.date_str}_'
-        count = 0
-        while True:
-            if os.path.exists(f'{backup_file_name}{count}.json'):
-                count += 1
-            else:
-                backup_file_name = f'{backup_file_name}{count}.json'
-                break
 
-        with open(backup_file_name, 'w') as out_file:
-            for d in cursor:
-                out_file.write(dumps(d) + '\n')
-        return
+def save_backup_manifest(backup_dir, manifest):
+    manifest_file = os.path.join(backup_dir, BACKUP_MANIFEST_FILE)
+    with open(manifest_file + '.tmp', 'w') as out_file:
+        json.dump(manifest, out_file, indent=2)
+    os.replace(manifest_file + '.tmp', manifest_file)
+    return
 
-    def get_all_players(self):
-        self.all_players = self.collection.find().sort('current_rating', DESCENDING)
-        return self.all_players
 
-    def get_current_ratings(self):
-        if self.all_players is None:
-            self.get_all_players()
+def get_backup_names(backups: list, target: int):
+    # The names of all players when the backup at target was taken. Full backups list all of them, incremental
+    # backups only the players added and removed since the backup before.
+    start = max(i for i in range(target + 1) if 'names' in backups[i])
+    names = set(backups[start]['names'])
+    for b in backups[start + 1:target + 1]:
+        names = (names - set(b['removed'])) | set(b['added'])
+    return names
 
-        self.all_players.rewind()
-        for p in self.all_players:
-            self.current_ratings[p['name']] = p['historical_ratings'][-1]
-        return self.current_ratings
 
-    def get_player_history(self, player_name: str):
-        player_info = self.collection.find_one({'name': player_name})
-        if player_info is not None:
-            return player_info['historical_ratings']
-        else:
-            return []
+def get_backup_file_name(backup_dir, date_str, backups: list, extension):
+    # Numbered after the backups in the manifest. A number already taken by a file, such as an old backup
+    # written before the manifest, is skipped so that no backup is overwritten.
+    taken = set(b['file'] for b in backups)
+    number = len(backups)
+    while True:
+        names = [f'ratings_before_{date_str}_{number}{e}' for e in BACKUP_EXTENSIONS.values()]
+        if not any(n in taken or os.path.exists(os.path.join(backup_dir, n)) for n in names):
+            return f'ratings_before_{date_str}_{number}{extension}'
+        number += 1
 
-    def get_ratings_history(self, player_list: list):
-        ratings_history = {}
-        if 'all' in map(str.lower, player_list):
-            if self.all_players is None:
-                self.get_all_players()
 
-            self.all_players.rewind()
-            for p in self.all_players:
-                ratings_history[p['name']] = p['historical_ratings']
-        else:
-            for p in player_list:
-                ratings_history[p] = self.get_player_history(p)
-        return ratings_history
+def utc_now():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
 
-    def get_last_update_date(self):
-        if self.all_players is None:
-            self.get_all_players()
 
-        last_update = datetime.strptime('2000-01-01', '%Y-%m-%d').replace(hour=14)
-        self.all_players.rewind()
-        for p in self.all_players:
-            last_update = p['last_played'] if p['last_played'] > last_update else last_update
-        return last_update
+class Profiler():
+    # Wall time, calls, bytes transferred and documents read and written of every phase and external call.
+    # Nothing is recorded unless it is enabled with --profile, --profile-output or --profile-cprofile.
 
-    def set_new_ratings(self, new_ratings: dict, new_emails: dict=None):
-        for k, v in new_ratings.items():
-            player = self.collection.find_one({'name': k})
-            r = float(v[0])
-            d = v[1]
-            if player is None:
-                new_player = {
-                    'name': k,
-                    'email': new_emails[k],
-                    'leagues_played': 1,
-                    'last_played': d,
-                    'current_rating': r,
-                    'historical_ratings': [[r, d]]
-                }
-                self.collection.insert_one(new_player)
-            else:
-                if player['last_played'] < d:
-                    player['historical_ratings'].append([r, d])
-                    self.collection.update_one(
-                        {'name': k},
-                        {
-                            '$inc': {'leagues_played': 1},
-                            '$set': {
-                                'last_played': d,
-                                'current_rating': r,
-                                'historical_ratings': player['historical_ratings']
-                            }
-                        }
-                    )
-        return
-
-    def update_ratings_from_sheet(self, new_ratings: dict, new_emails: dict=None):
-        for k, v in new_ratings.items():
-            player = self.collection.find_one({'name': k})
-            r = float(v[0])
-            d = v[1]
-            if player is None:
-                new_player = {
-                    'name': k,
-                    'email': new_emails[k],
-                    'leagues_played': 1,
-                    'last_played': d,
-                    'current_rating': r,
-                    'historical_ratings': [[r, d]]
-                }
-                self.collection.insert_one(new_player)
-            else:
-                player['historical_ratings'].append([r, d])
-                self.collection.update_one(
-                    {'name': k},
-                    {
-                        '$set': {
-                            'current_rating': r,
-                            'historical_ratings': player['historical_ratings']
-                        }
-                    }
-                )
+    def __init__(self):
+        self.enabled = False
+        self.stats = {}
+        self.cprofile = None
+        self.cprofile_used = False
+        # Bytes and documents of the profiled calls that are running, innermost last.
+        self.frames = []
         return
 
-    def remove_league(self):
+    def add(self, transferred=0, read=0):
+        # Counted in the innermost running call, and in the calls around it when it ends.
+        if len(self.frames) > 0:
+            self.frames[-1]['bytes'] += transferred
+            self.frames[-1]['read'] += read
         return
 
+    def count(self, documents):
+        for d in documents:
+            self.add(read=1)
+            yield d
 
-class GoogleSheet():
-
-    # If modifying these scopes, delete the file token.json.
-    SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
+    def push(self):
+        self.frames.append({'bytes': 0, 'read': 0})
+        return
 
-    # The ID and range of a sample spreadsheet.
-    SPREADSHEET_ID = '1IYGaCxJjT8H2oTvIdm423oCuSsRGHjWGnTW7dD_7kxg'
+    def pop(self):
+        frame = self.frames.pop()
+        self.add(frame['bytes'], frame['read'])
+        return frame
 
-    RATINGS_HEADERS_RANGE = 'Ratings!C1:C1'
-    RATINGS_RANGE = 'Ratings!A2:D'
-    PLAYERS_RANGE = 'Ratings!B2:D'
+    def record(self, name, seconds, transferred=0, read=0, written=0):
+        stats = self.stats.setdefault(name, {'calls': 0, 'seconds': 0.0, 'bytes': 0, 'read': 0, 'written': 0})
+        stats['calls'] += 1
+        stats['seconds'] += seconds
+        stats['bytes'] += transferred
+        stats['read'] += read
+        stats['written'] += written
+        return
 
-    def __init__(self, date_str, cred_file="google_cred.json"):
-        self.date_str = date_str
-        self.ratings_range = [f'{date_str}!C2:E7', f'{date_str}!C19:E24', f'{date_str}!C36:E41']
-        self.score_ranges = [f'{date_str}!H2:S16', f'{date_str}!H19:S33', f'{date_str}!H36:S50']
-        self.player_ranges = [f'{date_str}!B2:B7', f'{date_str}!B19:B24', f'{date_str}!B36:B41']
-        self.creds = None
-        self.sheet = None
-        self.scores = []
-        self.all_players = []
-        self.players_per_league = {}
+    def print_table(self):
+        print()
+        print(f'  {"Phase": <40} {"Calls": >7} {"Seconds": >10} {"Bytes": >12} {"Read": >8} {"Written": >8}')
+        for name, stats in sorted(self.stats.items(), key=lambda item: -item[1]['seconds']):
+            print(f'  {name: <40} {stats["calls"]: >7} {stats["seconds"]: >10.4f} {stats["bytes"]: >12,} '
+                  f'{stats["read"]: >8} {stats["written"]: >8}')
+        return
 
-        # The file token.json stores the user's access and refresh tokens, and is
-        # created automatically when the authorization flow completes for the first
-        # time.
-        if os.path.exists('token.json'):
-            self.creds = Credentials.from_authorized_user_file('token.json', self.SCOPES)
+    def to_prometheus(self):
+        lines = []
+        metrics = [
+            ('seconds', 'Wall time spent in the phase.'),
+            ('calls', 'Number of calls of the phase.'),
+            ('bytes', 'Bytes sent to and received from the service.'),
+            ('read', 'Documents read.'),
+            ('written', 'Documents written.')
+        ]
+        for metric, help_text in metrics:
+            lines.append(f'# HELP tt_ratings_phase_{metric} {help_text}')
+            lines.append(f'# TYPE tt_ratings_phase_{metric} gauge')
+            for name, stats in self.stats.items():
+                lines.append(f'tt_ratings_phase_{metric}{{phase="{name}"}} {stats[metric]}')
+        return '\n'.join(lines) + '\n'
 
-        # If there are no (valid) credentials available, let the user log in.
-        if not self.creds or not self.creds.valid:
-            if self.creds and self.creds.expired and self.creds.refresh_token:
-                try:
-                    self.creds.refresh(Request())
-                except RefreshError:
-                    flow = InstalledAppFlow.from_client_secrets_file(cred_file, self.SCOPES)
-                    self.creds = flow.run_local_server(port=0)
+    def report(self, print_table, output_file=None, cprofile_file=None):
+        if print_table:
+            self.print_table()
+        if output_file is not None:
+            with open(output_file, 'w') as out_file:
+                if output_file.endswith('.json'):
+                    json.dump(self.stats, out_file, indent=2)
+                else:
+                    out_file.write(self.to_prometheus())
+        if cprofile_file is not None and self.cprofile is not None:
+            if self.cprofile_used:
+                self.cprofile.dump_stats(cprofile_file)
             else:
-                flow = InstalledAppFlow.from_client_secrets_file(cred_file, self.SCOPES)
-                self.creds = flow.run_local_server(port=0)
-            # Save the credentials for the next run
-            with open('token.json', 'w') as token:
-                token.write(self.creds.to_json())
+                print(f'No rating calculation ran, {cprofile_file} was not written.')
         return
 
-    def get_sheet(self):
-        try:
-            service = build('sheets', 'v4', credentials=self.creds)
-            self.sheet = service.spreadsheets()
-        except HttpError as err:
-            print(f'Failed to get spreadsheet, error: {err}')
-            exit(1)
-        return self.sheet
 
-    def get_scores(self):
-        if self.sheet is None:
-            self.get_sheet()
+PROFILER = Profiler()
 
-        try:
-            for r in self.score_ranges:
-                result = self.sheet.values().get(spreadsheetId=self.SPREADSHEET_ID, range=r).execute()
-                scores = result.get('values', [])
-                for row in scores:
-                    row[:2] = map(str.strip, row[:2])
-                    row[2:] = map(int, row[2:])
-                self.scores.extend(scores)
-        except HttpError as err:
-            print(f'Failed to get league scores, error: {err}')
-            exit(1)
-        return self.scores
 
-    def get_all_ratings(self):
-        if self.sheet is None:
-            self.get_sheet()
+def profiled(read=None, written=None, transferred=None, compute=False):
+    # Records the calls of a method or function in PROFILER. read, written and transferred take the result and the
+    # arguments and return the documents read, the documents written and the bytes. The documents of cursors passed
+    # through counted() and the bytes of MongoDB commands are added by the calls that read them. The compute sections
+    # are also run under cProfile when a dump was asked for. A generator is timed while it produces its items.
+    def decorator(func):
+        def record(name, seconds, frame, result, args):
+            PROFILER.record(
+                name,
+                seconds,
+                frame['bytes'] + (transferred(result, args) if transferred is not None else 0),
+                frame['read'] + (read(result, args) if read is not None else 0),
+                written(result, args) if written is not None else 0
+            )
+            return
 
-        try:
-            values = self.sheet.values().get(spreadsheetId=self.SPREADSHEET_ID, range=self.PLAYERS_RANGE).execute()
-            ratings = values.get('values', [])
+        def get_name(args):
+            return func.__name__ if '.' not in func.__qualname__ else f'{type(args[0]).__name__}.{func.__name__}'
 
-            player_ratings = {}
-            for player in ratings:
-                player_ratings[player[0]] = [float(player[1]), player[2]]
-            return player_ratings
-        except HttpError as err:
-            print(f'Failed to get current ratings, error: {err}')
-            exit(1)
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not PROFILER.enabled:
+                return func(*args, **kwargs)
+            cprofile = PROFILER.cprofile if compute else None
+            start = time.perf_counter()
+            PROFILER.push()
+            if cprofile is not None:
+                PROFILER.cprofile_used = True
+                cprofile.enable()
+            try:
+                result = func(*args, **kwargs)
+            finally:
+                if cprofile is not None:
+                    cprofile.disable()
+                frame = PROFILER.pop()
+            record(get_name(args), time.perf_counter() - start, frame, result, args)
+            return result
 
-    def get_league_players(self):
-        if self.sheet is None:
-            self.get_sheet()
+        @functools.wraps(func)
+        def generator_wrapper(*args, **kwargs):
+            if not PROFILER.enabled:
+                yield from func(*args, **kwargs)
+                return
+            items = func(*args, **kwargs)
+            seconds = 0.0
+            frame = {'bytes': 0, 'read': 0}
+            try:
+                while True:
+                    # The frame is only on the stack while the generator runs, not while the caller uses the item.
+                    start = time.perf_counter()
+                    PROFILER.frames.append(frame)
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        return
+                    finally:
+                        PROFILER.frames.pop()
+                        seconds += time.perf_counter() - start
+                    yield item
+            finally:
+                items.close()
+                PROFILER.add(frame['bytes'], frame['read'])
+                record(get_name(args), seconds, frame, None, args)
 
-        try:
-            for i in range(len(self.player_ranges)):
-                r = self.player_ranges[i]
-                league = i + 1
-                self.players_per_league[league] = []
-                result = self.sheet.values().get(spreadsheetId=self.SPREADSHEET_ID, range=r).execute()
-                values = result.get('values', [])
-                for v in values:
-                    self.players_per_league[league].extend(v)
-                self.players_per_league[league] = list(map(str.strip, self.players_per_league[league]))
-                self.all_players.extend(self.players_per_league[league])
-        except HttpError as err:
-            print(f'Failed to get league players, error: {err}')
-            exit(1)
-        return self.all_players
+        return generator_wrapper if inspect.isgeneratorfunction(func) else wrapper
+    return decorator
 
-    def set_new_ratings(self, new_ratings: dict, rating_increased: dict, rating_decreased: dict, active_days):
-        try:
-            all_player_ratings = []
-            league_player_ratings = {}
-            ranking = 0
-            for k, v in new_ratings.items():
-                if k in self.all_players:
-                    try:
-                        rating_diff = f'+{rating_increased[k]}'
-                    except KeyError:
-                        try:
-                            rating_diff = f'{rating_decreased[k]}'
-                        except KeyError:
-                            rating_diff = '0'
-                    league_player_ratings[k] = [v[0] - float(rating_diff), rating_diff, v[0]]
-
-                ranking += 1
-                active_player = True
-                if (datetime.strptime(self.date_str, '%Y-%m-%d').replace(hour=14) - v[1]).days > active_days:
-                    active_player = False
-                all_player_ratings.append([ranking, k, v[0], active_player])
-                print(f'{k}     active:{active_player}')
-
-            for l in self.players_per_league:
-                values = []
-                for p in self.players_per_league[l]:
-                    if p == '':
-                        values.append(['', '', ''])
-                    else:
-                        values.append(league_player_ratings[p])
-                self.sheet.values().update(spreadsheetId=self.SPREADSHEET_ID, range=self.ratings_range[l - 1], valueInputOption='RAW', body={'values': values}).execute()
-
-            self.sheet.values().clear(spreadsheetId=self.SPREADSHEET_ID, range=self.RATINGS_HEADERS_RANGE).execute()
-            self.sheet.values().update(spreadsheetId=self.SPREADSHEET_ID, range=self.RATINGS_HEADERS_RANGE, valueInputOption='RAW', body={'values': [[f'{self.date_str}']]}).execute()
-            self.sheet.values().clear(spreadsheetId=self.SPREADSHEET_ID, range=self.RATINGS_RANGE).execute()
-            self.sheet.values().update(spreadsheetId=self.SPREADSHEET_ID, range=self.RATINGS_RANGE, valueInputOption='RAW', body={'values': all_player_ratings}).execute()
-        except HttpError as err:
-            print(f'Failed to update ratings, error: {err}')
-            exit(1)
-        return
 
-    def print_active_status(self, new_ratings: dict, rating_increased: dict, rating_decreased: dict, active_days):
-        all_player_ratings = []
-        league_player_ratings = {}
-        ranking = 0
-        for k, v in new_ratings.items():
-            if k in self.all_players:
-                try:
-                    rating_diff = f'+{rating_increased[k]}'
-                except KeyError:
-                    try:
-                        rating_diff = f'{rating_decreased[k]}'
-                    except KeyError:
-                        rating_diff = ''
-                league_player_ratings[k] = [v[0], rating_diff]
-
-            ranking += 1
-            active_player = True
-            if (datetime.strptime(self.date_str, '%Y-%m-%d').replace(hour=14) - v[1]).days > active_days:
-                active_player = False
-            all_player_ratings.append([ranking, k, v[0], active_player])
-            print(f'{k}     active:{active_player}')
-        return
+def counted(documents):
+    # Counts the documents of a cursor as read by the profiled call that iterates it.
+    if not PROFILER.enabled:
+        return documents
+    return PROFILER.count(documents)
 
 
-def calculate_new_ratings(current_ratings, league_scores, date_str, print_out):
-    rating_changes = {}
-    for row in league_scores:
-        if len(row) < 2:
-            continue
-        p1_name = row[0]
-        p2_name = row[1]
-        if p1_name == '' or p2_name == '':
-            continue
-        p1_rating = current_ratings[p1_name][0]
-        p2_rating = current_ratings[p2_name][0]
-        p1 = Player(p1_name, p1_rating)
-        p2 = Player(p2_name, p2_rating)
-        score_diffs_p1vp2 = []
-        score_diffs_p2vp1 = []
-        for game in range(5): # the match is best of 5
-            idx = game * 2 + 2
-            try:
-                score1 = row[idx]
-                score2 = row[idx +1]
-                if (not np.isnan(score1)) and (not np.isnan(score2)):
-                    score_diffs_p1vp2.append(score1 - score2)
-                    score_diffs_p2vp1.append(score2 - score1)
-            except IndexError:
-                break
-        if (len(score_diffs_p1vp2) > 0) and (len(score_diffs_p2vp1) > 0):
-            new_p1_rating = p1.add_match_against(p2, score_diffs_p1vp2, print_out)
-            new_p2_rating = p2.add_match_against(p1, score_diffs_p2vp1, print_out)
-            if print_out:
-                print()
+def get_command_listener():
+    # A pymongo command listener that adds the size of every command and its reply to the profiled call that sent
+    # it, and records the commands as phases of their own.
+    from bson import encode
+    from pymongo.monitoring import CommandListener
 
-            if p1_name not in rating_changes:
-                rating_changes[p1_name] = [new_p1_rating - p1_rating]
-            else:
-                rating_changes[p1_name].append(new_p1_rating - p1_rating)
-            if p2_name not in rating_changes:
-                rating_changes[p2_name] = [new_p2_rating - p2_rating]
-            else:
-                rating_changes[p2_name].append(new_p2_rating - p2_rating)
+    class ProfiledCommands(CommandListener):
 
-    new_ratings = copy.deepcopy(current_ratings)
-    if date_str == '':
-        print('No date provided, retaining existing dates')
-    for player in rating_changes:
-        new_ratings[player][0] += sum(rating_changes[player])
-        if date_str != '':
-            new_ratings[player][1] = datetime.strptime(date_str, '%Y-%m-%d').replace(hour=14)
-        else:
-            new_ratings[player][1] = current_ratings[player][1]
-    new_ratings = dict(sorted(new_ratings.items(), key=lambda item: item[1][0], reverse=True))
+        def __init__(self):
+            self.sent = {}
+            return
 
-    return new_ratings
+        def started(self, event):
+            self.sent[event.request_id] = len(encode(event.command))
+            PROFILER.add(transferred=self.sent[event.request_id])
+            return
 
+        def succeeded(self, event):
+            size = len(encode(event.reply))
+            PROFILER.add(transferred=size)
+            PROFILER.record(f'mongodb.{event.command_name}', event.duration_micros / 1e6,
+                            transferred=self.sent.pop(event.request_id, 0) + size)
+            return
 
-def get_rating_diffs(current_ratings, new_ratings):
-    rating_increased = {}
-    rating_decreased = {}
+        def failed(self, event):
+            PROFILER.record(f'mongodb.{event.command_name}', event.duration_micros / 1e6,
+                            transferred=self.sent.pop(event.request_id, 0))
+            return
 
-    for key in new_ratings:
-        rating_diff = round(new_ratings[key][0] - current_ratings[key][0], 2)
-        if key in current_ratings and (rating_diff > 0):
-            rating_increased[key] = rating_diff
-        elif key in current_ratings and (rating_diff < 0):
-            rating_decreased[key] = rating_diff
+    return ProfiledCommands()
 
-    return rating_increased, rating_decreased
 
+def json_size(value):
+    return len(json.dumps(value, default=str))
 
-def new_league(date_str, cert_file, google_cred, active_days, execute, print_out):
-    print('Connecting to google sheets...')
-    google_sheet = GoogleSheet(date_str, google_cred)
 
-    print('Connecting to MongoDB...')
-    mongodb = MongoDB(date_str, cert_file)
+class RatingsStorage():
+    # Base class of the rating storages, the commands only use the methods defined here.
 
-    league_scores = google_sheet.get_scores()
-    if not league_scores:
-        print(f'No scores found for {date_str}.')
+    def __init__(self, date_str):
+        self.current_ratings = {}
+        self.date_str = date_str
+        self.backup_dir = '.'
+        self.backup_compression = 'gzip'
+        self.full_backup = False
+        # Called after ratings are committed, so that readers such as the ratings service drop their caches.
+        self.commit_listeners = []
         return
-    league_players = google_sheet.get_league_players()
 
-    last_update = mongodb.get_last_update_date()
-    if last_update >= datetime.strptime(date_str, '%Y-%m-%d').replace(hour=14):
-        print(f'Leagues on "{date_str}" has already been processed before.')
-        return
-    current_ratings = mongodb.get_current_ratings()
-    missing_players = league_players - current_ratings.keys()
+    def get_all_documents(self):
+        raise NotImplementedError
 
-    print()
-    league_avg_ratings = {}
-    for i in range(len(google_sheet.players_per_league)):
-        league = i + 1
-        if len(google_sheet.players_per_league[league]) == 0:
-            break
+    def get_documents_updated_since(self, since):
+        # Every write stamps the changed player documents with an "updated" time.
+        for d in self.get_all_documents():
+            if d.get('updated') is not None and d['updated'] >= since:
+                yield d
 
-        print(f'League {league}:')
-        total_ratings = 0.0
-        player_count = 0
-        for p in google_sheet.players_per_league[league]:
-            try:
-                total_ratings += current_ratings[p][0]
-                player_count += 1
-            except KeyError:
-                pass
-            print(f'  {p}')
-        if player_count > 0:
-            league_avg_ratings[league] = total_ratings / player_count
-        else:
-            league_avg_ratings[league] = 0
-        print()
+    def get_player_names(self):
+        return [d['name'] for d in self.get_all_documents()]
 
-    while True:
-        print('Please make sure the players listed above are correct for each league. [y/N] ', end='')
-        player_check = input()
-        try:
-            if player_check.strip().lower() == 'y':
-                break
-            else:
-                print('\nPlease check the date of the league matches, then try running the script again.')
-                return
-        except KeyboardInterrupt:
-            return
+    def get_existing_players(self, player_names):
+        raise NotImplementedError
 
-    new_emails = {}
-    for p in missing_players:
-        if p != '':
-            while True:
-                for i in range(len(google_sheet.players_per_league)):
-                    league = i + 1
-                    if p in google_sheet.players_per_league[league]:
-                        print(f'Missing rating for "{p}", average ratings for league {league} is {round(league_avg_ratings[league], 2)}. Please enter initial rating: ', end='')
+    def insert_documents(self, documents: list):
+        raise NotImplementedError
+
+    def apply_rating_updates(self, inserts: list, updates: list, new_league: bool):
+        raise NotImplementedError
+
+    def get_current_ratings(self):
+        raise NotImplementedError
+
+    def get_player_history(self, player_name: str, last=None):
+        raise NotImplementedError
+
+    def iter_ratings_history(self, player_list: list, last=None, limit=None, offset=0):
+        raise NotImplementedError
+
+    def get_ratings_history(self, player_list: list, last=None):
+        return dict(self.iter_ratings_history(player_list, last))
+
+    def get_active_players(self, date, active_days, min_rating=None):
+        # Returns [ranking, name, rating, last_played] of the players who played within active_days of the date,
+        # highest rating first. The ranking is on the whole leaderboard.
+        raise NotImplementedError
+
+    def get_last_update_date(self):
+        raise NotImplementedError
+
+    def get_data_version(self):
+        # Changes whenever a player is written or deleted.
+        raise NotImplementedError
+
+    def get_source(self):
+        # Names the data the storage reads, for the files made from it such as the leaderboard index.
+        return type(self).__name__
+
+    def notify_commit(self):
+        for listener in self.commit_listeners:
+            listener()
+        return
+
+    def use_snapshot(self):
+        # For long running processes: get_current_ratings is served from a copy kept in memory until the data
+        # version changes, which also notices writes made by other processes.
+        get_current_ratings = self.get_current_ratings
+        snapshot = {}
+
+        def get_snapshot():
+            version = self.get_data_version()
+            if snapshot.get('version') != version or 'ratings' not in snapshot:
+                self.current_ratings = {}
+                snapshot['ratings'] = copy.deepcopy(get_current_ratings())
+                snapshot['version'] = version
+            # The commands add the new players to the returned dict.
+            self.current_ratings = copy.deepcopy(snapshot['ratings'])
+            return self.current_ratings
+
+        self.get_current_ratings = get_snapshot
+        return
+
+    def get_rating_history_arrays(self, player_list: list):
+        # Streamed into the arrays, the history is never held as a dict of lists.
+        return RatingHistory.from_iter(self.iter_ratings_history(player_list))
+
+    def delete_players(self, player_names: list):
+        raise NotImplementedError
+
+    def save_matches(self, date, league_scores: list, initial_ratings: dict=None):
+        raise NotImplementedError
+
+    def get_matches(self, from_date=None):
+        raise NotImplementedError
+
+    def delete_matches(self, date):
+        raise NotImplementedError
+
+    @profiled(transferred=lambda result, args: os.path.getsize(os.path.join(args[0].backup_dir, result)))
+    def backup(self, full=None):
+        # Writes the documents changed since the last backup, or all documents for a full backup. Every backup is
+        # listed in the manifest, with the player names of the time to restore removed players, see get_backup_names.
+        if full is None:
+            full = self.full_backup
+        manifest = load_backup_manifest(self.backup_dir)
+        backups = manifest['backups']
+        full_backups = [i for i, b in enumerate(backups) if b['type'] == 'full']
+        if full or len(full_backups) == 0 or len(backups) - full_backups[-1] > BACKUP_FULL_EVERY:
+            backup_type = 'full'
+            since = None
+        else:
+            backup_type = 'incremental'
+            since = backups[-1]['created']
+
+        created = utc_now()
+        os.makedirs(self.backup_dir, exist_ok=True)
+        backup_file_name = get_backup_file_name(
+            self.backup_dir, self.date_str, backups, BACKUP_EXTENSIONS[self.backup_compression]
+        )
+        if since is None:
+            documents = self.get_all_documents()
+        else:
+            documents = self.get_documents_updated_since(datetime.fromisoformat(since))
+
+        from bson.json_util import dumps
+        count = 0
+        with open_backup_file(os.path.join(self.backup_dir, backup_file_name), 'w') as out_file:
+            for d in documents:
+                out_file.write(dumps(d) + '\n')
+                count += 1
+
+        entry = {
+            'file': backup_file_name,
+            'type': backup_type,
+            'created': created.isoformat(),
+            'since': since,
+            'documents': count
+        }
+        names = set(self.get_player_names())
+        if backup_type == 'full':
+            entry['names'] = sorted(names)
+        else:
+            previous_names = get_backup_names(backups, len(backups) - 1)
+            entry['added'] = sorted(names - previous_names)
+            entry['removed'] = sorted(previous_names - names)
+        backups.append(entry)
+        save_backup_manifest(self.backup_dir, manifest)
+        print(f'Backed up {count} players to {backup_file_name} ({backup_type}).')
+        return backup_file_name
+
+    @profiled()
+    def restore(self, backup_file=None, dry_run=False, batch_size=1000):
+        # Restores the last full backup before the given backup (the latest one by default), followed by
+        # every incremental backup up to the given one.
+        backups = load_backup_manifest(self.backup_dir)['backups']
+        if backup_file is None and len(backups) == 0:
+            print(f'No backups found in {self.backup_dir}.')
+            return None
+
+        names = [b['file'] for b in backups]
+        if backup_file is None:
+            target = len(backups) - 1
+        elif os.path.basename(backup_file) in names:
+            target = names.index(os.path.basename(backup_file))
+        else:
+            # A backup that is not in the manifest, such as an old uncompressed one, is restored on its own.
+            target = None
+
+        if target is None:
+            chain = [{'file': backup_file, 'type': 'full'}]
+            player_names = None
+        else:
+            start = max([i for i in range(target + 1) if backups[i]['type'] == 'full'], default=None)
+            if start is None:
+                print(f'No full backup found before {names[target]}.')
+                return None
+            chain = [dict(b, file=os.path.join(self.backup_dir, b['file'])) for b in backups[start:target + 1]]
+            player_names = get_backup_names(backups, target)
+
+        from bson.json_util import loads
+        counts = {'backups': len(chain), 'documents': 0, 'removals': 0}
+        for b in chain:
+            with open_backup_file(b['file'], 'r') as in_file:
+                documents = []
+                for line in in_file:
+                    if line.strip() == '':
+                        continue
+                    d = loads(line)
+                    d.pop('_id', None)
+                    documents.append(d)
+                    if len(documents) >= batch_size:
+                        counts['documents'] += len(documents)
+                        if not dry_run:
+                            self.insert_documents(documents)
+                        documents = []
+                counts['documents'] += len(documents)
+                if not dry_run and len(documents) > 0:
+                    self.insert_documents(documents)
+
+        if player_names is not None:
+            removed_players = sorted(set(self.get_player_names()) - player_names)
+            counts['removals'] = len(removed_players)
+            if not dry_run:
+                self.delete_players(removed_players)
+
+        if dry_run:
+            print(f'Dry run, restoring {counts["backups"]} backups would write {counts["documents"]} players '
+                  f'and remove {counts["removals"]} players.')
+        else:
+            self.notify_commit()
+        return counts
+
+    def import_json(self, json_file):
+        # Loads a mongoexport file, one extended JSON document per line, such as players.json.
+        from bson.json_util import loads
+        documents = []
+        with open(json_file, 'r') as in_file:
+            for line in in_file:
+                if line.strip() == '':
+                    continue
+                d = loads(line)
+                d.pop('_id', None)
+                documents.append(d)
+        self.insert_documents(documents)
+        return len(documents)
+
+    def get_rating_updates(self, new_ratings: dict, new_emails: dict, new_league: bool):
+        # A new league only updates players who have not played on a later date yet, a sheet update
+        # updates every player.
+        existing_players = self.get_existing_players(new_ratings.keys())
+        inserts = []
+        updates = []
+        for k, v in new_ratings.items():
+            r = float(v[0])
+            d = v[1]
+            if k not in existing_players:
+                email = new_emails.get(k, '') if new_emails else ''
+                inserts.append((k, r, d, email))
+            elif new_league and existing_players[k]['last_played'] < d:
+                updates.append((k, r, d))
+            elif not new_league and round(existing_players[k]['current_rating'], 2) != round(r, 2):
+                # The sheet lists every player, only the ratings that were changed on it get a new point.
+                # Ratings are shown with 2 decimals, smaller differences are not changes.
+                updates.append((k, r, d))
+        return inserts, updates
+
+    def write_rating_updates(self, inserts: list, updates: list, new_league: bool, dry_run=False):
+        counts = {'inserts': len(inserts), 'updates': len(updates), 'total': len(inserts) + len(updates)}
+        if dry_run:
+            print(f'Dry run, {counts["total"]} write operations would be sent to the database: '
+                  f'{counts["inserts"]} new players, {counts["updates"]} updated players.')
+            return counts
+        if counts['total'] > 0:
+            self.apply_rating_updates(inserts, updates, new_league)
+            self.notify_commit()
+        return counts
+
+    def set_new_ratings(self, new_ratings: dict, new_emails: dict=None, dry_run=False):
+        inserts, updates = self.get_rating_updates(new_ratings, new_emails, True)
+        return self.write_rating_updates(inserts, updates, True, dry_run)
+
+    def update_ratings_from_sheet(self, new_ratings: dict, new_emails: dict=None, dry_run=False):
+        inserts, updates = self.get_rating_updates(new_ratings, new_emails, False)
+        unchanged = len(new_ratings) - len(inserts) - len(updates)
+        if unchanged > 0:
+            print(f'{unchanged} players with an unchanged rating are skipped.')
+        return self.write_rating_updates(inserts, updates, False, dry_run)
+
+    @profiled(compute=True)
+    def replay_from(self, date, previous_matches: list, matches: list=None, dry_run=False):
+        # Recomputes every history point from the date on, using the stored matches. The history before the
+        # date is kept as it is and the ratings are carried on from the last point before the date.
+        # previous_matches are the stored matches the current histories were calculated from.
+        if matches is None:
+            matches = self.get_matches(date)
+        players = {p['name']: p for p in self.get_all_documents()}
+
+        match_dates = {m['date'] for m in matches} | {m['date'] for m in previous_matches}
+        missing_dates = sorted({h[1] for p in players.values() for h in p['historical_ratings']
+                                if h[1] >= date} - match_dates)
+        if len(missing_dates) > 0:
+            print(f'No stored matches for {", ".join(d.strftime("%Y-%m-%d") for d in missing_dates)}, '
+                  f'cannot replay the ratings from {date.strftime("%Y-%m-%d")}.')
+            return None
+
+        current_ratings = {}
+        histories = {}
+        leagues_played = {}
+        for name, p in players.items():
+            histories[name] = [list(h) for h in p['historical_ratings'] if h[1] < date]
+            if len(histories[name]) > 0:
+                current_ratings[name] = list(histories[name][-1])
+            leagues_played[name] = p['leagues_played']
+        for m in previous_matches:
+            for name in get_played_players(m['scores']):
+                if name in leagues_played:
+                    leagues_played[name] -= 1
+
+        # Players who joined on a removed night start from the rating they were given on that night.
+        initial_ratings = {}
+        for m in previous_matches + matches:
+            for name, rating in m['initial_ratings'].items():
+                initial_ratings.setdefault(name, rating)
+
+        for m in matches:
+            for row in m['scores']:
+                for name in row[:2]:
+                    if name != '' and name not in current_ratings:
+                        current_ratings[name] = [initial_ratings[name], m['date']]
+                        histories.setdefault(name, [])
+                        leagues_played.setdefault(name, 0)
+
+            player_names = list(current_ratings)
+            player_index = {name: i for i, name in enumerate(player_names)}
+            ratings = np.array([current_ratings[name][0] for name in player_names], dtype=np.float64)
+            new_ratings, played = calculate_new_ratings_columnar(ratings, scores_to_columns(m['scores'], player_index))
+            for i in np.flatnonzero(played):
+                name = player_names[i]
+                current_ratings[name] = [float(new_ratings[i]), m['date']]
+                histories[name].append([float(new_ratings[i]), m['date']])
+                leagues_played[name] += 1
+
+        changed_players = []
+        removed_players = []
+        for name, history in histories.items():
+            p = players.get(name)
+            if len(history) == 0:
+                if p is not None:
+                    removed_players.append(name)
+                continue
+            if p is not None and p['historical_ratings'] == history and p['leagues_played'] == leagues_played[name]:
+                continue
+            document = dict(p) if p is not None else new_player_document(name, history[0][0], history[0][1], '')
+            document['historical_ratings'] = history
+            document['current_rating'] = history[-1][0]
+            document['last_played'] = history[-1][1]
+            document['leagues_played'] = leagues_played[name]
+            changed_players.append(document)
+
+        counts = {'nights': len(matches), 'updates': len(changed_players), 'removals': len(removed_players)}
+        if dry_run:
+            print(f'Dry run, replaying {counts["nights"]} league nights would update {counts["updates"]} players '
+                  f'and remove {counts["removals"]} players.')
+            return counts
+        self.insert_documents(changed_players)
+        self.delete_players(removed_players)
+        self.notify_commit()
+        return counts
+
+    def remove_league(self, dry_run=False):
+        date = datetime.strptime(self.date_str, '%Y-%m-%d').replace(hour=14)
+        previous_matches = self.get_matches(date)
+        if len(previous_matches) == 0 or previous_matches[0]['date'] != date:
+            print(f'No stored matches for {self.date_str}.')
+            return None
+
+        counts = self.replay_from(date, previous_matches, previous_matches[1:], dry_run)
+        if counts is not None and not dry_run:
+            self.delete_matches(date)
+        return counts
+
+    def compact_history(self, dry_run=False):
+        # Removes the history points that were replaced by a later point on the same date, such as the points every
+        # sheet update used to add for all players. Only the changed players are written, 500 per bulk write.
+        from bson import encode
+        counts = {'players': 0, 'points': 0, 'bytes': 0}
+        changed_players = []
+        for d in self.get_all_documents():
+            history = compact_history_points(d['historical_ratings'])
+            if len(history) == len(d['historical_ratings']):
+                continue
+            counts['players'] += 1
+            counts['points'] += len(d['historical_ratings']) - len(history)
+            counts['bytes'] += len(encode({'h': d['historical_ratings']})) - len(encode({'h': history}))
+            changed_players.append(dict(d, historical_ratings=history))
+            if len(changed_players) == 500:
+                if not dry_run:
+                    self.insert_documents(changed_players)
+                changed_players = []
+        if dry_run:
+            print(f'Dry run, compacting would remove {counts["points"]} history points of {counts["players"]} players '
+                  f'and reclaim {counts["bytes"]} bytes.')
+            return counts
+        self.insert_documents(changed_players)
+        print(f'Removed {counts["points"]} history points of {counts["players"]} players, '
+              f'reclaimed {counts["bytes"]} bytes.')
+        if counts['players'] > 0:
+            self.notify_commit()
+        return counts
+
+
+def compact_history_points(history: list):
+    # Keeps the last point of every date, the history is in date order.
+    return [h for i, h in enumerate(history) if i + 1 == len(history) or history[i + 1][1] != h[1]]
+
+
+def get_played_players(league_scores: list):
+    played_players = set()
+    for row in league_scores:
+        if len(row) < 2 or row[0] == '' or row[1] == '':
+            continue
+        score_diffs_p1vp2, score_diffs_p2vp1 = get_score_differentials(row)
+        if len(score_diffs_p1vp2) > 0:
+            played_players.update(row[:2])
+    return played_players
+
+
+def get_player_page(player_list: list, limit=None, offset=0):
+    # Named players are paged in the given order, None means the storage pages through all players by rating.
+    if 'all' in map(str.lower, player_list):
+        return None
+    return player_list[offset:None if limit is None else offset + limit]
+
+
+def new_player_document(name, rating, date, email):
+    return {
+        'name': name,
+        'email': email,
+        'leagues_played': 1,
+        'last_played': date,
+        'current_rating': rating,
+        'historical_ratings': [[rating, date]]
+    }
+
+
+class MongoDB(RatingsStorage):
+
+    CONNECTION_URI = 'mongodb+srv://duke-cluster.ops3ljm.mongodb.net/?authSource=%24external&authMechanism=MONGODB-X509&retryWrites=true&w=majority'
+    # The collections whose indexes were created by this process, so the daemon and the service only do it once.
+    INDEXED_COLLECTIONS = set()
+
+    def __init__(self, date_str, cert_file='mongodb_cert.pem'):
+        super().__init__(date_str)
+        from pymongo import MongoClient
+        # client = MongoClient('localhost', 27017)
+        if not os.path.exists(cert_file):
+            print(f'Missing mongodb cert file: {cert_file}')
+            exit(1)
+        # The commands are only listened to when profiling, the listener encodes every reply again to size it.
+        listeners = [get_command_listener()] if PROFILER.enabled else []
+        client = MongoClient(self.CONNECTION_URI, tls=True, tlsCertificateKeyFile=cert_file, event_listeners=listeners)
+        self.set_collections(client['ccttc_ratings'])
+        self.create_indexes()
+        return
+
+    def set_collections(self, db):
+        self.collection = db['players']
+        self.matches = db['matches']
+        return
+
+    def get_all_documents(self):
+        return self.collection.find().batch_size(1000)
+
+    def get_documents_updated_since(self, since):
+        return self.collection.find({'updated': {'$gte': since}}).batch_size(1000)
+
+    def get_player_names(self):
+        return self.collection.distinct('name')
+
+    def create_indexes(self):
+        # Called once when the storage is opened, the first time a process opens the collections.
+        from pymongo import IndexModel, ASCENDING, DESCENDING
+        if self.collection.full_name in MongoDB.INDEXED_COLLECTIONS:
+            return
+        self.collection.create_indexes([
+            IndexModel([('name', ASCENDING)]),
+            IndexModel([('current_rating', DESCENDING), ('name', ASCENDING)]),
+            IndexModel([('last_played', DESCENDING)]),
+            IndexModel([('updated', ASCENDING)])
+        ])
+        MongoDB.INDEXED_COLLECTIONS.add(self.collection.full_name)
+        return
+
+    def history_projection(self, last=None):
+        if last is None:
+            return None
+        return {'_id': 0, 'name': 1, 'historical_ratings': {'$slice': -last}}
+
+    @profiled()
+    def get_current_ratings(self):
+        # Only the latest history point of each player is transferred.
+        from pymongo import DESCENDING
+        cursor = self.collection.find({}, self.history_projection(1)).sort('current_rating', DESCENDING)
+        for p in counted(cursor):
+            self.current_ratings[p['name']] = p['historical_ratings'][-1]
+        return self.current_ratings
+
+    @profiled()
+    def get_player_history(self, player_name: str, last=None):
+        player_info = self.collection.find_one({'name': player_name}, self.history_projection(last))
+        if player_info is not None:
+            PROFILER.add(read=1)
+            return player_info['historical_ratings']
+        else:
+            return []
+
+    @profiled()
+    def iter_ratings_history(self, player_list: list, last=None, limit=None, offset=0):
+        from pymongo import ASCENDING, DESCENDING
+        projection = self.history_projection(last) or {'_id': 0, 'name': 1, 'historical_ratings': 1}
+        page = get_player_page(player_list, limit, offset)
+        if page is None:
+            cursor = self.collection.find({}, projection).sort([('current_rating', DESCENDING), ('name', ASCENDING)])
+            cursor = cursor.skip(offset).limit(limit or 0).batch_size(1000)
+            for p in counted(cursor):
+                yield p['name'], p['historical_ratings']
+            return
+        # A single round trip for the whole page of named players, yielded back in the given order.
+        cursor = self.collection.find({'name': {'$in': page}}, projection)
+        found = {p['name']: p['historical_ratings'] for p in counted(cursor)}
+        for name in page:
+            yield name, found.get(name, [])
+        return
+
+    @profiled()
+    def get_active_players(self, date, active_days, min_rating=None):
+        # The last_played index finds the active players. The ranking comes from the names in the rating index,
+        # read without the documents and only down to the lowest rating of an active player.
+        from pymongo import ASCENDING, DESCENDING
+        query = {'last_played': {'$gt': get_active_cutoff(date, active_days)}}
+        if min_rating is not None:
+            query['current_rating'] = {'$gt': min_rating}
+        projection = {'_id': 0, 'name': 1, 'current_rating': 1, 'last_played': 1}
+        players = [[p['name'], p['current_rating'], p['last_played']] for p in counted(self.collection.find(query, projection))]
+        if len(players) == 0:
+            return []
+        cursor = self.collection.find(
+            {'current_rating': {'$gte': min(p[1] for p in players)}}, {'_id': 0, 'name': 1, 'current_rating': 1}
+        ).sort([('current_rating', DESCENDING), ('name', ASCENDING)]).batch_size(1000)
+        return rank_players(players, (p['name'] for p in counted(cursor)))
+
+    @profiled()
+    def get_last_update_date(self):
+        last_update = datetime.strptime('2000-01-01', '%Y-%m-%d').replace(hour=14)
+        result = list(self.collection.aggregate([{'$group': {'_id': None, 'last_played': {'$max': '$last_played'}}}]))
+        if len(result) > 0 and result[0]['last_played'] is not None and result[0]['last_played'] > last_update:
+            last_update = result[0]['last_played']
+        return last_update
+
+    @profiled()
+    def get_data_version(self):
+        # Served from the updated index and the collection metadata, without reading any documents.
+        from pymongo import DESCENDING
+        last = self.collection.find_one({}, {'_id': 0, 'updated': 1}, sort=[('updated', DESCENDING)])
+        return (last or {}).get('updated'), self.collection.estimated_document_count()
+
+    def get_source(self):
+        return f'{type(self).__name__} {self.collection.full_name}'
+
+    @profiled()
+    def get_existing_players(self, player_names, projection=None):
+        if projection is None:
+            projection = {'_id': 0, 'name': 1, 'last_played': 1, 'current_rating': 1}
+        cursor = self.collection.find({'name': {'$in': list(player_names)}}, projection)
+        return {p['name']: p for p in counted(cursor)}
+
+    @profiled(written=lambda result, args: len(args[1]))
+    def insert_documents(self, documents: list):
+        from pymongo import ReplaceOne
+        updated = utc_now()
+        operations = [ReplaceOne({'name': d['name']}, dict(d, updated=updated), upsert=True) for d in documents]
+        if len(operations) > 0:
+            self.collection.bulk_write(operations, ordered=True)
+        return
+
+    @profiled(written=lambda result, args: len(args[1]))
+    def delete_players(self, player_names: list):
+        if len(player_names) > 0:
+            self.collection.delete_many({'name': {'$in': list(player_names)}})
+        return
+
+    @profiled(written=lambda result, args: 1)
+    def save_matches(self, date, league_scores: list, initial_ratings: dict=None):
+        # Player names can not be used as keys, the initial ratings are stored as [name, rating] pairs.
+        from pymongo import ASCENDING
+        self.matches.create_index([('date', ASCENDING)], unique=True)
+        self.matches.replace_one(
+            {'date': date},
+            {
+                'date': date,
+                'scores': league_scores,
+                'initial_ratings': [[k, v] for k, v in (initial_ratings or {}).items()]
+            },
+            upsert=True
+        )
+        return
+
+    @profiled()
+    def get_matches(self, from_date=None):
+        from pymongo import ASCENDING
+        query = {} if from_date is None else {'date': {'$gte': from_date}}
+        matches = []
+        for m in counted(self.matches.find(query, {'_id': 0}).sort('date', ASCENDING)):
+            m['initial_ratings'] = {k: v for k, v in m['initial_ratings']}
+            matches.append(m)
+        return matches
+
+    def delete_matches(self, date):
+        self.matches.delete_one({'date': date})
+        return
+
+    @profiled(written=lambda result, args: len(args[1]) + len(args[2]))
+    def apply_rating_updates(self, inserts: list, updates: list, new_league: bool):
+        # New players are upserted and existing players get the new rating pushed to their history,
+        # all in a single bulk write.
+        from pymongo import UpdateOne
+        updated = utc_now()
+        operations = []
+        for k, r, d, email in inserts:
+            operations.append(UpdateOne(
+                {'name': k},
+                {'$setOnInsert': new_player_document(k, r, d, email), '$set': {'updated': updated}},
+                upsert=True
+            ))
+        for k, r, d in updates:
+            if new_league:
+                operations.append(UpdateOne(
+                    {'name': k, 'last_played': {'$lt': d}},
+                    {
+                        '$inc': {'leagues_played': 1},
+                        '$set': {
+                            'last_played': d,
+                            'current_rating': r,
+                            'updated': updated
+                        },
+                        '$push': {'historical_ratings': [r, d]}
+                    }
+                ))
+            else:
+                operations.append(UpdateOne(
+                    {'name': k},
+                    {
+                        '$set': {'current_rating': r, 'updated': updated},
+                        '$push': {'historical_ratings': [r, d]}
+                    }
+                ))
+        self.collection.bulk_write(operations, ordered=True)
+        return
+
+
+class BucketedMongoDB(MongoDB):
+    # The player documents only keep the current state, the rating history is stored in a separate collection
+    # with one bucket document per player and year. Writes push to the bucket of the year instead of growing
+    # the player document, and the readers put the history back together from the buckets they need.
+
+    def set_collections(self, db):
+        super().set_collections(db)
+        self.collection = db['player_states']
+        self.buckets = db['rating_buckets']
+        return
+
+    def create_indexes(self):
+        from pymongo import IndexModel, ASCENDING
+        if self.buckets.full_name not in MongoDB.INDEXED_COLLECTIONS:
+            self.buckets.create_indexes([IndexModel([('name', ASCENDING), ('year', ASCENDING)], unique=True)])
+            MongoDB.INDEXED_COLLECTIONS.add(self.buckets.full_name)
+        super().create_indexes()
+        return
+
+    def get_state(self, document):
+        # The player document without the history, the date of the latest history point is kept as rating_date.
+        state = {k: v for k, v in document.items() if k not in ('_id', 'historical_ratings')}
+        history = document['historical_ratings']
+        state['rating_date'] = history[-1][1] if len(history) > 0 else document['last_played']
+        return state
+
+    def get_buckets(self, name, history: list):
+        buckets = {}
+        for r, d in history:
+            buckets.setdefault(d.year, []).append([r, d])
+        return [{'name': name, 'year': year, 'points': points} for year, points in buckets.items()]
+
+    def get_histories(self, player_names: list, last=None):
+        # A single query for the buckets of all the players, only the last points of each bucket are
+        # transferred when no more are needed.
+        from pymongo import ASCENDING
+        histories = {name: [] for name in player_names}
+        projection = {'_id': 0, 'name': 1, 'points': 1 if last is None else {'$slice': -last}}
+        cursor = self.buckets.find({'name': {'$in': list(histories)}}, projection)
+        for b in counted(cursor.sort([('name', ASCENDING), ('year', ASCENDING)]).batch_size(1000)):
+            histories[b['name']].extend(b['points'])
+        if last is not None:
+            histories = {name: history[-last:] for name, history in histories.items()}
+        return histories
+
+    def with_histories(self, cursor):
+        # Puts the history back into the player documents, the buckets are read for 1000 players at a time.
+        while True:
+            documents = list(itertools.islice(cursor, 1000))
+            if len(documents) == 0:
+                return
+            histories = self.get_histories([d['name'] for d in documents])
+            for d in documents:
+                d.pop('rating_date', None)
+                d['historical_ratings'] = histories[d['name']]
+                yield d
+
+    def get_all_documents(self):
+        return self.with_histories(self.collection.find().batch_size(1000))
+
+    def get_documents_updated_since(self, since):
+        return self.with_histories(self.collection.find({'updated': {'$gte': since}}).batch_size(1000))
+
+    @profiled()
+    def get_current_ratings(self):
+        # Served from the player documents alone.
+        from pymongo import DESCENDING
+        projection = {'_id': 0, 'name': 1, 'current_rating': 1, 'rating_date': 1}
+        for p in counted(self.collection.find(projection=projection).sort('current_rating', DESCENDING)):
+            self.current_ratings[p['name']] = [p['current_rating'], p['rating_date']]
+        return self.current_ratings
+
+    @profiled()
+    def get_player_history(self, player_name: str, last=None):
+        # The buckets are read newest year first and only until there are enough points.
+        from pymongo import DESCENDING
+        history = []
+        for b in counted(self.buckets.find({'name': player_name}, {'_id': 0, 'points': 1}).sort('year', DESCENDING)):
+            history[:0] = b['points']
+            if last is not None and len(history) >= last:
+                break
+        return history if last is None else history[-last:]
+
+    @profiled()
+    def iter_ratings_history(self, player_list: list, last=None, limit=None, offset=0):
+        from pymongo import ASCENDING, DESCENDING
+        page = get_player_page(player_list, limit, offset)
+        if page is None:
+            cursor = self.collection.find({}, {'_id': 0, 'name': 1})
+            cursor = cursor.sort([('current_rating', DESCENDING), ('name', ASCENDING)]).skip(offset).limit(limit or 0)
+            names = (p['name'] for p in counted(cursor.batch_size(1000)))
+            while True:
+                batch = list(itertools.islice(names, 1000))
+                if len(batch) == 0:
+                    return
+                histories = self.get_histories(batch, last)
+                for name in batch:
+                    yield name, histories[name]
+        histories = self.get_histories(page, last)
+        for name in page:
+            yield name, histories[name]
+        return
+
+    @profiled(written=lambda result, args: len(args[1]))
+    def insert_documents(self, documents: list):
+        # The buckets of the players are replaced as a whole, the same as the history of a replaced document.
+        from pymongo import DeleteMany, InsertOne, ReplaceOne
+        if len(documents) == 0:
+            return
+        updated = utc_now()
+        buckets = [DeleteMany({'name': {'$in': [d['name'] for d in documents]}})]
+        buckets.extend(InsertOne(b) for d in documents for b in self.get_buckets(d['name'], d['historical_ratings']))
+        self.buckets.bulk_write(buckets, ordered=True)
+        states = [ReplaceOne({'name': d['name']}, dict(self.get_state(d), updated=updated), upsert=True) for d in documents]
+        self.collection.bulk_write(states, ordered=True)
+        return
+
+    @profiled(written=lambda result, args: len(args[1]))
+    def delete_players(self, player_names: list):
+        if len(player_names) > 0:
+            self.collection.delete_many({'name': {'$in': list(player_names)}})
+            self.buckets.delete_many({'name': {'$in': list(player_names)}})
+        return
+
+    @profiled(written=lambda result, args: len(args[1]) + len(args[2]))
+    def apply_rating_updates(self, inserts: list, updates: list, new_league: bool):
+        # The history points are pushed before the player documents are updated. An interrupted write leaves
+        # a repeated point at worst, never a player document ahead of its history.
+        from pymongo import UpdateOne
+        updated = utc_now()
+        if new_league:
+            # Players who already played on a later date are skipped, the same as the last_played filter below.
+            # Players inserted earlier in the same batch have no stored document yet and always go through.
+            existing_players = self.get_existing_players([k for k, r, d in updates])
+            updates = [
+                (k, r, d) for k, r, d in updates
+                if k not in existing_players or existing_players[k]['last_played'] < d
+            ]
+        buckets = []
+        states = []
+        for k, r, d, email in inserts:
+            buckets.append(UpdateOne({'name': k, 'year': d.year}, {'$push': {'points': [r, d]}}, upsert=True))
+            states.append(UpdateOne(
+                {'name': k},
+                {'$setOnInsert': self.get_state(new_player_document(k, r, d, email)), '$set': {'updated': updated}},
+                upsert=True
+            ))
+        for k, r, d in updates:
+            buckets.append(UpdateOne({'name': k, 'year': d.year}, {'$push': {'points': [r, d]}}, upsert=True))
+            if new_league:
+                states.append(UpdateOne(
+                    {'name': k, 'last_played': {'$lt': d}},
+                    {
+                        '$inc': {'leagues_played': 1},
+                        '$set': {'last_played': d, 'current_rating': r, 'rating_date': d, 'updated': updated}
+                    }
+                ))
+            else:
+                states.append(UpdateOne({'name': k}, {'$set': {'current_rating': r, 'rating_date': d, 'updated': updated}}))
+        if len(buckets) > 0:
+            self.buckets.bulk_write(buckets, ordered=True)
+            self.collection.bulk_write(states, ordered=True)
+        return
+
+
+def migrate_history(source: RatingsStorage, target: BucketedMongoDB, execute=False):
+    # Copies every player into the bucketed layout, 500 players per bulk write. The source is left as it is.
+    counts = {'players': 0, 'points': 0, 'buckets': 0}
+    documents = []
+    for d in source.get_all_documents():
+        counts['players'] += 1
+        counts['points'] += len(d['historical_ratings'])
+        counts['buckets'] += len(target.get_buckets(d['name'], d['historical_ratings']))
+        documents.append(d)
+        if len(documents) == 500:
+            if execute:
+                target.insert_documents(documents)
+            documents = []
+    if not execute:
+        print(f'Dry run, {counts["players"]} players with {counts["points"]} history points would be written '
+              f'to {counts["buckets"]} buckets.')
+        return counts
+    target.insert_documents(documents)
+    written = target.collection.count_documents({})
+    if written != counts['players']:
+        print(f'Migrated {counts["players"]} players but {written} are in the bucketed layout.')
+        exit(1)
+    print(f'Migrated {counts["players"]} players with {counts["points"]} history points to {counts["buckets"]} buckets.')
+    target.notify_commit()
+    return counts
+
+
+class MemoryStorage(RatingsStorage):
+    # Keeps the player documents in a dict, for testing and benchmarking without a database.
+
+    def __init__(self, date_str, json_file=None):
+        super().__init__(date_str)
+        self.players = {}
+        self.matches = {}
+        if json_file is not None:
+            self.import_json(json_file)
+        return
+
+    def get_all_documents(self):
+        return sorted(self.players.values(), key=lambda p: p['current_rating'], reverse=True)
+
+    def get_existing_players(self, player_names):
+        return {k: self.players[k] for k in player_names if k in self.players}
+
+    def insert_documents(self, documents: list):
+        updated = utc_now()
+        for d in documents:
+            self.players[d['name']] = copy.deepcopy(d)
+            self.players[d['name']]['updated'] = updated
+        return
+
+    def delete_players(self, player_names: list):
+        for k in player_names:
+            self.players.pop(k, None)
+        return
+
+    def save_matches(self, date, league_scores: list, initial_ratings: dict=None):
+        self.matches[date] = {
+            'date': date,
+            'scores': copy.deepcopy(league_scores),
+            'initial_ratings': dict(initial_ratings or {})
+        }
+        return
+
+    def get_matches(self, from_date=None):
+        return [copy.deepcopy(self.matches[d]) for d in sorted(self.matches) if from_date is None or d >= from_date]
+
+    def delete_matches(self, date):
+        self.matches.pop(date, None)
+        return
+
+    def apply_rating_updates(self, inserts: list, updates: list, new_league: bool):
+        updated = utc_now()
+        for k, r, d, email in inserts:
+            self.players[k] = new_player_document(k, r, d, email)
+            self.players[k]['updated'] = updated
+        for k, r, d in updates:
+            player = self.players[k]
+            if new_league:
+                player['leagues_played'] += 1
+                player['last_played'] = d
+            player['current_rating'] = r
+            player['historical_ratings'].append([r, d])
+            player['updated'] = updated
+        return
+
+    def get_current_ratings(self):
+        for p in self.get_all_documents():
+            self.current_ratings[p['name']] = list(p['historical_ratings'][-1])
+        return self.current_ratings
+
+    def get_player_history(self, player_name: str, last=None):
+        if player_name not in self.players:
+            return []
+        history = self.players[player_name]['historical_ratings']
+        return [list(h) for h in (history if last is None else history[-last:])]
+
+    def iter_ratings_history(self, player_list: list, last=None, limit=None, offset=0):
+        page = get_player_page(player_list, limit, offset)
+        if page is None:
+            players = sorted(self.players.values(), key=lambda p: (-p['current_rating'], p['name']))
+            page = get_player_page([p['name'] for p in players], limit, offset)
+        for name in page:
+            yield name, self.get_player_history(name, last)
+        return
+
+    def get_active_players(self, date, active_days, min_rating=None):
+        players = sorted(self.players.values(), key=lambda p: (-p['current_rating'], p['name']))
+        activity = ActivityIndex({p['name']: [p['current_rating'], p['last_played']] for p in players})
+        return activity.active_players(date, active_days, min_rating)
+
+    def get_last_update_date(self):
+        last_update = datetime.strptime('2000-01-01', '%Y-%m-%d').replace(hour=14)
+        for p in self.players.values():
+            last_update = p['last_played'] if p['last_played'] > last_update else last_update
+        return last_update
+
+    def get_data_version(self):
+        updated = [p['updated'] for p in self.players.values() if p.get('updated') is not None]
+        return max(updated, default=None), len(self.players)
+
+
+class SQLiteStorage(RatingsStorage):
+    # Stores the players and their rating history in two indexed tables of a local SQLite file.
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS players (
+            name TEXT PRIMARY KEY,
+            email TEXT,
+            leagues_played INTEGER,
+            last_played TEXT,
+            current_rating REAL,
+            updated TEXT
+        );
+        CREATE TABLE IF NOT EXISTS historical_ratings (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            rating REAL,
+            date TEXT
+        );
+        CREATE TABLE IF NOT EXISTS matches (
+            date TEXT PRIMARY KEY,
+            scores TEXT,
+            initial_ratings TEXT
+        );
+        DROP INDEX IF EXISTS players_current_rating;
+        CREATE INDEX IF NOT EXISTS players_current_rating_name ON players (current_rating DESC, name);
+        CREATE INDEX IF NOT EXISTS players_last_played ON players (last_played);
+        CREATE INDEX IF NOT EXISTS players_updated ON players (updated);
+        CREATE INDEX IF NOT EXISTS historical_ratings_name ON historical_ratings (name, id);
+    '''
+
+    # Fixed width, so dates stored as text sort in date order.
+    DATE_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+    def __init__(self, date_str, db_file='ratings.db', json_file=None):
+        super().__init__(date_str)
+        # The ratings service uses the connection from its event loop thread, one request at a time.
+        self.connection = sqlite3.connect(db_file, check_same_thread=False)
+        # Databases created before the updated column was added get it here, before the index on it is created.
+        columns = [c[1] for c in self.connection.execute('PRAGMA table_info(players)')]
+        if len(columns) > 0 and 'updated' not in columns:
+            self.connection.execute('ALTER TABLE players ADD COLUMN updated TEXT')
+        self.connection.executescript(self.SCHEMA)
+        if json_file is not None:
+            self.import_json(json_file)
+        return
+
+    def to_text(self, date):
+        return date.strftime(self.DATE_FORMAT)
+
+    def to_date(self, text):
+        return datetime.strptime(text, self.DATE_FORMAT)
+
+    def get_all_documents(self, since=None):
+        players = self.connection.execute(
+            'SELECT name, email, leagues_played, last_played, current_rating, updated FROM players '
+            'WHERE updated >= ? OR ? IS NULL ORDER BY current_rating DESC',
+            (None if since is None else self.to_text(since),) * 2
+        )
+        for name, email, leagues_played, last_played, current_rating, updated in players.fetchall():
+            d = {
+                'name': name,
+                'email': email,
+                'leagues_played': leagues_played,
+                'last_played': self.to_date(last_played),
+                'current_rating': current_rating,
+                'historical_ratings': self.get_player_history(name)
+            }
+            if updated is not None:
+                d['updated'] = self.to_date(updated)
+            yield d
+
+    def get_documents_updated_since(self, since):
+        return self.get_all_documents(since)
+
+    def get_player_names(self):
+        return [name for name, in self.connection.execute('SELECT name FROM players').fetchall()]
+
+    @profiled()
+    def get_existing_players(self, player_names):
+        player_names = list(player_names)
+        existing_players = {}
+        # Stay below the SQLite limit of variables per statement.
+        for i in range(0, len(player_names), 500):
+            names = player_names[i:i + 500]
+            rows = self.connection.execute(
+                f'SELECT name, last_played, current_rating FROM players WHERE name IN ({",".join("?" * len(names))})',
+                names
+            )
+            for name, last_played, current_rating in counted(rows):
+                existing_players[name] = {
+                    'name': name,
+                    'last_played': self.to_date(last_played),
+                    'current_rating': current_rating
+                }
+        return existing_players
+
+    @profiled(written=lambda result, args: len(args[1]))
+    def insert_documents(self, documents: list):
+        updated = self.to_text(utc_now())
+        with self.connection:
+            for d in documents:
+                self.connection.execute('DELETE FROM historical_ratings WHERE name = ?', (d['name'],))
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO players (name, email, leagues_played, last_played, current_rating, updated) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (d['name'], d['email'], d['leagues_played'], self.to_text(d['last_played']), d['current_rating'],
+                     updated)
+                )
+                self.connection.executemany(
+                    'INSERT INTO historical_ratings (name, rating, date) VALUES (?, ?, ?)',
+                    [(d['name'], r, self.to_text(h)) for r, h in d['historical_ratings']]
+                )
+        return
+
+    @profiled(written=lambda result, args: len(args[1]))
+    def delete_players(self, player_names: list):
+        with self.connection:
+            self.connection.executemany('DELETE FROM players WHERE name = ?', [(k,) for k in player_names])
+            self.connection.executemany('DELETE FROM historical_ratings WHERE name = ?', [(k,) for k in player_names])
+        return
+
+    @profiled(written=lambda result, args: 1)
+    def save_matches(self, date, league_scores: list, initial_ratings: dict=None):
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO matches VALUES (?, ?, ?)',
+                (self.to_text(date), json.dumps(league_scores), json.dumps(initial_ratings or {}))
+            )
+        return
+
+    @profiled()
+    def get_matches(self, from_date=None):
+        rows = self.connection.execute(
+            'SELECT date, scores, initial_ratings FROM matches WHERE date >= ? ORDER BY date',
+            ('' if from_date is None else self.to_text(from_date),)
+        )
+        return [{'date': self.to_date(date), 'scores': json.loads(scores), 'initial_ratings': json.loads(initial_ratings)}
+                for date, scores, initial_ratings in counted(rows)]
+
+    def delete_matches(self, date):
+        with self.connection:
+            self.connection.execute('DELETE FROM matches WHERE date = ?', (self.to_text(date),))
+        return
+
+    @profiled(written=lambda result, args: len(args[1]) + len(args[2]))
+    def apply_rating_updates(self, inserts: list, updates: list, new_league: bool):
+        updated = self.to_text(utc_now())
+        with self.connection:
+            self.connection.executemany(
+                'INSERT INTO players (name, email, leagues_played, last_played, current_rating, updated) '
+                'VALUES (?, ?, 1, ?, ?, ?)',
+                [(k, email, self.to_text(d), r, updated) for k, r, d, email in inserts]
+            )
+            if new_league:
+                self.connection.executemany(
+                    'UPDATE players SET leagues_played = leagues_played + 1, last_played = ?, current_rating = ?, '
+                    'updated = ? WHERE name = ?',
+                    [(self.to_text(d), r, updated, k) for k, r, d in updates]
+                )
+            else:
+                self.connection.executemany(
+                    'UPDATE players SET current_rating = ?, updated = ? WHERE name = ?',
+                    [(r, updated, k) for k, r, d in updates]
+                )
+            self.connection.executemany(
+                'INSERT INTO historical_ratings (name, rating, date) VALUES (?, ?, ?)',
+                [(k, r, self.to_text(d)) for k, r, d, email in inserts] + [(k, r, self.to_text(d)) for k, r, d in updates]
+            )
+        return
+
+    @profiled()
+    def get_current_ratings(self):
+        rows = self.connection.execute('''
+            SELECT h.name, h.rating, h.date FROM historical_ratings h
+            JOIN (SELECT name, MAX(id) AS id FROM historical_ratings GROUP BY name) l ON h.id = l.id
+            JOIN players p ON p.name = h.name
+            ORDER BY p.current_rating DESC
+        ''')
+        for name, rating, date in counted(rows):
+            self.current_ratings[name] = [rating, self.to_date(date)]
+        return self.current_ratings
+
+    @profiled()
+    def get_player_history(self, player_name: str, last=None):
+        if last is None:
+            rows = self.connection.execute(
+                'SELECT rating, date FROM historical_ratings WHERE name = ? ORDER BY id', (player_name,)
+            ).fetchall()
+        else:
+            rows = self.connection.execute(
+                'SELECT rating, date FROM historical_ratings WHERE name = ? ORDER BY id DESC LIMIT ?', (player_name, last)
+            ).fetchall()[::-1]
+        return [[rating, self.to_date(date)] for rating, date in counted(rows)]
+
+    @profiled()
+    def iter_ratings_history(self, player_list: list, last=None, limit=None, offset=0):
+        page = get_player_page(player_list, limit, offset)
+        if page is None:
+            # The names are read from their own cursor, so rows are yielded while the page is still being read.
+            page = (name for name, in counted(self.connection.execute(
+                'SELECT name FROM players ORDER BY current_rating DESC, name LIMIT ? OFFSET ?',
+                (-1 if limit is None else limit, offset)
+            )))
+        for name in page:
+            yield name, self.get_player_history(name, last)
+        return
+
+    @profiled()
+    def get_active_players(self, date, active_days, min_rating=None):
+        # The players_last_played index finds the active players, the ranking comes from the names in the
+        # players_current_rating_name index, the same as MongoDB.get_active_players.
+        rows = self.connection.execute(
+            'SELECT name, current_rating, last_played FROM players WHERE last_played > ? AND (? IS NULL OR current_rating > ?)',
+            (self.to_text(get_active_cutoff(date, active_days)), min_rating, min_rating)
+        )
+        players = [[name, rating, self.to_date(last_played)] for name, rating, last_played in counted(rows)]
+        if len(players) == 0:
+            return []
+        names = self.connection.execute(
+            'SELECT name FROM players WHERE current_rating >= ? ORDER BY current_rating DESC, name',
+            (min(p[1] for p in players),)
+        )
+        return rank_players(players, (name for name, in counted(names)))
+
+    @profiled()
+    def get_last_update_date(self):
+        last_update = datetime.strptime('2000-01-01', '%Y-%m-%d').replace(hour=14)
+        last_played, = self.connection.execute('SELECT MAX(last_played) FROM players').fetchone()
+        if last_played is not None and self.to_date(last_played) > last_update:
+            last_update = self.to_date(last_played)
+        return last_update
+
+    @profiled()
+    def get_data_version(self):
+        return self.connection.execute('SELECT MAX(updated), COUNT(*) FROM players').fetchone()
+
+    def get_source(self):
+        # The file of the main database, empty for an in-memory database.
+        return f'{type(self).__name__} {self.connection.execute("PRAGMA database_list").fetchone()[2]}'
+
+
+def open_storage(storage, date_str, cert_file, sqlite_file='ratings.db', json_file=None):
+    if storage == 'memory':
+        return MemoryStorage(date_str, json_file)
+    elif storage == 'sqlite':
+        return SQLiteStorage(date_str, sqlite_file, json_file)
+    elif storage == 'mongodb-buckets':
+        return BucketedMongoDB(date_str, cert_file)
+    return MongoDB(date_str, cert_file)
+
+
+LEADERBOARD_INDEX_FILE = 'leaderboard_index'
+
+
+class RatingHistory():
+    # The rating history of all players in two contiguous arrays, the points of player i are
+    # ratings[offsets[i]:offsets[i + 1]] and dates[offsets[i]:offsets[i + 1]].
+
+    def __init__(self, names: list, offsets: np.ndarray, ratings: np.ndarray, dates: np.ndarray):
+        self.names = list(names)
+        self.player_index = {name: i for i, name in enumerate(self.names)}
+        self.offsets = offsets
+        self.ratings = ratings
+        self.dates = dates
+        self.search_keys = None
+        self.search_dates = None
+        self.search_stride = None
+        return
+
+    @classmethod
+    def from_history(cls, ratings_history: dict, sort_by_date=False):
+        return cls.from_iter(ratings_history.items(), sort_by_date)
+
+    @classmethod
+    def from_iter(cls, ratings_history, sort_by_date=False):
+        # Copies (name, history) pairs, such as from iter_ratings_history, into the arrays one player at a time.
+        # The arrays double when they are full, only the points of one player are held as lists at once.
+        names = []
+        offsets = [0]
+        ratings = np.empty(1024, dtype=np.float64)
+        dates = np.empty(1024, dtype='datetime64[us]')
+        count = 0
+        for name, history in ratings_history:
+            if count + len(history) > len(ratings):
+                capacity = max(2 * len(ratings), count + len(history))
+                ratings = np.concatenate((ratings[:count], np.empty(capacity - count, dtype=np.float64)))
+                dates = np.concatenate((dates[:count], np.empty(capacity - count, dtype='datetime64[us]')))
+            ratings[count:count + len(history)] = [h[0] for h in history]
+            dates[count:count + len(history)] = [h[1] for h in history]
+            count += len(history)
+            names.append(name)
+            offsets.append(count)
+        history = cls(names, np.array(offsets, dtype=np.int64), ratings[:count], dates[:count])
+        if sort_by_date:
+            history.sort_by_date()
+        return history
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        mmap_mode = 'r' if mmap else None
+        with open(os.path.join(directory, 'names.json'), 'r') as in_file:
+            names = json.load(in_file)
+        history = cls(names,
+                      np.load(os.path.join(directory, 'offsets.npy'), mmap_mode=mmap_mode),
+                      np.load(os.path.join(directory, 'ratings.npy'), mmap_mode=mmap_mode),
+                      np.load(os.path.join(directory, 'dates.npy'), mmap_mode=mmap_mode))
+        # The search keys are saved with the history when they were built, see build_search_keys.
+        if os.path.exists(os.path.join(directory, 'search.json')):
+            with open(os.path.join(directory, 'search.json'), 'r') as in_file:
+                history.search_stride = json.load(in_file)['stride']
+            history.search_dates = np.load(os.path.join(directory, 'search_dates.npy'), mmap_mode=mmap_mode)
+            history.search_keys = np.load(os.path.join(directory, 'search_keys.npy'), mmap_mode=mmap_mode)
+        return history
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, 'offsets.npy'), np.asarray(self.offsets))
+        np.save(os.path.join(directory, 'ratings.npy'), np.asarray(self.ratings))
+        np.save(os.path.join(directory, 'dates.npy'), np.asarray(self.dates))
+        with open(os.path.join(directory, 'names.json'), 'w') as out_file:
+            json.dump(self.names, out_file)
+        if self.search_keys is not None:
+            np.save(os.path.join(directory, 'search_dates.npy'), np.asarray(self.search_dates))
+            np.save(os.path.join(directory, 'search_keys.npy'), np.asarray(self.search_keys))
+            with open(os.path.join(directory, 'search.json'), 'w') as out_file:
+                json.dump({'stride': self.search_stride}, out_file)
+        elif os.path.exists(os.path.join(directory, 'search.json')):
+            os.remove(os.path.join(directory, 'search.json'))
+        return
+
+    def __len__(self):
+        return len(self.names)
+
+    def get_player(self, name):
+        # Views into the contiguous arrays, nothing is copied.
+        i = self.player_index[name]
+        return self.ratings[self.offsets[i]:self.offsets[i + 1]], self.dates[self.offsets[i]:self.offsets[i + 1]]
+
+    def to_dict(self, player_list: list=None):
+        ratings_history = {}
+        for name in (self.names if player_list is None else player_list):
+            if name not in self.player_index:
+                ratings_history[name] = []
+                continue
+            ratings, dates = self.get_player(name)
+            ratings_history[name] = [[float(r), d] for r, d in zip(ratings, dates.astype(datetime))]
+        return ratings_history
+
+    def player_ids(self):
+        return np.repeat(np.arange(len(self.names)), np.diff(self.offsets))
+
+    def sort_by_date(self):
+        # lexsort is stable, two points on the same date keep their order.
+        order = np.lexsort((self.dates, self.player_ids()))
+        self.ratings = np.asarray(self.ratings)[order]
+        self.dates = np.asarray(self.dates)[order]
+        self.search_keys = None
+        return
+
+    def last_points(self):
+        # Index of the latest point of every player, -1 for players without points.
+        return np.where(np.diff(self.offsets) > 0, self.offsets[1:] - 1, -1)
+
+    def build_search_keys(self):
+        # The dates must be sorted per player. Dates are replaced by their rank among all dates, so that
+        # player * stride + date rank keys sort across all players. The stride leaves room for twice as many
+        # dates, so that append adds the keys of later dates without changing the others.
+        self.search_dates = np.unique(self.dates)
+        self.search_stride = 2 * len(self.search_dates) + 2
+        date_ranks = np.searchsorted(self.search_dates, self.dates)
+        self.search_keys = self.player_ids() * self.search_stride + date_ranks
+        return
+
+    def points_as_of(self, date):
+        # Index of the latest point on or before the date of every player, -1 for players without one.
+        # One binary search per player finds the point.
+        if self.search_keys is None:
+            self.build_search_keys()
+        date_rank = np.searchsorted(self.search_dates, np.datetime64(date, 'us'), side='right')
+        player_keys = np.arange(len(self.names)) * self.search_stride + date_rank
+        points = np.searchsorted(self.search_keys, player_keys, side='left') - 1
+        return np.where(points >= self.offsets[:-1], points, -1)
+
+    def append(self, new_points: dict):
+        # Adds one [rating, date] point per player, new players are added at the end.
+        players = []
+        positions = []
+        ratings = []
+        dates = []
+        new_names = []
+        for name, v in new_points.items():
+            if name in self.player_index:
+                players.append(self.player_index[name])
+                positions.append(self.offsets[self.player_index[name] + 1])
+                ratings.append(float(v[0]))
+                dates.append(v[1])
+            else:
+                new_names.append(name)
+
+        # In player order, a player without points ends where the player before ends.
+        order = np.argsort(players, kind='stable')
+        players = np.array(players, dtype=np.int64)[order]
+        positions = np.array(positions, dtype=np.int64)[order]
+        self.ratings = np.insert(np.asarray(self.ratings), positions, np.array(ratings, dtype=np.float64)[order])
+        dates = np.array(dates, dtype='datetime64[us]')[order]
+        self.dates = np.insert(np.asarray(self.dates), positions, dates)
+        new_dates = np.array([new_points[k][1] for k in new_names], dtype='datetime64[us]')
+        self.extend_search_keys(positions, players, dates, new_dates)
+        # The start of every player moves by the number of points inserted for the players before it.
+        self.offsets = np.asarray(self.offsets) + np.searchsorted(players, np.arange(len(self.offsets)), side='left')
+
+        if len(new_names) > 0:
+            self.offsets = np.concatenate((self.offsets, self.offsets[-1] + np.arange(1, len(new_names) + 1)))
+            self.ratings = np.concatenate((self.ratings, np.array([float(new_points[k][0]) for k in new_names])))
+            self.dates = np.concatenate((self.dates, new_dates))
+            for name in new_names:
+                self.player_index[name] = len(self.names)
+                self.names.append(name)
+        return
+
+    def extend_search_keys(self, positions: np.ndarray, players: np.ndarray, dates: np.ndarray, new_dates: np.ndarray):
+        # Adds the keys of points inserted at the positions for the players, and of one point per new player at
+        # the end. Only dates after all known dates fit in the stride, any other date rebuilds the keys later.
+        if self.search_keys is None:
+            return
+        added_dates = np.setdiff1d(np.concatenate((dates, new_dates)), self.search_dates)
+        if len(added_dates) > 0 and ((len(self.search_dates) > 0 and added_dates[0] <= self.search_dates[-1]) or
+                                     len(self.search_dates) + len(added_dates) >= self.search_stride):
+            self.search_keys = None
+            return
+        self.search_dates = np.concatenate((self.search_dates, added_dates))
+        keys = players * self.search_stride + np.searchsorted(self.search_dates, dates)
+        self.search_keys = np.insert(np.asarray(self.search_keys), positions, keys)
+        new_players = np.arange(len(self.names), len(self.names) + len(new_dates))
+        new_keys = new_players * self.search_stride + np.searchsorted(self.search_dates, new_dates)
+        self.search_keys = np.concatenate((self.search_keys, new_keys))
+        return
+
+
+class LeaderboardIndex():
+    # The rating history sorted by date, to look up the ladder of any date with a binary search per player.
+
+    def __init__(self, history: RatingHistory, version: list=None):
+        self.history = history
+        # The storage and the data version the index was built from, see get_leaderboard_index_version.
+        self.version = version
+        return
+
+    @classmethod
+    def from_history(cls, ratings_history: dict):
+        return cls(RatingHistory.from_history(ratings_history, sort_by_date=True))
+
+    @classmethod
+    def load(cls, index_file):
+        version = None
+        if os.path.exists(os.path.join(index_file, 'version.json')):
+            with open(os.path.join(index_file, 'version.json'), 'r') as in_file:
+                version = json.load(in_file)
+        return cls(RatingHistory.load(index_file), version)
+
+    def save(self, index_file):
+        # The search keys are saved too, so that the first lookup after a load does not build them.
+        if self.history.search_keys is None:
+            self.history.build_search_keys()
+        self.history.save(index_file)
+        with open(os.path.join(index_file, 'version.json'), 'w') as out_file:
+            json.dump(self.version, out_file)
+        return
+
+    def update(self, new_ratings: dict):
+        # Adds the points written by set_new_ratings, which only adds a point for players with a later date.
+        last_points = self.history.last_points()
+        new_points = {}
+        for name, v in new_ratings.items():
+            i = self.history.player_index.get(name)
+            if i is None or last_points[i] < 0 or np.datetime64(v[1], 'us') > self.history.dates[last_points[i]]:
+                new_points[name] = v
+        self.history.append(new_points)
+        return
+
+    def as_of(self, date, active_days, player_list: list=None):
+        # Returns [ranking, name, rating, active] of every player with a rating on the date, highest rating first.
+        # Players are active the same way as in GoogleSheet.set_new_ratings. The ranking is on the whole
+        # leaderboard, a player list only picks the rows.
+        as_of_date = np.datetime64(date, 'us')
+        points = self.history.points_as_of(as_of_date)
+        players = np.flatnonzero(points >= 0)
+        ratings = self.history.ratings[points[players]]
+        # Whole days, the same as timedelta.days.
+        days = (as_of_date - self.history.dates[points[players]]) // np.timedelta64(1, 'D')
+        active = days <= active_days
+        player_list = None if player_list is None else set(player_list)
+
+        leaderboard = []
+        for ranking, i in enumerate(np.argsort(-ratings, kind='stable'), start=1):
+            name = self.history.names[players[i]]
+            if player_list is None or name in player_list:
+                leaderboard.append([ranking, name, float(ratings[i]), bool(active[i])])
+        return leaderboard
+
+
+def get_leaderboard_index_version(storage: RatingsStorage):
+    # Every write changes the data version, including -u corrections, --compact-history and a league night that
+    # is run again. The source keeps an index made from one storage from being used with another.
+    return [storage.get_source(), str(storage.get_data_version())]
+
+
+def get_leaderboard_index(storage: RatingsStorage, index_file=LEADERBOARD_INDEX_FILE):
+    # Loads the saved index, or rebuilds it from the full history when it is missing or out of date.
+    version = get_leaderboard_index_version(storage)
+    if os.path.exists(index_file):
+        index = LeaderboardIndex.load(index_file)
+        if index.version == version:
+            return index
+    history = storage.get_rating_history_arrays(['all'])
+    history.sort_by_date()
+    index = LeaderboardIndex(history, version)
+    index.save(index_file)
+    return index
+
+
+def update_leaderboard_index(storage: RatingsStorage, league_ratings: list, version: list, index_file=LEADERBOARD_INDEX_FILE):
+    # Adds new leagues, one dict of new ratings per league night in date order, to the saved index if the index
+    # was up to date before the leagues were written. version is get_leaderboard_index_version from before the writes.
+    if not os.path.exists(index_file):
+        return
+    index = LeaderboardIndex.load(index_file)
+    if index.version != version:
+        remove_leaderboard_index(index_file)
+        return
+    for new_ratings in league_ratings:
+        index.update(new_ratings)
+    index.version = get_leaderboard_index_version(storage)
+    index.save(index_file)
+    return
+
+
+def remove_leaderboard_index(index_file=LEADERBOARD_INDEX_FILE):
+    if os.path.exists(index_file):
+        shutil.rmtree(index_file)
+    return
+
+
+def get_active_cutoff(date, active_days):
+    # A player is active when (date - last_played).days <= active_days, which is the same as having played
+    # after the returned time. Comparing against it needs neither a date parse nor a timedelta per player.
+    return date - timedelta(days=active_days + 1)
+
+
+def rank_players(players: list, ranked_names):
+    # Puts the ranking in front of [name, rating, last_played] rows, from the names in leaderboard order.
+    # Stops reading the names once every player is ranked.
+    rows = {p[0]: p for p in players}
+    ranked = []
+    for ranking, name in enumerate(ranked_names, start=1):
+        if len(ranked) == len(rows):
+            break
+        if name in rows:
+            ranked.append([ranking] + rows[name])
+    return ranked
+
+
+class ActivityIndex():
+    # The active flags, the days since the last played date and the ranking of a whole roster as arrays.
+    # The ratings dict is ordered by rating, highest first, the same as the Ratings tab.
+
+    def __init__(self, ratings: dict):
+        self.names = list(ratings.keys())
+        self.ratings = np.array([v[0] for v in ratings.values()], dtype=np.float64)
+        self.last_played = np.array([v[1] for v in ratings.values()], dtype='datetime64[us]')
+        self.ranks = np.arange(1, len(self.names) + 1)
+        # Positions of the players by last played date, to find the active players with a binary search.
+        self.by_last_played = np.argsort(self.last_played, kind='stable')
+        self.sorted_last_played = self.last_played[self.by_last_played]
+        return
+
+    def days_since(self, date):
+        # Whole days, the same as timedelta.days.
+        return (np.datetime64(date, 'us') - self.last_played) // np.timedelta64(1, 'D')
+
+    def active(self, date, active_days):
+        return self.days_since(date) <= active_days
+
+    def active_players(self, date, active_days, min_rating=None):
+        # Returns [ranking, name, rating, last_played] of the players active on the date, highest rating first.
+        # Only the players after the cutoff are looked at.
+        cutoff = np.datetime64(get_active_cutoff(date, active_days), 'us')
+        players = self.by_last_played[np.searchsorted(self.sorted_last_played, cutoff, side='right'):]
+        if min_rating is not None:
+            players = players[self.ratings[players] > min_rating]
+        players = np.sort(players)
+        return [
+            [int(self.ranks[i]), self.names[i], float(self.ratings[i]), self.last_played[i].astype(datetime)]
+            for i in players
+        ]
+
+
+class GoogleSheet():
+
+    # If modifying these scopes, delete the file token.json.
+    SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
+
+    # The ID and range of a sample spreadsheet.
+    SPREADSHEET_ID = '1IYGaCxJjT8H2oTvIdm423oCuSsRGHjWGnTW7dD_7kxg'
+
+    RATINGS_HEADERS_RANGE = 'Ratings!C1:C1'
+    RATINGS_RANGE = 'Ratings!A2:D'
+    PLAYERS_RANGE = 'Ratings!B2:D'
+
+    # Every league takes a block of 17 rows on the date tab.
+    LEAGUE_ROWS = 17
+    # A delta sync rewrites the whole Ratings tab instead when more than this share of its rows changed.
+    DELTA_MAX_CHANGED_ROWS = 0.5
+    # Spreadsheet services by credentials file, reused by the later sheets of the process such as the commands
+    # run by the daemon. The credentials refresh their token when it expires.
+    SERVICES = {}
+
+    def __init__(self, date_str, cred_file="google_cred.json", leagues=3, sheet=None, delta_sync=False):
+        self.date_str = date_str
+        self.delta_sync = delta_sync
+        self.ratings_range = []
+        self.score_ranges = []
+        self.player_ranges = []
+        for i in range(leagues):
+            first_row = i * self.LEAGUE_ROWS + 2
+            self.ratings_range.append(f'{date_str}!C{first_row}:E{first_row + 5}')
+            self.score_ranges.append(f'{date_str}!H{first_row}:S{first_row + 14}')
+            self.player_ranges.append(f'{date_str}!B{first_row}:B{first_row + 5}')
+        self.creds = None
+        self.sheet = sheet
+        self.league_data = None
+        self.scores = []
+        self.all_players = []
+        self.players_per_league = {}
+        self.service_key = os.path.abspath(cred_file) if cred_file is not None else None
+
+        # A spreadsheet service passed in by the caller or kept from an earlier sheet is already authorized.
+        if self.sheet is None:
+            self.sheet = self.SERVICES.get(self.service_key)
+        if self.sheet is None:
+            self.authorize(cred_file)
+        return
+
+    @profiled()
+    def authorize(self, cred_file):
+        from google.auth.exceptions import RefreshError
+        from google.auth.transport.requests import Request
+        from google.oauth2.credentials import Credentials
+        from google_auth_oauthlib.flow import InstalledAppFlow
+
+        # The file token.json stores the user's access and refresh tokens, and is
+        # created automatically when the authorization flow completes for the first
+        # time.
+        if os.path.exists('token.json'):
+            self.creds = Credentials.from_authorized_user_file('token.json', self.SCOPES)
+
+        # If there are no (valid) credentials available, let the user log in.
+        if not self.creds or not self.creds.valid:
+            if self.creds and self.creds.expired and self.creds.refresh_token:
+                try:
+                    self.creds.refresh(Request())
+                except RefreshError:
+                    flow = InstalledAppFlow.from_client_secrets_file(cred_file, self.SCOPES)
+                    self.creds = flow.run_local_server(port=0)
+            else:
+                flow = InstalledAppFlow.from_client_secrets_file(cred_file, self.SCOPES)
+                self.creds = flow.run_local_server(port=0)
+            # Save the credentials for the next run
+            with open('token.json', 'w') as token:
+                token.write(self.creds.to_json())
+        return
+
+    @profiled()
+    def get_sheet(self):
+        from googleapiclient.discovery import build
+        from googleapiclient.errors import HttpError
+        try:
+            # The Sheets discovery document bundled with the client is used instead of fetching it.
+            service = build('sheets', 'v4', credentials=self.creds, static_discovery=True, cache_discovery=False)
+            self.sheet = service.spreadsheets()
+            self.SERVICES[self.service_key] = self.sheet
+        except HttpError as err:
+            print(f'Failed to get spreadsheet, error: {err}')
+            exit(1)
+        return self.sheet
+
+    @profiled(transferred=lambda result, args: json_size(result))
+    def batch_get(self, ranges: list, value_render_option='FORMATTED_VALUE'):
+        from googleapiclient.errors import HttpError
+        if self.sheet is None:
+            self.get_sheet()
+
+        try:
+            return self.sheet.values().batchGet(spreadsheetId=self.SPREADSHEET_ID, ranges=ranges,
+                                                valueRenderOption=value_render_option).execute()
+        except HttpError as err:
+            print(f'Failed to get {", ".join(ranges)}, error: {err}')
+            exit(1)
+
+    def get_league_data(self):
+        # Scores and players of every league are fetched in a single batchGet call.
+        if self.league_data is not None:
+            return self.league_data
+
+        result = self.batch_get(self.score_ranges + self.player_ranges)
+        value_ranges = [r.get('values', []) for r in result.get('valueRanges', [])]
+        self.league_data = {
+            'scores': value_ranges[:len(self.score_ranges)],
+            'players': value_ranges[len(self.score_ranges):]
+        }
+        return self.league_data
+
+    @profiled()
+    def get_date_tabs(self):
+        # Titles of the dated tabs, such as 2022-10-16, in chronological order.
+        from googleapiclient.errors import HttpError
+        if self.sheet is None:
+            self.get_sheet()
+
+        try:
+            result = self.sheet.get(spreadsheetId=self.SPREADSHEET_ID, fields='sheets.properties.title').execute()
+        except HttpError as err:
+            print(f'Failed to get spreadsheet tabs, error: {err}')
+            exit(1)
+
+        dates = []
+        for tab in result.get('sheets', []):
+            title = tab['properties']['title']
+            try:
+                datetime.strptime(title, '%Y-%m-%d')
+            except ValueError:
+                continue
+            dates.append(title)
+        return sorted(dates)
+
+    def get_scores(self):
+        league_data = self.get_league_data()
+
+        self.scores = []
+        for scores in league_data['scores']:
+            for row in scores:
+                row[:2] = map(str.strip, row[:2])
+                row[2:] = map(int, row[2:])
+            self.scores.extend(scores)
+        return self.scores
+
+    @profiled(transferred=lambda result, args: json_size(result))
+    def get_all_ratings(self):
+        from googleapiclient.errors import HttpError
+        if self.sheet is None:
+            self.get_sheet()
+
+        try:
+            values = self.sheet.values().get(spreadsheetId=self.SPREADSHEET_ID, range=self.PLAYERS_RANGE).execute()
+            ratings = values.get('values', [])
+
+            player_ratings = {}
+            for player in ratings:
+                player_ratings[player[0]] = [float(player[1]), player[2]]
+            return player_ratings
+        except HttpError as err:
+            print(f'Failed to get current ratings, error: {err}')
+            exit(1)
+
+    def get_date(self):
+        return datetime.strptime(self.date_str, '%Y-%m-%d').replace(hour=14)
+
+    def get_league_players(self):
+        league_data = self.get_league_data()
+
+        self.all_players = []
+        for i in range(len(self.player_ranges)):
+            league = i + 1
+            self.players_per_league[league] = []
+            for v in league_data['players'][i]:
+                self.players_per_league[league].extend(v)
+            self.players_per_league[league] = list(map(str.strip, self.players_per_league[league]))
+            self.all_players.extend(self.players_per_league[league])
+        return self.all_players
+
+    def get_league_ratings_data(self, new_ratings: dict, rating_increased: dict, rating_decreased: dict):
+        # The old rating, the change and the new rating of every league player, for the ranges on the date tab.
+        league_player_ratings = {}
+        league_players = set(self.all_players)
+        for k, v in new_ratings.items():
+            if k in league_players:
+                try:
+                    rating_diff = f'+{rating_increased[k]}'
+                except KeyError:
+                    try:
+                        rating_diff = f'{rating_decreased[k]}'
+                    except KeyError:
+                        rating_diff = '0'
+                league_player_ratings[k] = [v[0] - float(rating_diff), rating_diff, v[0]]
+
+        data = []
+        for l in self.players_per_league:
+            values = []
+            for p in self.players_per_league[l]:
+                if p == '':
+                    values.append(['', '', ''])
+                else:
+                    values.append(league_player_ratings[p])
+            data.append({'range': self.ratings_range[l - 1], 'values': values})
+        return data
+
+    def get_ratings_writes(self, new_ratings: dict, rating_increased: dict, rating_decreased: dict, active_days,
+                           league_data: list=None):
+        # Returns the ranges to clear and the ranges to write for the new ratings, without sending them.
+        # league_data holds ranges of other date tabs to write in the same call.
+        activity = ActivityIndex(new_ratings)
+        active = activity.active(self.get_date(), active_days).tolist()
+        all_player_ratings = [
+            [ranking, k, v[0], a] for ranking, (k, v), a in zip(activity.ranks.tolist(), new_ratings.items(), active)
+        ]
+
+        data = (league_data or []) + self.get_league_ratings_data(new_ratings, rating_increased, rating_decreased)
+        data.append({'range': self.RATINGS_HEADERS_RANGE, 'values': [[f'{self.date_str}']]})
+        data.append({'range': self.RATINGS_RANGE, 'values': all_player_ratings})
+        return [self.RATINGS_HEADERS_RANGE, self.RATINGS_RANGE], data
+
+    def get_ratings_delta(self, clear_ranges: list, data: list):
+        # Reads the Ratings tab once and only writes the blocks of rows that differ from it. When the ranking
+        # shifted for too many players the full rewrite is kept.
+        ratings = [d for d in data if d['range'] == self.RATINGS_RANGE]
+        if len(ratings) == 0:
+            return clear_ranges, data
+        rows = ratings[0]['values']
+        result = self.batch_get([self.RATINGS_RANGE], 'UNFORMATTED_VALUE')
+        current_rows = result.get('valueRanges', [{}])[0].get('values', [])
+
+        changed = [i for i, row in enumerate(rows) if i >= len(current_rows) or current_rows[i] != row]
+        if len(changed) > self.DELTA_MAX_CHANGED_ROWS * len(rows):
+            print(f'{len(changed)} of {len(rows)} rows changed on the Ratings tab, rewriting all of them.')
+            return clear_ranges, data
+
+        delta = [d for d in data if d['range'] != self.RATINGS_RANGE]
+        first = 0
+        for j in range(len(changed)):
+            if j + 1 == len(changed) or changed[j + 1] != changed[j] + 1:
+                start, end = changed[first], changed[j]
+                delta.append({'range': f'Ratings!A{start + 2}:D{end + 2}', 'values': rows[start:end + 1]})
+                first = j + 1
+        # The header is overwritten, only the rows of players who are no longer listed are cleared.
+        delta_clear = [r for r in clear_ranges if r not in (self.RATINGS_HEADERS_RANGE, self.RATINGS_RANGE)]
+        if len(current_rows) > len(rows):
+            delta_clear.append(f'Ratings!A{len(rows) + 2}:D')
+        print(f'{len(changed)} of {len(rows)} rows changed on the Ratings tab.')
+        return delta_clear, delta
+
+    def write_ratings(self, clear_ranges: list, data: list):
+        for d in data:
+            if d['range'] == self.RATINGS_RANGE:
+                for ranking, k, rating, active_player in d['values']:
+                    print(f'{k}     active:{active_player}')
+        if self.delta_sync:
+            clear_ranges, data = self.get_ratings_delta(clear_ranges, data)
+        self.batch_write(clear_ranges, data)
+        return
+
+    @profiled(transferred=lambda result, args: json_size(args[2]))
+    def batch_write(self, clear_ranges: list, data: list):
+        from googleapiclient.errors import HttpError
+        if self.sheet is None:
+            self.get_sheet()
+
+        try:
+            # One call to clear the Ratings tab and one call to write every range.
+            if len(clear_ranges) > 0:
+                self.sheet.values().batchClear(spreadsheetId=self.SPREADSHEET_ID, body={'ranges': clear_ranges}).execute()
+            self.sheet.values().batchUpdate(spreadsheetId=self.SPREADSHEET_ID, body={'valueInputOption': 'RAW', 'data': data}).execute()
+        except HttpError as err:
+            print(f'Failed to update ratings, error: {err}')
+            exit(1)
+        return
+
+    def set_new_ratings(self, new_ratings: dict, rating_increased: dict, rating_decreased: dict, active_days,
+                        league_data: list=None):
+        clear_ranges, data = self.get_ratings_writes(new_ratings, rating_increased, rating_decreased, active_days, league_data)
+        self.write_ratings(clear_ranges, data)
+        return
+
+    def print_active_status(self, new_ratings: dict, rating_increased: dict, rating_decreased: dict, active_days):
+        activity = ActivityIndex(new_ratings)
+        for k, active_player in zip(activity.names, activity.active(self.get_date(), active_days).tolist()):
+            print(f'{k}     active:{active_player}')
+        return
+
+
+def get_score_differentials(row):
+    score_diffs_p1vp2 = []
+    score_diffs_p2vp1 = []
+    for game in range(5): # the match is best of 5
+        idx = game * 2 + 2
+        try:
+            score1 = row[idx]
+            score2 = row[idx + 1]
+            if (not np.isnan(score1)) and (not np.isnan(score2)):
+                score_diffs_p1vp2.append(score1 - score2)
+                score_diffs_p2vp1.append(score2 - score1)
+        except IndexError:
+            break
+    return score_diffs_p1vp2, score_diffs_p2vp1
+
+
+def scores_to_columns(league_scores, player_index: dict):
+    # Converts the score rows from the spreadsheet into a (matches, 12) array: the indices of both players
+    # followed by the ten game scores, with NaN for games that were not played.
+    score_columns = []
+    for row in league_scores:
+        if len(row) < 2:
+            continue
+        p1_name = row[0]
+        p2_name = row[1]
+        if p1_name == '' or p2_name == '':
+            continue
+        columns = [player_index[p1_name], player_index[p2_name]] + [np.nan] * 10
+        columns[2:len(row)] = row[2:12]
+        score_columns.append(columns)
+    return np.array(score_columns, dtype=np.float64).reshape(-1, 12)
+
+
+def calculate_rating_deltas(ratings: np.ndarray, score_columns: np.ndarray, e: ELO=None):
+    p1 = score_columns[:, 0].astype(np.intp)
+    p2 = score_columns[:, 1].astype(np.intp)
+    score_diffs = score_columns[:, 2:12:2] - score_columns[:, 3:12:2]
+    played = ~np.isnan(score_diffs)
+    has_games = played.any(axis=1)
+
+    # A tied game counts as won by both players, the same as in ELO.update_rating.
+    p1_game_score_diffs = (played & (score_diffs >= 0)).sum(axis=1) - (played & (score_diffs < 0)).sum(axis=1)
+    p2_game_score_diffs = (played & (score_diffs <= 0)).sum(axis=1) - (played & (score_diffs > 0)).sum(axis=1)
+
+    p1_ratings = ratings[p1]
+    p2_ratings = ratings[p2]
+    if e is None:
+        e = ELO()
+    p1_changes = e.rating_changes(p1_ratings - p2_ratings, p1_game_score_diffs)
+    p2_changes = e.rating_changes(p2_ratings - p1_ratings, p2_game_score_diffs)
+
+    # Keep the (new rating - old rating) rounding of the per match calculation.
+    p1_deltas = (p1_ratings + p1_changes) - p1_ratings
+    p2_deltas = (p2_ratings + p2_changes) - p2_ratings
+    return p1_deltas, p2_deltas, has_games
+
+
+def calculate_new_ratings_columnar(ratings: np.ndarray, score_columns: np.ndarray, e: ELO=None):
+    # Returns the new ratings of all players and a mask of the players that played at least one match.
+    p1_deltas, p2_deltas, has_games = calculate_rating_deltas(ratings, score_columns, e)
+    players = score_columns[has_games, :2].astype(np.intp).ravel()
+    deltas = np.column_stack((p1_deltas[has_games], p2_deltas[has_games])).ravel()
+
+    # bincount adds the deltas in match order, so the sums are identical to adding them one by one.
+    total_deltas = np.bincount(players, weights=deltas, minlength=len(ratings))
+    played = np.bincount(players, minlength=len(ratings)) > 0
+    new_ratings = ratings.copy()
+    new_ratings[played] += total_deltas[played]
+    return new_ratings, played
+
+
+@profiled(compute=True)
+def calculate_new_ratings(current_ratings, league_scores, date_str, print_out):
+    player_names = list(current_ratings)
+    player_index = {name: i for i, name in enumerate(player_names)}
+    ratings = np.array([current_ratings[p][0] for p in player_names], dtype=np.float64)
+    score_columns = scores_to_columns(league_scores, player_index)
+
+    if print_out:
+        p1_deltas, p2_deltas, has_games = calculate_rating_deltas(ratings, score_columns)
+        match = 0
+        for row in league_scores:
+            if len(row) < 2 or row[0] == '' or row[1] == '':
+                continue
+            if has_games[match]:
+                score_diffs_p1vp2, score_diffs_p2vp1 = get_score_differentials(row)
+                p1_rating = current_ratings[row[0]][0]
+                p2_rating = current_ratings[row[1]][0]
+                print_match_result(row[0], p1_rating, row[1], p2_rating, score_diffs_p1vp2, p1_deltas[match])
+                print_match_result(row[1], p2_rating, row[0], p1_rating, score_diffs_p2vp1, p2_deltas[match])
+                print()
+            match += 1
+
+    new_rating_values, played = calculate_new_ratings_columnar(ratings, score_columns)
+
+    league_date = None
+    if date_str == '':
+        print('No date provided, retaining existing dates')
+    else:
+        league_date = datetime.strptime(date_str, '%Y-%m-%d').replace(hour=14)
+
+    # A stable sort keeps players with the same rating in their current order.
+    new_ratings = {}
+    for i in np.argsort(-new_rating_values, kind='stable'):
+        player = player_names[i]
+        if played[i]:
+            last_played = league_date if league_date is not None else current_ratings[player][1]
+            new_ratings[player] = [float(new_rating_values[i]), last_played]
+        else:
+            new_ratings[player] = list(current_ratings[player])
+
+    return new_ratings
+
+
+def get_rating_diffs(current_ratings, new_ratings):
+    rating_increased = {}
+    rating_decreased = {}
+
+    for key in new_ratings:
+        rating_diff = round(new_ratings[key][0] - current_ratings[key][0], 2)
+        if key in current_ratings and (rating_diff > 0):
+            rating_increased[key] = rating_diff
+        elif key in current_ratings and (rating_diff < 0):
+            rating_decreased[key] = rating_diff
+
+    return rating_increased, rating_decreased
+
+
+# Bumped when the layout of the plan files changes.
+PLAN_VERSION = 1
+
+
+def make_plan(data_version, inserts: list, updates: list, matches: list, sheet_date, sheet_writes):
+    # Everything a new league writes to the database and the spreadsheet, so that a reviewed dry run can be
+    # applied without fetching and calculating again. data_version is the storage version the plan is based on.
+    clear_ranges, data = sheet_writes
+    return {
+        'version': PLAN_VERSION,
+        'created': utc_now(),
+        'data_version': str(data_version),
+        'inserts': [list(i) for i in inserts],
+        'updates': [list(u) for u in updates],
+        'matches': matches,
+        'sheet': {'date': sheet_date, 'clear': clear_ranges, 'data': data}
+    }
+
+
+def save_plan(plan_file, plan: dict):
+    # The first line is the checksum of the extended JSON plan on the second line.
+    from bson.json_util import dumps
+    body = dumps(plan)
+    with open_backup_file(plan_file, 'w') as out_file:
+        out_file.write(f'sha256:{hashlib.sha256(body.encode()).hexdigest()}\n{body}\n')
+    print(f'Plan saved to {plan_file}, apply it with "--apply {plan_file} -e".')
+    return
+
+
+def load_plan(plan_file):
+    from bson.json_util import loads
+    if not os.path.exists(plan_file):
+        print(f'Missing plan file: {plan_file}')
+        exit(1)
+    with open_backup_file(plan_file, 'r') as in_file:
+        checksum = in_file.readline().strip()
+        body = in_file.read().strip()
+    if checksum != f'sha256:{hashlib.sha256(body.encode()).hexdigest()}':
+        print(f'The checksum of {plan_file} does not match, the plan file is damaged.')
+        exit(1)
+    plan = loads(body)
+    if plan['version'] != PLAN_VERSION:
+        print(f'{plan_file} was made by another version of this script, run the dry run again.')
+        exit(1)
+    return plan
+
+
+def check_plan(plan: dict, storage: RatingsStorage):
+    if str(storage.get_data_version()) != plan['data_version']:
+        print('The database has changed since the plan was made, run the dry run again.')
+        return False
+    return True
+
+
+def apply_plan(plan: dict, storage: RatingsStorage, google_sheet: GoogleSheet):
+    if not check_plan(plan, storage):
+        return False
+    index_version = get_leaderboard_index_version(storage)
+    storage.backup()
+    storage.write_rating_updates(plan['inserts'], plan['updates'], True)
+
+    # The leaderboard index gets the new points one league night at a time.
+    league_ratings = {}
+    for k, r, d, *_ in plan['inserts'] + plan['updates']:
+        league_ratings.setdefault(d, {})[k] = [r, d]
+    update_leaderboard_index(storage, [league_ratings[d] for d in sorted(league_ratings)], index_version)
+
+    for m in plan['matches']:
+        storage.save_matches(m['date'], m['scores'], m['initial_ratings'])
+    google_sheet.write_ratings(plan['sheet']['clear'], plan['sheet']['data'])
+    return True
+
+
+def apply_new_league_plan(plan_file, google_cred, execute, storage: RatingsStorage, delta_sync=False):
+    plan = load_plan(plan_file)
+    dates = ', '.join(m['date'].strftime('%Y-%m-%d') for m in plan['matches'])
+    print(f'Plan for {dates}, made on {plan["created"].strftime("%Y-%m-%d %H:%M")} UTC.')
+    if not check_plan(plan, storage):
+        exit(1)
+
+    if execute:
+        print('Connecting to google sheets...')
+        google_sheet = GoogleSheet(plan['sheet']['date'], google_cred, delta_sync=delta_sync)
+        print('Updating database and spreadsheet...')
+        apply_plan(plan, storage, google_sheet)
+        print('All done!')
+    else:
+        print('No execute flag detected, database and spreadsheet will not be updated.')
+        storage.write_rating_updates(plan['inserts'], plan['updates'], True, dry_run=True)
+    return
+
+
+def print_league_players(google_sheet: GoogleSheet, current_ratings: dict):
+    # Lists the players of every league and returns the average rating of each league.
+    league_avg_ratings = {}
+    for i in range(len(google_sheet.players_per_league)):
+        league = i + 1
+        if len(google_sheet.players_per_league[league]) == 0:
+            break
+
+        print(f'League {league}:')
+        total_ratings = 0.0
+        player_count = 0
+        for p in google_sheet.players_per_league[league]:
+            try:
+                total_ratings += current_ratings[p][0]
+                player_count += 1
+            except KeyError:
+                pass
+            print(f'  {p}')
+        if player_count > 0:
+            league_avg_ratings[league] = total_ratings / player_count
+        else:
+            league_avg_ratings[league] = 0
+        print()
+    return league_avg_ratings
+
+
+def confirm(question, assume_yes=False):
+    print(f'{question} [y/N] ', end='')
+    if assume_yes:
+        print('y')
+        return True
+    try:
+        return input().strip().lower() == 'y'
+    except KeyboardInterrupt:
+        return False
+
+
+def ask_new_players(google_sheet: GoogleSheet, missing_players: set, league_avg_ratings: dict, current_ratings: dict):
+    # Adds the initial ratings of the new players to current_ratings and returns their emails, or None if the
+    # user gave up.
+    new_emails = {}
+    for p in missing_players:
+        if p != '':
+            while True:
+                for i in range(len(google_sheet.players_per_league)):
+                    league = i + 1
+                    if p in google_sheet.players_per_league[league]:
+                        print(f'Missing rating for "{p}", average ratings for league {league} is {round(league_avg_ratings[league], 2)}. Please enter initial rating: ', end='')
                         break
                 try:
-                    current_ratings[p] = [float(input()), datetime.strptime(date_str, '%Y-%m-%d').replace(hour=14)]
+                    current_ratings[p] = [float(input()), datetime.strptime(google_sheet.date_str, '%Y-%m-%d').replace(hour=14)]
                     break
                 except ValueError:
                     print('Rating must be a number, please try again.')
                     continue
                 except KeyboardInterrupt:
+                    return None
+
+            while True:
+                print(f'Please enter an email address for "{p}": ', end='')
+                player_email = input()
+                try:
+                    new_emails[p] = player_email.strip().lower()
+                    break
+                except KeyboardInterrupt:
+                    return None
+    return new_emails
+
+
+# How new players missing from the manifest get their initial rating in unattended runs.
+NEW_PLAYER_POLICIES = ['league-average', 'manifest-only']
+
+
+def load_new_player_manifest(manifest_file):
+    # A CSV file with name, rating and email columns, or a YAML file that maps the names to a rating or to a
+    # mapping with rating and email. The rating and the email are both optional.
+    if not os.path.exists(manifest_file):
+        print(f'Missing new player manifest: {manifest_file}')
+        exit(1)
+    if manifest_file.endswith('.csv'):
+        import csv
+        with open(manifest_file, 'r', newline='') as in_file:
+            entries = [(row.get('name'), row) for row in csv.DictReader(in_file)]
+    else:
+        try:
+            import yaml
+        except ImportError:
+            print('YAML manifests need the PyYAML package, install it with "pip install -r requirements.txt".')
+            exit(1)
+        with open(manifest_file, 'r') as in_file:
+            try:
+                content = yaml.safe_load(in_file)
+            except yaml.YAMLError as e:
+                report_problems('load_new_player_manifest', None, [
+                    {'type': 'invalid_manifest', 'player': None, 'message': f'{manifest_file} is not valid YAML: {e}'}
+                ])
+        if content is None:
+            content = {}
+        if not isinstance(content, dict):
+            report_problems('load_new_player_manifest', None, [{
+                'type': 'invalid_manifest',
+                'player': None,
+                'message': f'{manifest_file} must map the player names to their entries, not be a {type(content).__name__}.'
+            }])
+        entries = list(content.items())
+
+    manifest = {}
+    problems = []
+    for name, entry in entries:
+        if not isinstance(entry, dict):
+            entry = {'rating': entry}
+        if name is None or str(name).strip() == '':
+            problems.append({'type': 'invalid_manifest', 'player': None, 'message': 'Entry without a name.'})
+            continue
+        name = str(name).strip()
+        rating = entry.get('rating')
+        try:
+            rating = None if rating is None or str(rating).strip() == '' else float(rating)
+        except ValueError:
+            problems.append({'type': 'invalid_manifest', 'player': name, 'message': f'Rating "{rating}" is not a number.'})
+            continue
+        manifest[name] = {'rating': rating, 'email': str(entry.get('email') or '').strip().lower()}
+    if len(problems) > 0:
+        report_problems('load_new_player_manifest', None, problems)
+    return manifest
+
+
+def get_new_players(google_sheet: GoogleSheet, missing_players: set, league_avg_ratings: dict, current_ratings: dict,
+                    manifest: dict, policy='league-average'):
+    # The unattended counterpart of ask_new_players, returns the emails and a list of problems.
+    new_emails = {}
+    problems = []
+    for p in sorted(missing_players):
+        if p == '':
+            continue
+        entry = manifest.get(p, {})
+        rating = entry.get('rating')
+        if rating is None and policy == 'league-average':
+            for league, players in google_sheet.players_per_league.items():
+                if p in players and league_avg_ratings.get(league, 0) > 0:
+                    rating = round(league_avg_ratings[league], 2)
+                    break
+        if rating is None:
+            problems.append({'type': 'missing_rating', 'player': p,
+                             'message': f'No initial rating for "{p}" in the manifest.'})
+            continue
+        print(f'New player "{p}" starts at {rating}.')
+        current_ratings[p] = [float(rating), datetime.strptime(google_sheet.date_str, '%Y-%m-%d').replace(hour=14)]
+        new_emails[p] = entry.get('email', '')
+    return new_emails, problems
+
+
+def report_problems(command, date_str, problems: list):
+    # Unattended runs end with a JSON report that schedulers can parse, and exit with 1.
+    print(json.dumps({'command': command, 'date': date_str, 'status': 'failed', 'problems': problems}, indent=2))
+    exit(1)
+
+
+def print_league_changes(google_sheet: GoogleSheet, current_ratings: dict, new_ratings: dict):
+    for i in range(len(google_sheet.players_per_league)):
+        league = i + 1
+        if len(google_sheet.players_per_league[league]) == 0:
+            break
+
+        print(f'League {league}:')
+        for p in google_sheet.players_per_league[league]:
+            if p != '':
+                print(f'  {p: >20}: {round(current_ratings[p][0], 2): >7.02f}   =>   {round(new_ratings[p][0] - current_ratings[p][0], 2): >+7.02f}   =>   {round(new_ratings[p][0], 2): >7.02f}')
+        print()
+    return
+
+
+def new_league(date_str, cert_file, google_cred, active_days, execute, print_out, leagues=3, storage=None,
+               plan_file=None, assume_yes=False, new_players: dict=None, new_player_policy='league-average',
+               delta_sync=False):
+    # With assume_yes nothing is asked, the new players come from the new_players manifest or the policy.
+    print('Connecting to google sheets...')
+    google_sheet = GoogleSheet(date_str, google_cred, leagues, delta_sync=delta_sync)
+
+    if storage is None:
+        print('Connecting to MongoDB...')
+        storage = MongoDB(date_str, cert_file)
+
+    league_scores = google_sheet.get_scores()
+    if not league_scores:
+        print(f'No scores found for {date_str}.')
+        if assume_yes:
+            report_problems('new_league', date_str, [{'type': 'no_scores', 'player': None, 'message': f'No scores found for {date_str}.'}])
+        return
+    league_players = google_sheet.get_league_players()
+
+    last_update = storage.get_last_update_date()
+    if last_update >= datetime.strptime(date_str, '%Y-%m-%d').replace(hour=14):
+        print(f'Leagues on "{date_str}" has already been processed before.')
+        if assume_yes:
+            report_problems('new_league', date_str, [{'type': 'already_processed', 'player': None,
+                                                      'message': f'Leagues on "{date_str}" has already been processed before.'}])
+        return
+    data_version = storage.get_data_version()
+    current_ratings = storage.get_current_ratings()
+    missing_players = league_players - current_ratings.keys()
+
+    print()
+    league_avg_ratings = print_league_players(google_sheet, current_ratings)
+    if not confirm('Please make sure the players listed above are correct for each league.', assume_yes):
+        print('\nPlease check the date of the league matches, then try running the script again.')
+        return
+
+    if assume_yes or new_players is not None:
+        new_emails, problems = get_new_players(google_sheet, missing_players, league_avg_ratings, current_ratings,
+                                               new_players or {}, new_player_policy)
+        if len(problems) > 0:
+            report_problems('new_league', date_str, problems)
+    else:
+        new_emails = ask_new_players(google_sheet, missing_players, league_avg_ratings, current_ratings)
+        if new_emails is None:
+            return
+
+    print('Calculating new ratings...')
+    new_ratings = calculate_new_ratings(current_ratings, league_scores, date_str, print_out)
+    rating_increased, rating_decreased = get_rating_diffs(current_ratings, new_ratings)
+
+    if print_out:
+        print_league_changes(google_sheet, current_ratings, new_ratings)
+
+    inserts, updates = storage.get_rating_updates(new_ratings, new_emails, True)
+    matches = [{
+        'date': datetime.strptime(date_str, '%Y-%m-%d').replace(hour=14),
+        'scores': league_scores,
+        'initial_ratings': {p: current_ratings[p][0] for p in missing_players if p != ''}
+    }]
+    plan = make_plan(data_version, inserts, updates, matches, date_str,
+                     google_sheet.get_ratings_writes(new_ratings, rating_increased, rating_decreased, active_days))
+
+    # Just in case things go wrong, we backup the database locally.
+    # The backup file can be used to import to mongodb using command "mongoimport".
+    if execute:
+        if not confirm('Update database and spreadsheet?', assume_yes):
+            print('Database and spreadsheet NOT updated...')
+            return
+        print('Updating database and spreadsheet...')
+        apply_plan(plan, storage, google_sheet)
+        print('All done!')
+    else:
+        print('No execute flag detected, database and spreadsheet will not be updated.')
+        storage.write_rating_updates(inserts, updates, True, dry_run=True)
+        save_plan(plan_file if plan_file is not None else f'ratings_plan_{date_str}.json.gz', plan)
+
+    return
+
+
+def new_leagues(from_date_str, to_date_str, cert_file, google_cred, active_days, execute, print_out, leagues=3,
+                storage=None, plan_file=None, assume_yes=False, new_players: dict=None,
+                new_player_policy='league-average', delta_sync=False):
+    # Processes every dated tab from from_date_str to to_date_str in chronological order. The ratings are carried
+    # from one night to the next in memory, and every night is written at the end with a single backup.
+    from concurrent.futures import ThreadPoolExecutor
+    print('Connecting to google sheets...')
+    google_sheet = GoogleSheet(to_date_str, google_cred, leagues)
+
+    if storage is None:
+        print('Connecting to MongoDB...')
+        storage = MongoDB(from_date_str, cert_file)
+
+    last_update = storage.get_last_update_date()
+    dates = []
+    for date_str in google_sheet.get_date_tabs():
+        if date_str < from_date_str or date_str > to_date_str:
+            continue
+        if last_update >= datetime.strptime(date_str, '%Y-%m-%d').replace(hour=14):
+            print(f'Leagues on "{date_str}" has already been processed before.')
+            continue
+        dates.append(date_str)
+    if len(dates) == 0:
+        print(f'No new league nights found from {from_date_str} to {to_date_str}.')
+        return
+    print(f'Processing {len(dates)} league nights: {", ".join(dates)}')
+
+    data_version = storage.get_data_version()
+    current_ratings = storage.get_current_ratings()
+    stored_players = set(current_ratings)
+    sheets = [GoogleSheet(date_str, google_cred, leagues, google_sheet.sheet, delta_sync) for date_str in dates]
+    nights = []
+    inserts = []
+    updates = []
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # The scores of the next night are fetched while the current one is checked and calculated. Only the
+        # prefetch thread talks to the spreadsheet during the loop, the service is not thread safe.
+        prefetch = executor.submit(sheets[0].get_league_data)
+        for i, sheet in enumerate(sheets):
+            prefetch.result()
+            if i + 1 < len(sheets):
+                prefetch = executor.submit(sheets[i + 1].get_league_data)
+
+            # Once a later night is written, a night without scores counts as processed and is never picked up
+            # again. An unattended run stops before anything is written, an interactive run ends the range at
+            # the night before, and the night without scores is picked up by the next run.
+            league_scores = sheet.get_scores()
+            if not league_scores and assume_yes:
+                report_problems('new_leagues', sheet.date_str, [{'type': 'no_scores', 'player': None,
+                                                                 'message': f'No scores found for {sheet.date_str}.'}])
+            if not league_scores:
+                print(f'\nNo scores found for {sheet.date_str}, the later league nights are not processed.')
+                if len(nights) > 0:
+                    print(f'The league nights up to {nights[-1]["sheet"].date_str} are processed, run the script '
+                          f'again from {sheet.date_str} once its scores are entered.')
+                prefetch.cancel()
+                break
+            league_players = sheet.get_league_players()
+            missing_players = league_players - current_ratings.keys()
+
+            print(f'\n{sheet.date_str}:')
+            league_avg_ratings = print_league_players(sheet, current_ratings)
+            if not confirm('Please make sure the players listed above are correct for each league.', assume_yes):
+                print('\nPlease check the date of the league matches, then try running the script again.')
+                return
+
+            if assume_yes or new_players is not None:
+                new_emails, problems = get_new_players(sheet, missing_players, league_avg_ratings, current_ratings,
+                                                       new_players or {}, new_player_policy)
+                # Nothing has been written yet, the later nights depend on this one so the batch stops here.
+                if len(problems) > 0:
+                    report_problems('new_leagues', sheet.date_str, problems)
+            else:
+                new_emails = ask_new_players(sheet, missing_players, league_avg_ratings, current_ratings)
+                if new_emails is None:
                     return
 
-            while True:
-                print(f'Please enter an email address for "{p}": ', end='')
-                player_email = input()
-                try:
-                    new_emails[p] = player_email.strip().lower()
+            print('Calculating new ratings...')
+            new_ratings = calculate_new_ratings(current_ratings, league_scores, sheet.date_str, print_out)
+            rating_increased, rating_decreased = get_rating_diffs(current_ratings, new_ratings)
+            if print_out:
+                print_league_changes(sheet, current_ratings, new_ratings)
+
+            # Only the players of this night get a point, new players are inserted on their first night.
+            date = datetime.strptime(sheet.date_str, '%Y-%m-%d').replace(hour=14)
+            for k, v in new_ratings.items():
+                if v[1] != date:
+                    continue
+                if k in stored_players:
+                    updates.append((k, v[0], date))
+                else:
+                    inserts.append((k, v[0], date, new_emails.get(k, '')))
+                    stored_players.add(k)
+            nights.append({
+                'sheet': sheet,
+                'date': date,
+                'scores': league_scores,
+                'initial_ratings': {p: current_ratings[p][0] for p in missing_players if p != ''},
+                'new_ratings': new_ratings,
+                'rating_increased': rating_increased,
+                'rating_decreased': rating_decreased
+            })
+            current_ratings = new_ratings
+
+    if len(nights) == 0:
+        return
+
+    # The date tabs of the earlier nights are written in the same call as the last night and the Ratings tab.
+    league_data = []
+    for n in nights[:-1]:
+        league_data += n['sheet'].get_league_ratings_data(n['new_ratings'], n['rating_increased'], n['rating_decreased'])
+    last_night = nights[-1]
+    sheet_writes = last_night['sheet'].get_ratings_writes(last_night['new_ratings'], last_night['rating_increased'],
+                                                          last_night['rating_decreased'], active_days, league_data)
+    matches = [{'date': n['date'], 'scores': n['scores'], 'initial_ratings': n['initial_ratings']} for n in nights]
+    plan = make_plan(data_version, inserts, updates, matches, last_night['sheet'].date_str, sheet_writes)
+
+    if execute:
+        if not confirm(f'Update database and spreadsheet with {len(nights)} league nights?', assume_yes):
+            print('Database and spreadsheet NOT updated...')
+            return
+        print('Updating database and spreadsheet...')
+        apply_plan(plan, storage, last_night['sheet'])
+        print('All done!')
+    else:
+        print('No execute flag detected, database and spreadsheet will not be updated.')
+        storage.write_rating_updates(inserts, updates, True, dry_run=True)
+        if plan_file is None:
+            plan_file = f'ratings_plan_{dates[0]}_{last_night["sheet"].date_str}.json.gz'
+        save_plan(plan_file, plan)
+
+    return
+
+
+def update_database_from_sheet(date_str, cert_file, google_cred, active_days, execute, print_out, storage=None):
+    print('Connecting to google sheets...')
+    google_sheet = GoogleSheet(date_str, google_cred)
+
+    if storage is None:
+        print('Connecting to MongoDB...')
+        storage = MongoDB(date_str, cert_file)
+
+    league_scores = google_sheet.get_all_ratings()
+    current_ratings = storage.get_current_ratings()
+
+    for player in current_ratings:
+        league_scores[player][1] = current_ratings[player][1]
+
+    print('Calculating new ratings...')
+    rating_increased, rating_decreased = get_rating_diffs(current_ratings, league_scores)
+
+    if print_out:
+        for i in current_ratings:
+            print(f'{i}')
+            print(
+                f'  {round(current_ratings[i][0], 2): >7.02f}   =>   {round(league_scores[i][0] - current_ratings[i][0], 2): >+7.02f}   =>   {round(league_scores[i][0], 2): >7.02f}')
+            print()
+
+    google_sheet.print_active_status(league_scores, rating_increased, rating_decreased, active_days)
+    if execute:
+        while True:
+            print('Update database? [y/N] ', end='')
+            execute_check = input()
+            try:
+                if execute_check.strip().lower() == 'y':
                     break
-                except KeyboardInterrupt:
+                else:
+                    print('Database and spreadsheet NOT updated...')
                     return
+            except KeyboardInterrupt:
+                return
+        print('Updating database and spreadsheet...')
+        storage.backup()
+        storage.update_ratings_from_sheet(league_scores, {})
+        remove_leaderboard_index()
+        print('All done!')
+    else:
+        print('No execute flag detected, database and spreadsheet will not be updated.')
+        storage.update_ratings_from_sheet(league_scores, {}, dry_run=True)
+    return
+
+
+def show_leaderboard(storage: RatingsStorage, player_list: list, as_of, active_days, limit=None, offset=0,
+                     active_only=False, min_rating=None):
+    index = get_leaderboard_index(storage)
+    as_of_date = datetime.strptime(as_of, '%Y-%m-%d').replace(hour=14)
+    players = None if 'all' in map(str.lower, player_list) else player_list
+    print(f'   Ratings as of {as_of}')
+    print('   Rank  Name        Rating   Active')
+    leaderboard = index.as_of(as_of_date, active_days, players)
+    if active_only or min_rating is not None:
+        leaderboard = [
+            p for p in leaderboard if (p[3] or not active_only) and (min_rating is None or p[2] > min_rating)
+        ]
+    for ranking, name, rating, active_player in leaderboard[offset:None if limit is None else offset + limit]:
+        print(f'  {ranking: >5}  {name: <12} {round(rating, 2): >7.02f}   {active_player}')
+    return
+
+
+def show_active_players(storage: RatingsStorage, player_list: list, active_days, min_rating=None, limit=None, offset=0):
+    now = datetime.now()
+    players = storage.get_active_players(now, active_days, min_rating)
+    if 'all' not in map(str.lower, player_list):
+        names = set(player_list)
+        players = [p for p in players if p[1] in names]
+    print(f'   Players active within {active_days} days')
+    print('   Rank  Name        Rating   Last played')
+    for ranking, name, rating, last_played in players[offset:None if limit is None else offset + limit]:
+        print(f'  {ranking: >5}  {name: <12} {round(rating, 2): >7.02f}   {last_played.strftime("%Y-%m-%d")}')
+    return
+
+
+def show_ratings(cert_file, player_list: list, current, active_days, storage=None, as_of=None, limit=None, offset=0, last=None,
+                 active_only=False, min_rating=None):
+    if storage is None:
+        print('Connecting to MongoDB...')
+        date_str = datetime.now().strftime('%Y-%m-%d')
+        storage = MongoDB(date_str, cert_file)
+    if as_of is not None:
+        show_leaderboard(storage, player_list, as_of, active_days, limit, offset, active_only, min_rating)
+        return
+    if active_only:
+        show_active_players(storage, player_list, active_days, min_rating, limit, offset)
+        return
+    if current:
+        print('   Name        Rating   Active')
+    else:
+        print('   Name        Ratings (latest ratings first)')
+    cutoff = get_active_cutoff(datetime.now(), active_days)
+    # Rows are printed as the storage yields them instead of after the whole roster is loaded.
+    for k, v in storage.iter_ratings_history(player_list, 1 if current else last, limit, offset):
+        if len(v) == 0:
+            print(f'  {k: <12} not found')
+            continue
+        if current:
+            active_player = v[-1][1] > cutoff
+            ratings = f'{round(v[-1][0], 2): >7.02f}   {active_player}'
+        else:
+            ratings = ', '.join([str(round(d[0], 2)) for d in v[::-1]])
+        player_info = f'  {k: <12} {ratings}'
+        print(player_info)
+    return
+
+class RatingsService():
+    # Read side of the ratings for the club website. The sorted leaderboard and the player histories are kept
+    # in memory until the storage is written. The endpoints run in a thread pool and the storages are not
+    # thread safe, so the lock lets one request at a time read the storage and fill the cache.
+
+    def __init__(self, storage: RatingsStorage, active_days=60, cache_ttl=30):
+        self.storage = storage
+        self.active_days = active_days
+        self.cache_ttl = cache_ttl
+        self.version = None
+        self.checked = None
+        self.leaderboard = None
+        self.histories = {}
+        self.lock = threading.RLock()
+        storage.commit_listeners.append(self.invalidate)
+        return
+
+    def invalidate(self):
+        with self.lock:
+            self.checked = None
+            self.leaderboard = None
+            self.histories = {}
+        return
+
+    def check_version(self):
+        # Writes made through this storage invalidate the cache right away, writes made by other processes
+        # (such as a cron job running -n) are noticed the next time the version is checked. The date is part
+        # of the version because the active status changes with it.
+        now = time.monotonic()
+        if self.checked is not None and now - self.checked < self.cache_ttl:
+            return
+        version = (self.storage.get_data_version(), datetime.now().strftime('%Y-%m-%d'))
+        if version != self.version:
+            self.invalidate()
+            self.version = version
+        self.checked = now
+        return
+
+    def is_active(self, last_played):
+        return last_played > get_active_cutoff(datetime.now(), self.active_days)
+
+    def make_response(self, body: dict):
+        content = json.dumps(body)
+        etag = '"' + hashlib.sha1(content.encode()).hexdigest() + '"'
+        return etag, content
+
+    def get_leaderboard(self):
+        with self.lock:
+            return self.read_leaderboard()
+
+    def read_leaderboard(self):
+        self.check_version()
+        if self.leaderboard is None:
+            ratings = {name: history[-1] for name, history in self.storage.iter_ratings_history(['all'], 1)}
+            activity = ActivityIndex(ratings)
+            active = activity.active(datetime.now(), self.active_days).tolist()
+            players = []
+            for ranking, (name, (rating, date)), active_player in zip(activity.ranks.tolist(), ratings.items(), active):
+                players.append({
+                    'rank': ranking,
+                    'name': name,
+                    'rating': round(rating, 2),
+                    'last_played': date.strftime('%Y-%m-%d'),
+                    'active': active_player
+                })
+            self.leaderboard = self.make_response({'players': players})
+        return self.leaderboard
+
+    def get_player(self, name, last=None):
+        with self.lock:
+            return self.read_player(name, last)
+
+    def read_player(self, name, last=None):
+        self.check_version()
+        if name not in self.histories:
+            history = self.storage.get_player_history(name)
+            if len(history) == 0:
+                return None
+            self.histories[name] = history
+        history = self.histories[name]
+        rating, date = history[-1]
+        return self.make_response({
+            'name': name,
+            'rating': round(rating, 2),
+            'last_played': date.strftime('%Y-%m-%d'),
+            'active': self.is_active(date),
+            'history': [[round(r, 2), d.strftime('%Y-%m-%d')] for r, d in (history if last is None else history[-last:])]
+        })
+
+
+def create_ratings_app(service: RatingsService):
+    try:
+        from fastapi import FastAPI, Header, HTTPException, Query, Response
+    except ImportError:
+        print('The ratings service needs fastapi, install it with "pip install -r requirements.txt".')
+        exit(1)
+    app = FastAPI(title='tt-ratings')
+
+    def respond(response, if_none_match):
+        etag, content = response
+        headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+        if if_none_match is not None and etag in [t.strip() for t in if_none_match.split(',')]:
+            return Response(status_code=304, headers=headers)
+        return Response(content, media_type='application/json', headers=headers)
+
+    # The endpoints are plain functions, so FastAPI runs the blocking storage reads in its thread pool
+    # instead of on the event loop.
+    @app.get('/leaderboard')
+    def leaderboard(if_none_match: str = Header(None)):
+        return respond(service.get_leaderboard(), if_none_match)
+
+    @app.get('/players/{name}')
+    def player(name: str, last: int = Query(None, ge=1), if_none_match: str = Header(None)):
+        response = service.get_player(name, last)
+        if response is None:
+            raise HTTPException(status_code=404, detail=f'Player not found: {name}')
+        return respond(response, if_none_match)
+
+    return app
+
+
+def serve_ratings(storage: RatingsStorage, host, port, active_days, cache_ttl):
+    app = create_ratings_app(RatingsService(storage, active_days, cache_ttl))
+    import uvicorn
+    uvicorn.run(app, host=host, port=port)
+    return
+
+
+# Best of 5 outcomes as the game score difference of the first player, the losses first.
+SIMULATION_OUTCOMES = np.array([-3, -2, -1, 1, 2, 3])
+SIMULATION_SEASONS = 1000000
+SIMULATION_BATCH_SIZE = 100000
+
+
+def get_outcome_probabilities(p):
+    # Every game is won with probability p, the same as in generate_league_night. The columns follow
+    # SIMULATION_OUTCOMES, e.g. 3:1 is a win of 3 of the first 4 games with the 4th game won.
+    q = 1 - p
+    return np.column_stack((q ** 3, 3 * q ** 3 * p, 6 * q ** 3 * p ** 2, 6 * p ** 3 * q ** 2, 3 * p ** 3 * q, p ** 3))
+
+
+class LeagueSimulation():
+    # The round robins of a league night. The probability and the rating changes of every outcome of every match
+    # are worked out once, a season is then one draw per match. Rating changes are sums of the quarter points of
+    # the rating change tables, so they are counted in exact quarter point histograms.
+
+    def __init__(self, leagues: list, ratings: dict):
+        self.leagues = leagues
+        self.names = [p for league in leagues for p in league]
+        self.ratings = np.array([ratings[p] for p in self.names], dtype=np.float64)
+        self.league_bounds = []
+        pairs = []
+        start = 0
+        for league in leagues:
+            self.league_bounds.append((start, start + len(league)))
+            pairs.extend((start + a, start + b) for a in range(len(league)) for b in range(a + 1, len(league)))
+            start += len(league)
+        pairs = np.array(pairs, dtype=np.intp).reshape(-1, 2)
+
+        e = ELO()
+        p1_ratings = self.ratings[pairs[:, 0]]
+        p2_ratings = self.ratings[pairs[:, 1]]
+        self.thresholds = np.cumsum(get_outcome_probabilities(e.expected_result(p1_ratings, p2_ratings)), axis=1)[:, :-1]
+        outcomes = np.tile(SIMULATION_OUTCOMES, len(pairs))
+        self.p1_changes = e.rating_changes(np.repeat(p1_ratings - p2_ratings, 6), outcomes).reshape(-1, 6)
+        self.p2_changes = e.rating_changes(np.repeat(p2_ratings - p1_ratings, 6), -outcomes).reshape(-1, 6)
+
+        # (matches, players) matrices that add up the matches of each player.
+        self.p1_players = np.zeros((len(pairs), len(self.names)))
+        self.p1_players[np.arange(len(pairs)), pairs[:, 0]] = 1
+        self.p2_players = np.zeros((len(pairs), len(self.names)))
+        self.p2_players[np.arange(len(pairs)), pairs[:, 1]] = 1
+        max_changes = np.abs(self.p1_changes).max(axis=1, initial=0) @ self.p1_players + \
+            np.abs(self.p2_changes).max(axis=1, initial=0) @ self.p2_players
+        self.max_quarters = int(np.ceil(max_changes.max(initial=0) * 4))
+        self.max_positions = max((len(league) for league in leagues), default=0)
+        return
+
+    def sample(self, seasons, seed):
+        # Returns the histograms of the rating changes and the finishing positions of every player.
+        rng = np.random.default_rng(seed)
+        matches = np.arange(len(self.thresholds))
+        outcomes = (rng.random((seasons, len(matches)))[:, :, None] >= self.thresholds).sum(axis=2)
+        changes = self.p1_changes[matches, outcomes] @ self.p1_players + self.p2_changes[matches, outcomes] @ self.p2_players
+
+        # Matches won decide the finishing position and the game score difference breaks the ties,
+        # players who are still tied share the better position.
+        game_score_diffs = SIMULATION_OUTCOMES[outcomes]
+        scores = (100 * (game_score_diffs > 0) + game_score_diffs) @ self.p1_players + \
+            (100 * (game_score_diffs < 0) - game_score_diffs) @ self.p2_players
+        positions = np.empty(scores.shape, dtype=np.intp)
+        for start, end in self.league_bounds:
+            league_scores = scores[:, start:end]
+            positions[:, start:end] = (league_scores[:, None, :] > league_scores[:, :, None]).sum(axis=2)
+
+        quarters = np.rint(changes * 4).astype(np.intp) + self.max_quarters
+        change_counts = np.zeros((len(self.names), 2 * self.max_quarters + 1), dtype=np.int64)
+        position_counts = np.zeros((len(self.names), self.max_positions), dtype=np.int64)
+        for i in range(len(self.names)):
+            change_counts[i] = np.bincount(quarters[:, i], minlength=2 * self.max_quarters + 1)
+            position_counts[i] = np.bincount(positions[:, i], minlength=self.max_positions)
+        return change_counts, position_counts
+
+    def run(self, seasons=SIMULATION_SEASONS, batch_size=SIMULATION_BATCH_SIZE, workers=None, seed=None):
+        # The batches are sampled in a process pool, every batch has its own random stream.
+        from concurrent.futures import ProcessPoolExecutor
+        batches = [min(batch_size, seasons - i) for i in range(0, seasons, batch_size)]
+        seeds = np.random.SeedSequence(seed).spawn(len(batches))
+        change_counts = np.zeros((len(self.names), 2 * self.max_quarters + 1), dtype=np.int64)
+        position_counts = np.zeros((len(self.names), self.max_positions), dtype=np.int64)
+        if workers == 1:
+            results = list(map(self.sample, batches, seeds))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(self.sample, batches, seeds))
+        for batch_change_counts, batch_position_counts in results:
+            change_counts += batch_change_counts
+            position_counts += batch_position_counts
+        return change_counts, position_counts
+
+    def get_change_percentiles(self, change_counts, percentiles):
+        cumulative = np.cumsum(change_counts, axis=1)
+        quarters = np.stack([
+            np.argmax(cumulative >= q / 100 * cumulative[:, -1:], axis=1) for q in percentiles
+        ], axis=1)
+        return (quarters - self.max_quarters) / 4
+
+
+def print_simulation(simulation: LeagueSimulation, change_counts, position_counts):
+    seasons = change_counts[0].sum() if len(change_counts) > 0 else 0
+    changes = (np.arange(change_counts.shape[1]) - simulation.max_quarters) / 4
+    means = change_counts @ changes / max(seasons, 1)
+    deviations = np.sqrt(np.maximum(change_counts @ changes ** 2 / max(seasons, 1) - means ** 2, 0))
+    percentiles = simulation.get_change_percentiles(change_counts, [5, 50, 95])
+    print(f'   {seasons} simulated seasons, rating change and chance of each finishing position')
+    for l, (start, end) in enumerate(simulation.league_bounds, 1):
+        print()
+        print(f'   League {l}')
+        header = '   Name        Rating     Mean    Std     5%    50%    95%'
+        print(header + ''.join(f'{f"#{p}": >7}' for p in range(1, end - start + 1)))
+        for i in range(start, end):
+            changes_info = f'{means[i]: >+7.02f} {deviations[i]: >6.02f} ' + \
+                ' '.join(f'{c: >+6.02f}' for c in percentiles[i])
+            positions_info = ''.join(f'{c / max(seasons, 1): >7.1%}' for c in position_counts[i, :end - start])
+            print(f'  {simulation.names[i]: <12} {round(simulation.ratings[i], 2): >7.02f} {changes_info}{positions_info}')
+    return
+
+
+def simulate_league(date_str, google_cred, roster, storage: RatingsStorage, leagues=3, seasons=SIMULATION_SEASONS,
+                    batch_size=SIMULATION_BATCH_SIZE, workers=None):
+    # The leagues are read from the date tab, or given as "name,name,...;name,..." to try out other groupings.
+    if roster is not None:
+        league_players = [[p.strip() for p in league.split(',') if p.strip() != ''] for league in roster.split(';')]
+    else:
+        print('Connecting to google sheets...')
+        google_sheet = GoogleSheet(date_str, google_cred, leagues)
+        google_sheet.get_league_players()
+        league_players = [[p for p in players if p != ''] for players in google_sheet.players_per_league.values()]
+
+    current_ratings = storage.get_current_ratings()
+    ratings = {}
+    for l, league in enumerate(league_players, 1):
+        known_ratings = [current_ratings[p][0] for p in league if p in current_ratings]
+        league_avg_rating = float(np.mean(known_ratings)) if len(known_ratings) > 0 else 1000.0
+        for p in league:
+            if p in current_ratings:
+                ratings[p] = current_ratings[p][0]
+            else:
+                print(f'Missing rating for "{p}", using the average rating of league {l}: {round(league_avg_rating, 2)}')
+                ratings[p] = league_avg_rating
+
+    simulation = LeagueSimulation(league_players, ratings)
+    change_counts, position_counts = simulation.run(seasons, batch_size, workers)
+    print_simulation(simulation, change_counts, position_counts)
+    return
+
+
+# Candidate values of the backtest, the tables are scaled as a whole. match_K and game_K are not searched, the
+# rating updates do not use them.
+BACKTEST_SEARCH_SPACE = {
+    'expected_scale': [0.5, 0.75, 1.0, 1.25, 1.5],
+    'unexpected_scale': [0.5, 0.75, 1.0, 1.25, 1.5],
+    'range_scale': [0.5, 0.75, 1.0, 1.25, 1.5],
+    'elo_scale': [200.0, 300.0, 400.0, 500.0, 600.0]
+}
+BACKTEST_BASELINE = {'expected_scale': 1.0, 'unexpected_scale': 1.0, 'range_scale': 1.0, 'elo_scale': 400.0}
+BACKTEST_CHECKPOINT_FILE = 'backtest_checkpoint.jsonl'
+# The stored matches, set in every worker of the backtest once instead of being sent with every candidate.
+BACKTEST_DATA = None
+# The shared memory blocks BACKTEST_DATA points into in a worker, kept open while the worker runs.
+BACKTEST_SHARED_MEMORY = []
+
+
+def load_backtest_data(storage: RatingsStorage):
+    # Turns the stored matches into arrays: the score columns of all nights one after the other, the offsets of
+    # the nights and the ratings every player starts from.
+    matches = storage.get_matches()
+    if len(matches) == 0:
+        print('No stored matches to backtest.')
+        exit(1)
+    first_date = matches[0]['date']
+    ratings = {}
+    first_ratings = {}
+    for d in storage.get_all_documents():
+        history = [h for h in d['historical_ratings'] if h[1] < first_date]
+        if len(history) > 0:
+            ratings[d['name']] = history[-1][0]
+        if len(d['historical_ratings']) > 0:
+            first_ratings[d['name']] = d['historical_ratings'][0][0]
+    for m in matches:
+        for name, rating in m['initial_ratings'].items():
+            ratings.setdefault(name, rating)
+        for name in get_played_players(m['scores']):
+            if name not in ratings and name in first_ratings:
+                ratings[name] = first_ratings[name]
+
+    player_index = {name: i for i, name in enumerate(ratings)}
+    score_columns = []
+    offsets = [0]
+    for m in matches:
+        rows = [row for row in m['scores'] if all(p == '' or p in player_index for p in row[:2])]
+        if len(rows) < len(m['scores']):
+            print(f'Skipped {len(m["scores"]) - len(rows)} matches of {m["date"].strftime("%Y-%m-%d")} '
+                  f'with players without a rating.')
+        score_columns.append(scores_to_columns(rows, player_index))
+        offsets.append(offsets[-1] + len(score_columns[-1]))
+    score_columns = np.concatenate(score_columns)
+
+    # 1 when the first player won the match, 0 when the second player won and NaN when nobody did.
+    score_diffs = score_columns[:, 2:12:2] - score_columns[:, 3:12:2]
+    game_score_diffs = np.nansum(np.sign(score_diffs), axis=1)
+    winners = np.where(game_score_diffs > 0, 1.0, np.where(game_score_diffs < 0, 0.0, np.nan))
+    fingerprint = hashlib.sha1(score_columns.tobytes() + np.array(list(ratings.values())).tobytes()).hexdigest()
+    return {
+        'ratings': np.array(list(ratings.values()), dtype=np.float64),
+        'score_columns': score_columns,
+        'offsets': np.array(offsets, dtype=np.intp),
+        'winners': winners,
+        'fingerprint': fingerprint
+    }
+
+
+def set_backtest_data(data: dict):
+    global BACKTEST_DATA
+    BACKTEST_DATA = data
+    return
+
+
+def share_backtest_data(data: dict):
+    # Copies the arrays into shared memory once. Returns the blocks, which the caller closes and unlinks, and
+    # what attach_backtest_data needs to find them: the name, shape and dtype of every array.
+    from multiprocessing import shared_memory
+    blocks = []
+    shared = {}
+    for key, value in data.items():
+        if not isinstance(value, np.ndarray):
+            shared[key] = value
+            continue
+        block = shared_memory.SharedMemory(create=True, size=max(1, value.nbytes))
+        blocks.append(block)
+        np.ndarray(value.shape, dtype=value.dtype, buffer=block.buf)[...] = value
+        shared[key] = {'shared_memory': block.name, 'shape': value.shape, 'dtype': value.dtype.str}
+    return blocks, shared
+
+
+def attach_backtest_data(shared: dict):
+    # The initializer of the backtest workers, the arrays are read-only views of the shared memory.
+    from multiprocessing import shared_memory
+    data = {}
+    for key, value in shared.items():
+        if not isinstance(value, dict):
+            data[key] = value
+            continue
+        block = shared_memory.SharedMemory(name=value['shared_memory'])
+        BACKTEST_SHARED_MEMORY.append(block)
+        data[key] = np.ndarray(value['shape'], dtype=np.dtype(value['dtype']), buffer=block.buf)
+        data[key].flags.writeable = False
+    set_backtest_data(data)
+    return
+
+
+def get_candidate_elo(params: dict):
+    return ELO(
+        RATING_RANGE_LIST * params['range_scale'],
+        RATING_CHANGE_EXPECTED * params['expected_scale'],
+        RATING_CHANGE_UNEXPECTED * params['unexpected_scale'],
+        params['elo_scale']
+    )
+
+
+def backtest(params: dict, data: dict=None):
+    # Replays the stored nights with the candidate parameters. Before every night the winner of every match is
+    # predicted with expected_result from the ratings so far, the score is the log-loss of those predictions.
+    if data is None:
+        data = BACKTEST_DATA
+    e = get_candidate_elo(params)
+    ratings = data['ratings'].copy()
+    losses = []
+    correct = 0
+    for start, end in zip(data['offsets'][:-1], data['offsets'][1:]):
+        score_columns = data['score_columns'][start:end]
+        winners = data['winners'][start:end]
+        decided = ~np.isnan(winners)
+        p = e.expected_result(ratings[score_columns[decided, 0].astype(np.intp)],
+                              ratings[score_columns[decided, 1].astype(np.intp)])
+        p = np.clip(p, 1e-15, 1 - 1e-15)
+        losses.append(-(winners[decided] * np.log(p) + (1 - winners[decided]) * np.log(1 - p)))
+        correct += int(((p > 0.5) == (winners[decided] == 1)).sum())
+        ratings, played = calculate_new_ratings_columnar(ratings, score_columns, e)
+    losses = np.concatenate(losses)
+    return {
+        'params': params,
+        'log_loss': float(losses.mean()) if len(losses) > 0 else None,
+        'accuracy': correct / len(losses) if len(losses) > 0 else None,
+        'matches': len(losses),
+        'data': data['fingerprint']
+    }
+
+
+def get_backtest_candidates(search, candidates=100, seed=0):
+    # The grid is every combination of the search space, a random search samples every value uniformly
+    # between the smallest and the largest one. The same seed gives the same candidates, to resume a search.
+    if search == 'grid':
+        keys = list(BACKTEST_SEARCH_SPACE)
+        return [dict(zip(keys, values)) for values in itertools.product(*BACKTEST_SEARCH_SPACE.values())]
+    rng = np.random.default_rng(seed)
+    return [
+        {k: round(float(rng.uniform(min(v), max(v))), 4) for k, v in BACKTEST_SEARCH_SPACE.items()}
+        for _ in range(candidates)
+    ]
+
+
+def load_backtest_checkpoint(checkpoint_file, fingerprint):
+    # Results of an earlier run on the same matches, by their parameters.
+    results = {}
+    if checkpoint_file is None or not os.path.exists(checkpoint_file):
+        return results
+    with open(checkpoint_file, 'r') as in_file:
+        for line in in_file:
+            if line.strip() == '':
+                continue
+            result = json.loads(line)
+            if result['data'] == fingerprint:
+                results[json.dumps(result['params'], sort_keys=True)] = result
+    return results
+
+
+def run_backtest(storage: RatingsStorage, search=None, candidates=100, seed=0, workers=None,
+                 checkpoint_file=BACKTEST_CHECKPOINT_FILE):
+    from concurrent.futures import ProcessPoolExecutor
+    data = load_backtest_data(storage)
+    print(f'Backtesting {data["offsets"].size - 1} league nights with {len(data["score_columns"])} matches.')
+    baseline = backtest(BACKTEST_BASELINE, data)
+    if baseline['matches'] == 0:
+        print('No stored match has a winner to predict.')
+        exit(1)
+    if search is None:
+        print_backtest_results([], baseline)
+        return [baseline]
+
+    params = get_backtest_candidates(search, candidates, seed)
+    results = load_backtest_checkpoint(checkpoint_file, data['fingerprint'])
+    pending = [p for p in params if json.dumps(p, sort_keys=True) not in results]
+    print(f'{len(params) - len(pending)} of {len(params)} candidates found in {checkpoint_file}.')
+    # Every finished candidate is appended to the checkpoint right away, an interrupted search resumes from it.
+    # The workers read the matches from shared memory, they are not copied into every worker.
+    with open(checkpoint_file, 'a') as out_file:
+        blocks = []
+        if workers == 1:
+            set_backtest_data(data)
+            finished = map(backtest, pending)
+            executor = None
+        else:
+            blocks, shared = share_backtest_data(data)
+            executor = ProcessPoolExecutor(max_workers=workers, initializer=attach_backtest_data, initargs=(shared,))
+            finished = executor.map(backtest, pending, chunksize=max(1, len(pending) // 64))
+        try:
+            for result in finished:
+                results[json.dumps(result['params'], sort_keys=True)] = result
+                out_file.write(json.dumps(result) + '\n')
+                out_file.flush()
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+            for block in blocks:
+                block.close()
+                block.unlink()
+    print_backtest_results([results[json.dumps(p, sort_keys=True)] for p in params], baseline)
+    return results
+
+
+def print_backtest_results(results: list, baseline: dict, top=10):
+    results = sorted([r for r in results if r['log_loss'] is not None], key=lambda r: r['log_loss'])
+    print(f'   Log-loss   Accuracy   Expected  Unexpected  Range   ELO scale   ({baseline["matches"]} matches)')
+    for r in [baseline] + results[:top]:
+        p = r['params']
+        label = '  (current)' if r is baseline else ''
+        print(f'   {r["log_loss"]: >8.04f}   {r["accuracy"]: >8.2%}   {p["expected_scale"]: >8.02f}  '
+              f'{p["unexpected_scale"]: >10.02f}  {p["range_scale"]: >5.02f}   {p["elo_scale"]: >9.01f}{label}')
+    return
+
+
+# League nights are played as round robins of 6 players, the same layout as the date tabs of the spreadsheet.
+BENCHMARK_PLAYERS_PER_LEAGUE = 6
+# Slowdown over the baseline that is reported as a regression.
+BENCHMARK_TOLERANCE = 0.25
+# Read-only commands timed from a fresh interpreter, they must not need MongoDB or the spreadsheet.
+BENCHMARK_STARTUP_COMMANDS = {
+    'help': ['-h'],
+    'show_ratings': ['--storage', 'memory', '-s', 'all', '-c']
+}
+BENCHMARK_STARTUP_RUNS = 5
+
+
+def generate_club(players: int, rng, json_file='players.json', start_date=None):
+    # The ratings are sampled from the distribution of the current ratings in the mongoexport file.
+    seed_ratings = [1500.0]
+    if json_file is not None and os.path.exists(json_file):
+        from bson.json_util import loads
+        with open(json_file, 'r') as in_file:
+            seed_ratings = [loads(line)['current_rating'] for line in in_file if line.strip() != '']
+    if start_date is None:
+        start_date = datetime.strptime('2023-01-07', '%Y-%m-%d').replace(hour=14)
+    ratings = rng.choice(seed_ratings, players) + rng.normal(0, 50, players)
+    return {f'Player {i}': [float(ratings[i]), start_date] for i in range(players)}
+
+
+def generate_league_night(club_ratings: dict, leagues: int, rng):
+    # Returns score rows shaped like the ones from GoogleSheet.get_scores: both player names followed by the
+    # points of each game of a best of 5 match.
+    player_names = list(club_ratings)
+    players = rng.choice(len(player_names), leagues * BENCHMARK_PLAYERS_PER_LEAGUE, replace=False)
+    ratings = np.array([club_ratings[player_names[i]][0] for i in players])
+    players = players[np.argsort(-ratings)].reshape(leagues, BENCHMARK_PLAYERS_PER_LEAGUE)
+
+    pairs = np.array([(a, b) for a in range(BENCHMARK_PLAYERS_PER_LEAGUE) for b in range(a + 1, BENCHMARK_PLAYERS_PER_LEAGUE)])
+    p1 = players[:, pairs[:, 0]].ravel()
+    p2 = players[:, pairs[:, 1]].ravel()
+    p1_ratings = np.array([club_ratings[player_names[i]][0] for i in p1])
+    p2_ratings = np.array([club_ratings[player_names[i]][0] for i in p2])
+
+    # Every game is won with the ELO expected result, the match stops when a player has won 3 games.
+    p1_wins_game = rng.random((len(p1), 5)) < ELO().expected_result(p1_ratings, p2_ratings)[:, None]
+    games = np.minimum(np.argmax(np.cumsum(p1_wins_game, axis=1) == 3, axis=1),
+                       np.argmax(np.cumsum(~p1_wins_game, axis=1) == 3, axis=1)) + 1
+    loser_points = rng.integers(0, 10, (len(p1), 5))
+
+    rows = []
+    for m in range(len(p1)):
+        row = [player_names[p1[m]], player_names[p2[m]]]
+        for g in range(games[m]):
+            if p1_wins_game[m, g]:
+                row += [11, int(loser_points[m, g])]
+            else:
+                row += [int(loser_points[m, g]), 11]
+        rows.append(row)
+    return rows
+
+
+def generate_season(matches: int, rng, json_file='players.json'):
+    # The club grows with the number of matches, 3 out of 4 players show up on a league night.
+    players = min(max(48, matches // 20), 20000)
+    leagues = max(3, players * 3 // 4 // BENCHMARK_PLAYERS_PER_LEAGUE)
+    club_ratings = generate_club(players, rng, json_file)
+    league_date = datetime.strptime('2023-01-07', '%Y-%m-%d').replace(hour=14)
+
+    storage = MemoryStorage(league_date.strftime('%Y-%m-%d'))
+    storage.insert_documents([new_player_document(k, v[0], v[1], '') for k, v in club_ratings.items()])
+    nights = []
+    match_count = 0
+    while match_count < matches:
+        league_date = league_date + timedelta(days=7)
+        rows = generate_league_night(club_ratings, leagues, rng)[:matches - match_count]
+        match_count += len(rows)
+        nights.append((league_date.strftime('%Y-%m-%d'), rows))
+    return storage, club_ratings, nights
+
+
+def benchmark_stage(stage, func, items: int):
+    start = time.perf_counter()
+    func()
+    seconds = time.perf_counter() - start
+
+    # Peak memory is measured in a second run, so the tracing does not slow down the timed one.
+    tracemalloc.start()
+    func()
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {'seconds': seconds, 'items': items, 'per_second': items / seconds if seconds > 0 else 0.0,
+            'peak_memory': peak_memory}
+
+
+def benchmark_size(matches: int, rng, json_file='players.json'):
+    print(f'{matches} matches:')
+    storage, club_ratings, nights = generate_season(matches, rng, json_file)
+    league_scores = [row for date_str, rows in nights for row in rows]
+    date_str = nights[-1][0]
+    results = {}
+
+    e = ELO()
+    rating_diffs = rng.normal(0, 200, matches)
+    game_score_diffs = rng.choice([-3, -2, -1, 1, 2, 3], matches)
+    results['ELO.rating_change'] = benchmark_stage(
+        'ELO.rating_change', lambda: [e.rating_change(rating_diffs[i], game_score_diffs[i]) for i in range(matches)], matches
+    )
+    results['ELO.rating_changes'] = benchmark_stage(
+        'ELO.rating_changes', lambda: e.rating_changes(rating_diffs, game_score_diffs), matches
+    )
+
+    new_ratings = calculate_new_ratings(club_ratings, league_scores, date_str, False)
+    results['calculate_new_ratings'] = benchmark_stage(
+        'calculate_new_ratings',
+        lambda: calculate_new_ratings(club_ratings, league_scores, date_str, False), matches
+    )
+    player_index = {name: i for i, name in enumerate(club_ratings)}
+    ratings = np.array([v[0] for v in club_ratings.values()])
+    score_columns = scores_to_columns(league_scores, player_index)
+    results['calculate_new_ratings_columnar'] = benchmark_stage(
+        'calculate_new_ratings_columnar', lambda: calculate_new_ratings_columnar(ratings, score_columns), matches
+    )
+    results['get_rating_diffs'] = benchmark_stage(
+        'get_rating_diffs', lambda: get_rating_diffs(club_ratings, new_ratings), len(new_ratings)
+    )
+
+    def replay():
+        replay_storage = MemoryStorage(date_str)
+        replay_storage.insert_documents(list(storage.get_all_documents()))
+        current_ratings = replay_storage.get_current_ratings()
+        for night_date, rows in nights:
+            current_ratings = calculate_new_ratings(current_ratings, rows, night_date, False)
+            replay_storage.set_new_ratings(current_ratings)
+        return replay_storage
+
+    results['replay'] = benchmark_stage('replay', replay, matches)
+    storage = replay()
+    history_points = sum(len(d['historical_ratings']) for d in storage.get_all_documents())
+
+    with tempfile.TemporaryDirectory() as backup_dir:
+        cwd = os.getcwd()
+        os.chdir(backup_dir)
+        try:
+            def full_backup():
+                with contextlib.redirect_stdout(io.StringIO()):
+                    storage.backup(full=True)
+
+            results['backup'] = benchmark_stage('backup', full_backup, history_points)
+        finally:
+            os.chdir(cwd)
+
+    history = storage.get_rating_history_arrays(['all'])
+    history.sort_by_date()
+    results['RatingHistory.from_history'] = benchmark_stage(
+        'RatingHistory.from_history', lambda: storage.get_rating_history_arrays(['all']), history_points
+    )
+    results['LeaderboardIndex.as_of'] = benchmark_stage(
+        'LeaderboardIndex.as_of', lambda: LeaderboardIndex(history).as_of(nights[-1][0], 60), len(history)
+    )
+
+    def show_all_ratings():
+        with contextlib.redirect_stdout(io.StringIO()):
+            show_ratings(None, ['all'], False, 60, storage)
+
+    results['show_ratings'] = benchmark_stage('show_ratings', show_all_ratings, history_points)
+
+    for stage, result in results.items():
+        print(f'  {stage: <32} {result["seconds"]: >10.4f}s {result["per_second"]: >14,.0f}/s '
+              f'{result["peak_memory"] / 1024 / 1024: >10.2f} MiB')
+    print()
+    return results
+
+
+def benchmark_startup(json_file='players.json'):
+    # Runs each command under python -X importtime, the best wall time of the runs is reported together with
+    # the slowest top level imports of the last run.
+    results = {}
+    for stage, arguments in BENCHMARK_STARTUP_COMMANDS.items():
+        command = [sys.executable, '-X', 'importtime', os.path.abspath(__file__)] + arguments
+        if json_file is not None:
+            command += ['--import-json', json_file]
+        seconds = []
+        for _ in range(BENCHMARK_STARTUP_RUNS):
+            start = time.perf_counter()
+            process = subprocess.run(command, capture_output=True, text=True)
+            seconds.append(time.perf_counter() - start)
+        if process.returncode != 0:
+            print(f'  startup {stage} failed: {process.stderr.splitlines()[-1:]}')
+            continue
+
+        imports = []
+        for line in process.stderr.splitlines():
+            # import time: self [us] | cumulative | imported package, nested imports are indented.
+            fields = line.split('|')
+            if not line.startswith('import time:') or len(fields) != 3 or not fields[1].strip().isdigit():
+                continue
+            if not fields[2].startswith('  '):
+                imports.append((int(fields[1]) / 1000000, fields[2].strip()))
+        imports.sort(reverse=True)
+        results[f'startup {stage}'] = {
+            'seconds': min(seconds),
+            'imports': {name: import_seconds for import_seconds, name in imports[:5]}
+        }
+
+    for stage, result in results.items():
+        slowest = ', '.join(f'{name} {import_seconds * 1000:.0f}ms' for name, import_seconds in result['imports'].items())
+        print(f'  {stage: <32} {result["seconds"]: >10.4f}s   {slowest}')
+    print()
+    return results
+
+
+def compare_benchmarks(results: dict, baseline: dict):
+    regressions = 0
+    print('Comparison with the baseline:')
+    for size, stages in results['results'].items():
+        for stage, result in stages.items():
+            try:
+                baseline_seconds = baseline['results'][size][stage]['seconds']
+            except KeyError:
+                continue
+            ratio = result['seconds'] / baseline_seconds if baseline_seconds > 0 else 1.0
+            status = ''
+            if ratio > 1 + BENCHMARK_TOLERANCE:
+                status = 'REGRESSION'
+                regressions += 1
+            print(f'  {size: >8} {stage: <32} {baseline_seconds: >10.4f}s => {result["seconds"]: >10.4f}s  {ratio: >6.2f}x  {status}')
+    return regressions
+
 
-    print('Calculating new ratings...')
-    new_ratings = calculate_new_ratings(current_ratings, league_scores, date_str, print_out)
-    rating_increased, rating_decreased = get_rating_diffs(current_ratings, new_ratings)
+def run_benchmark(sizes: list, output_file, baseline_file=None, json_file='players.json', seed=0):
+    rng = np.random.default_rng(seed)
+    results = {
+        'created': datetime.now().isoformat(),
+        'python': sys.version.split()[0],
+        'numpy': np.__version__,
+        'results': {}
+    }
+    print(f'  {"Stage": <32} {"Time": >11} {"Throughput": >16} {"Peak memory": >14}')
+    for size in sizes:
+        results['results'][str(size)] = benchmark_size(size, rng, json_file)
+    results['results']['startup'] = benchmark_startup(json_file)
 
-    if print_out:
-        for i in range(len(google_sheet.players_per_league)):
-            league = i + 1
-            if len(google_sheet.players_per_league[league]) == 0:
-                break
+    if output_file is not None:
+        with open(output_file, 'w') as out_file:
+            json.dump(results, out_file, indent=2)
+        print(f'Benchmark results saved to {output_file}')
 
-            print(f'League {league}:')
-            for p in google_sheet.players_per_league[league]:
-                if p != '':
-                    print(f'  {p: >20}: {round(current_ratings[p][0], 2): >7.02f}   =>   {round(new_ratings[p][0] - current_ratings[p][0], 2): >+7.02f}   =>   {round(new_ratings[p][0], 2): >7.02f}')
-            print()
+    regressions = 0
+    if baseline_file is not None:
+        with open(baseline_file, 'r') as in_file:
+            regressions = compare_benchmarks(results, json.load(in_file))
+    return regressions
 
-    # Just in case things go wrong, we backup the database locally.
-    # The backup file can be used to import to mongodb using command "mongoimport".
-    if execute:
-        while True:
-            print('Update database and spreadsheet? [y/N] ', end='')
-            execute_check = input()
-            try:
-                if execute_check.strip().lower() == 'y':
-                    break
-                else:
-                    print('Database and spreadsheet NOT updated...')
-                    return
-            except KeyboardInterrupt:
-                return
-        print('Updating database and spreadsheet...')
-        mongodb.backup()
-        mongodb.set_new_ratings(new_ratings, new_emails)
-        google_sheet.set_new_ratings(new_ratings, rating_increased, rating_decreased, active_days)
-        print('All done!')
-    else:
-        print('No execute flag detected, database and spreadsheet will not be updated.')
 
-    return
+# Storages kept open by the daemon, None outside of the daemon.
+DAEMON_STORAGES = None
 
 
-def update_database_from_sheet(date_str, cert_file, google_cred, active_days, execute, print_out):
-    print('Connecting to google sheets...')
-    google_sheet = GoogleSheet(date_str, google_cred)
+class DaemonOutput(io.TextIOBase):
+    # Stands in for stdout while the daemon runs a command, every write is sent to the client as a JSON line.
 
-    print('Connecting to MongoDB...')
-    mongodb = MongoDB(date_str, cert_file)
+    def __init__(self, connection):
+        self.connection = connection
+        return
 
-    league_scores = google_sheet.get_all_ratings()
-    current_ratings = mongodb.get_current_ratings()
+    def writable(self):
+        return True
 
-    for player in current_ratings:
-        league_scores[player][1] = current_ratings[player][1]
+    def write(self, text):
+        self.send({'out': text})
+        return len(text)
 
-    print('Calculating new ratings...')
-    rating_increased, rating_decreased = get_rating_diffs(current_ratings, league_scores)
+    def send(self, message: dict):
+        self.connection.sendall((json.dumps(message) + '\n').encode('utf-8'))
+        return
 
-    if print_out:
-        for i in current_ratings:
-            print(f'{i}')
-            print(
-                f'  {round(current_ratings[i][0], 2): >7.02f}   =>   {round(league_scores[i][0] - current_ratings[i][0], 2): >+7.02f}   =>   {round(league_scores[i][0], 2): >7.02f}')
-            print()
 
-    google_sheet.print_active_status(league_scores, rating_increased, rating_decreased, active_days)
-    if execute:
+def run_daemon(args):
+    # Runs the commands sent to the socket one at a time, in the working directory of the client. The storages
+    # and the spreadsheet services stay connected between the commands.
+    import socket
+    import traceback
+    global DAEMON_STORAGES
+    DAEMON_STORAGES = {}
+    get_storage(args)
+    parser = make_parser()
+
+    if os.path.exists(args.socket):
+        os.remove(args.socket)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(args.socket)
+    os.chmod(args.socket, 0o600)
+    server.listen()
+    print(f'Listening on {args.socket}, press Ctrl+C to stop.')
+    cwd = os.getcwd()
+    try:
         while True:
-            print('Update database? [y/N] ', end='')
-            execute_check = input()
-            try:
-                if execute_check.strip().lower() == 'y':
-                    break
-                else:
-                    print('Database and spreadsheet NOT updated...')
-                    return
-            except KeyboardInterrupt:
-                return
-        print('Updating database and spreadsheet...')
-        mongodb.backup()
-        mongodb.update_ratings_from_sheet(league_scores, {})
-        print('All done!')
-    else:
-        print('No execute flag detected, database and spreadsheet will not be updated.')
+            connection, _ = server.accept()
+            with connection:
+                reader = connection.makefile('r', encoding='utf-8')
+                output = DaemonOutput(connection)
+                code = 0
+                start = time.perf_counter()
+                request = {}
+                try:
+                    request = json.loads(reader.readline())
+                    os.chdir(request['cwd'])
+                    # The prompts of -n and -u are answered by the client, exit() ends the command.
+                    sys.stdin = reader
+                    with contextlib.redirect_stdout(output):
+                        run_command(parser.parse_args(request['argv']))
+                except SystemExit as err:
+                    code = err.code if isinstance(err.code, int) else (0 if err.code is None else 1)
+                except Exception:
+                    output.write(traceback.format_exc())
+                    code = 1
+                finally:
+                    sys.stdin = sys.__stdin__
+                    os.chdir(cwd)
+                try:
+                    output.send({'exit': code})
+                except OSError:
+                    pass
+                print(f'{" ".join(request.get("argv", []))} => {code} in {time.perf_counter() - start:.3f}s')
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        os.remove(args.socket)
     return
 
 
-def show_ratings(cert_file, player_list: list, current, active_days):
-    print('Connecting to MongoDB...')
-    date_str = datetime.now().strftime('%Y-%m-%d')
-    mongodb = MongoDB(date_str, cert_file)
-    player_list = mongodb.get_ratings_history(player_list)
-    if current:
-        print('   Name        Rating   Active')
+def get_storage(args):
+    date_str = args.date if args.date is not None else datetime.now().strftime('%Y-%m-%d')
+    # The daemon keeps its storages, and their connections, for the next commands.
+    key = (args.storage, os.path.abspath(args.mongodb_cert), os.path.abspath(args.sqlite_file), args.import_json)
+    if DAEMON_STORAGES is not None and key in DAEMON_STORAGES:
+        storage = DAEMON_STORAGES[key]
+        storage.date_str = date_str
     else:
-        print('   Name        Ratings (latest ratings first)')
-    for k, v in player_list.items():
-        if current:
-            active_player = True
-            if (datetime.now() - v[-1][1]).days > active_days:
-                active_player = False
-            ratings = f'{round(v[-1][0], 2): >7.02f}   {active_player}'
-        else:
-            ratings = ', '.join([str(round(d[0], 2)) for d in v[::-1]])
-        player_info = f'  {k: <12} {ratings}'
-        print(player_info)
-    return
+        if args.storage in ('mongodb', 'mongodb-buckets'):
+            print('Connecting to MongoDB...')
+        storage = open_storage(args.storage, date_str, args.mongodb_cert, args.sqlite_file, args.import_json)
+        if DAEMON_STORAGES is not None:
+            storage.use_snapshot()
+            DAEMON_STORAGES[key] = storage
+    storage.backup_dir = args.backup_dir
+    storage.backup_compression = args.backup_compression
+    storage.full_backup = args.full_backup
+    return storage
 
-def main():
+
+def make_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument(
         '-m', '--mongodb-cert',
@@ -772,6 +3961,28 @@ def main():
         default='mongodb_cert.pem',
         help='Path to the MongoDB cert file, defaults to "mongodb_cert.pem".'
     )
+    parser.add_argument(
+        '--storage',
+        dest='storage',
+        type=str,
+        choices=['mongodb', 'mongodb-buckets', 'sqlite', 'memory'],
+        default='mongodb',
+        help='Where the ratings are stored, defaults to "mongodb". "mongodb-buckets" keeps the rating history in '
+             'yearly buckets, see "--migrate-history".'
+    )
+    parser.add_argument(
+        '--sqlite-file',
+        dest='sqlite_file',
+        type=str,
+        default='ratings.db',
+        help='Path to the SQLite database used with "--storage sqlite", defaults to "ratings.db".'
+    )
+    parser.add_argument(
+        '--import-json',
+        dest='import_json',
+        type=str,
+        help='A mongoexport file (such as "players.json") to load into the sqlite or memory storage.'
+    )
     parser.add_argument(
         '-g', '--google-cred',
         dest='google_cred',
@@ -786,6 +3997,13 @@ def main():
         default=60,
         help='The limit in days when players is set as inactive, defaults to 60 days.'
     )
+    parser.add_argument(
+        '-l', '--leagues',
+        dest='leagues',
+        type=int,
+        default=3,
+        help='The number of leagues on the date tab of the spreadsheet, defaults to 3.'
+    )
     parser.add_argument(
         '-d', '--date',
         dest='date',
@@ -799,6 +4017,51 @@ def main():
         default=False,
         help='Use new league matches to update the ratings.'
     )
+    parser.add_argument(
+        '--from',
+        dest='from_date',
+        type=str,
+        help='This option must be paired with "-n", process every dated tab from this date in the format of yyyy-mm-dd.'
+    )
+    parser.add_argument(
+        '--to',
+        dest='to_date',
+        type=str,
+        help='This option must be paired with "--from", the last date to process, defaults to today.'
+    )
+    parser.add_argument(
+        '--plan',
+        dest='plan',
+        type=str,
+        help='This option must be paired with "-n", where the dry run saves the plan, defaults to "ratings_plan_<date>.json.gz".'
+    )
+    parser.add_argument(
+        '--apply',
+        dest='apply',
+        type=str,
+        help='Apply a plan saved by a dry run of "-n", if the database has not changed since.'
+    )
+    parser.add_argument(
+        '-y', '--yes',
+        dest='assume_yes',
+        action='store_true',
+        default=False,
+        help='This option must be paired with "-n", answer yes to every question and report problems as JSON for unattended runs.'
+    )
+    parser.add_argument(
+        '--new-players',
+        dest='new_players',
+        type=str,
+        help='This option must be paired with "-n", a CSV or YAML file with the initial ratings and emails of new players.'
+    )
+    parser.add_argument(
+        '--new-player-rating',
+        dest='new_player_rating',
+        type=str,
+        choices=NEW_PLAYER_POLICIES,
+        default='league-average',
+        help='How new players missing from "--new-players" are rated, defaults to the average of their league.'
+    )
     parser.add_argument(
         '-s', '--show-ratings',
         dest='show_ratings',
@@ -812,6 +4075,44 @@ def main():
         default=False,
         help='This option must be paired with "-s", only show the current ratings of player(s).'
     )
+    parser.add_argument(
+        '--as-of',
+        dest='as_of',
+        type=str,
+        help='This option must be paired with "-s", show the ranked ratings on a date in the format of yyyy-mm-dd.'
+    )
+    parser.add_argument(
+        '--limit',
+        dest='limit',
+        type=int,
+        help='This option must be paired with "-s", only show this many players.'
+    )
+    parser.add_argument(
+        '--offset',
+        dest='offset',
+        type=int,
+        default=0,
+        help='This option must be paired with "-s", skip this many players before showing any, defaults to 0.'
+    )
+    parser.add_argument(
+        '--last',
+        dest='last',
+        type=int,
+        help='This option must be paired with "-s", only show the latest N ratings of each player.'
+    )
+    parser.add_argument(
+        '--active',
+        dest='active_only',
+        action='store_true',
+        default=False,
+        help='This option must be paired with "-s", only show the players who played within the active days.'
+    )
+    parser.add_argument(
+        '--min-rating',
+        dest='min_rating',
+        type=float,
+        help='This option must be paired with "-s" and "--active" or "--as-of", only show players rated above this.'
+    )
     parser.add_argument(
         '-e', '--execute',
         dest='execute',
@@ -833,17 +4134,285 @@ def main():
         default=False,
         help='Update the server from Google Doc ratings sheet'
     )
-    #TODO: remove a league
     parser.add_argument(
         '-r', '--remove-league',
         dest='remove_league',
         action='store_true',
         default=False,
-        help='Remove league matches of the specified date.'
+        help='Remove league matches of the specified date and replay the ratings of the later leagues.'
+    )
+    parser.add_argument(
+        '--backup-dir',
+        dest='backup_dir',
+        type=str,
+        default='.',
+        help='Directory of the backups and their manifest, defaults to the current directory.'
+    )
+    parser.add_argument(
+        '--backup-compression',
+        dest='backup_compression',
+        type=str,
+        choices=['none', 'gzip', 'zstd'],
+        default='gzip',
+        help='Compression of the backup files, defaults to "gzip". "zstd" needs the zstandard package.'
+    )
+    parser.add_argument(
+        '--full-backup',
+        dest='full_backup',
+        action='store_true',
+        default=False,
+        help='Back up all players instead of only the players changed since the last backup.'
+    )
+    parser.add_argument(
+        '--restore',
+        dest='restore',
+        type=str,
+        nargs='?',
+        const='',
+        help='Restore a backup (the latest one by default) with the full and incremental backups before it.'
+    )
+    parser.add_argument(
+        '--compact-history',
+        dest='compact_history',
+        action='store_true',
+        default=False,
+        help='Remove the history points replaced by a later point on the same date. Needs -e to write.'
+    )
+    parser.add_argument(
+        '--migrate-history',
+        dest='migrate_history',
+        action='store_true',
+        default=False,
+        help='Copy the players, or the players of the "--import-json" file, into the bucketed layout used by '
+             '"--storage mongodb-buckets". The players collection is not changed.'
+    )
+    parser.add_argument(
+        '--benchmark',
+        dest='benchmark',
+        action='store_true',
+        default=False,
+        help='Benchmark the rating pipeline on synthetic leagues seeded from "--import-json" or "players.json".'
+    )
+    parser.add_argument(
+        '--benchmark-sizes',
+        dest='benchmark_sizes',
+        type=str,
+        default='100,10000,1000000',
+        help='Comma separated numbers of matches to benchmark, defaults to "100,10000,1000000".'
+    )
+    parser.add_argument(
+        '--benchmark-output',
+        dest='benchmark_output',
+        type=str,
+        default='benchmark.json',
+        help='Where to save the benchmark results, defaults to "benchmark.json".'
+    )
+    parser.add_argument(
+        '--benchmark-baseline',
+        dest='benchmark_baseline',
+        type=str,
+        help='A saved benchmark result to compare against, exits with 1 on regressions.'
+    )
+    parser.add_argument(
+        '--serve',
+        dest='serve',
+        action='store_true',
+        default=False,
+        help='Serve the leaderboard and player histories over HTTP for the club website.'
+    )
+    parser.add_argument(
+        '--host',
+        dest='host',
+        type=str,
+        default='127.0.0.1',
+        help='The address the ratings service listens on, defaults to 127.0.0.1.'
+    )
+    parser.add_argument(
+        '--port',
+        dest='port',
+        type=int,
+        default=8000,
+        help='The port the ratings service listens on, defaults to 8000.'
+    )
+    parser.add_argument(
+        '--cache-ttl',
+        dest='cache_ttl',
+        type=int,
+        default=30,
+        help='Seconds the ratings service waits before checking the database for changes, defaults to 30.'
+    )
+    parser.add_argument(
+        '--simulate',
+        dest='simulate',
+        action='store_true',
+        default=False,
+        help='Simulate the league night of "-d" (or "--roster") and show the rating changes and finishing positions.'
+    )
+    parser.add_argument(
+        '--roster',
+        dest='roster',
+        type=str,
+        help='This option must be paired with "--simulate", leagues to simulate instead of the ones on the date tab, '
+             'players separated by "," and leagues by ";".'
+    )
+    parser.add_argument(
+        '--seasons',
+        dest='seasons',
+        type=int,
+        default=SIMULATION_SEASONS,
+        help=f'This option must be paired with "--simulate", the number of simulated seasons, defaults to {SIMULATION_SEASONS}.'
+    )
+    parser.add_argument(
+        '--batch-size',
+        dest='batch_size',
+        type=int,
+        default=SIMULATION_BATCH_SIZE,
+        help=f'This option must be paired with "--simulate", seasons sampled at once by a worker, '
+             f'defaults to {SIMULATION_BATCH_SIZE}.'
+    )
+    parser.add_argument(
+        '--workers',
+        dest='workers',
+        type=int,
+        help='This option must be paired with "--simulate" or "--backtest", the number of worker processes, '
+             'defaults to the CPU count.'
+    )
+    parser.add_argument(
+        '--backtest',
+        dest='backtest',
+        action='store_true',
+        default=False,
+        help='Replay the stored matches and score how well the ratings predicted the winners (log-loss).'
+    )
+    parser.add_argument(
+        '--search',
+        dest='search',
+        type=str,
+        choices=['grid', 'random'],
+        help='This option must be paired with "--backtest", search the rating tables for a better log-loss.'
+    )
+    parser.add_argument(
+        '--candidates',
+        dest='candidates',
+        type=int,
+        default=100,
+        help='This option must be paired with "--search random", the number of candidates, defaults to 100.'
+    )
+    parser.add_argument(
+        '--seed',
+        dest='seed',
+        type=int,
+        default=0,
+        help='This option must be paired with "--search random", the same seed resumes the same search, defaults to 0.'
+    )
+    parser.add_argument(
+        '--checkpoint',
+        dest='checkpoint',
+        type=str,
+        default=BACKTEST_CHECKPOINT_FILE,
+        help=f'This option must be paired with "--search", the results of finished candidates, '
+             f'defaults to "{BACKTEST_CHECKPOINT_FILE}".'
+    )
+    parser.add_argument(
+        '--profile',
+        dest='profile',
+        action='store_true',
+        default=False,
+        help='Print the time, calls, bytes and documents of every phase and external call when the command ends.'
+    )
+    parser.add_argument(
+        '--profile-output',
+        dest='profile_output',
+        type=str,
+        help='Save the profile as JSON if the file name ends with ".json", otherwise in the Prometheus text format.'
+    )
+    parser.add_argument(
+        '--profile-cprofile',
+        dest='profile_cprofile',
+        type=str,
+        help='Save a cProfile dump of the rating calculations, it can be read with "python -m pstats".'
+    )
+    parser.add_argument(
+        '--delta-sync',
+        dest='delta_sync',
+        action='store_true',
+        default=False,
+        help='Only write the changed rows of the Ratings tab, unless the ranking of most players changed.'
+    )
+    parser.add_argument(
+        '--daemon',
+        dest='daemon',
+        action='store_true',
+        default=False,
+        help='Keep the database and spreadsheet connections open and run the "-s", "-n" and "-u" commands sent to '
+             'the socket.'
+    )
+    parser.add_argument(
+        '--socket',
+        dest='socket',
+        type=str,
+        default=DAEMON_SOCKET_FILE,
+        help='The Unix socket of the daemon, defaults to "~/.tt-ratings.sock".'
+    )
+    parser.add_argument(
+        '--no-daemon',
+        dest='no_daemon',
+        action='store_true',
+        default=False,
+        help='Run the command in this process even when a daemon is running.'
     )
-    args = parser.parse_args()
+    return parser
+
+
+def main():
+    args = make_parser().parse_args()
+
+    if args.daemon:
+        run_daemon(args)
+        exit(0)
+    # -s, -n and -u are run by the daemon when one is listening, with the output and the prompts passed through.
+    profiling = args.profile or args.profile_output is not None or args.profile_cprofile is not None
+    if not args.no_daemon and not profiling and (args.show_ratings is not None or args.new_league or args.update_server):
+        code = run_daemon_client(args.socket, sys.argv[1:])
+        if code is not None:
+            exit(code)
+
+    if args.profile or args.profile_output is not None or args.profile_cprofile is not None:
+        PROFILER.enabled = True
+        if args.profile_cprofile is not None:
+            import cProfile
+            PROFILER.cprofile = cProfile.Profile()
+        start = time.perf_counter()
 
-    if args.new_league:
+        # Reported on every exit, the commands end with exit() on success and on errors.
+        def report_profile():
+            PROFILER.record('total', time.perf_counter() - start)
+            PROFILER.report(args.profile, args.profile_output, args.profile_cprofile)
+
+        atexit.register(report_profile)
+
+    run_command(args)
+    exit(0)
+
+
+def run_command(args):
+    if args.apply is not None:
+        apply_new_league_plan(args.apply, args.google_cred, args.execute, get_storage(args), args.delta_sync)
+    elif args.new_league and args.from_date is not None:
+        to_date = args.to_date if args.to_date is not None else datetime.now().strftime('%Y-%m-%d')
+        try:
+            datetime.strptime(args.from_date, '%Y-%m-%d')
+            datetime.strptime(to_date, '%Y-%m-%d')
+        except ValueError:
+            print('Date must be in the format of yyyy-mm-dd.')
+            exit(1)
+        if args.date is None:
+            args.date = args.from_date
+        new_players = load_new_player_manifest(args.new_players) if args.new_players is not None else None
+        new_leagues(args.from_date, to_date, args.mongodb_cert, args.google_cred, args.active_days, args.execute,
+                    args.print_out, args.leagues, get_storage(args), args.plan, args.assume_yes, new_players,
+                    args.new_player_rating, args.delta_sync)
+    elif args.new_league:
         if args.date is None:
             print('Must provide a date to process new league matches.')
             exit(1)
@@ -852,7 +4421,10 @@ def main():
         except ValueError:
             print('Date must be in the format of yyyy-mm-dd.')
             exit(1)
-        new_league(args.date, args.mongodb_cert, args.google_cred, args.active_days, args.execute, args.print_out)
+        new_players = load_new_player_manifest(args.new_players) if args.new_players is not None else None
+        new_league(args.date, args.mongodb_cert, args.google_cred, args.active_days, args.execute, args.print_out,
+                   args.leagues, get_storage(args), args.plan, args.assume_yes, new_players, args.new_player_rating,
+                   args.delta_sync)
     elif args.update_server:
         if args.date is None:
             print('Must provide a date to process new league matches.')
@@ -863,7 +4435,7 @@ def main():
             print('Date must be in the format of yyyy-mm-dd.')
             exit(1)
         update_database_from_sheet(args.date, args.mongodb_cert, args.google_cred, args.active_days,
-                                   args.execute, args.print_out)
+                                   args.execute, args.print_out, get_storage(args))
     elif args.remove_league:
         if args.date is None:
             print('Must provide a date to remove league matches.')
@@ -873,14 +4445,99 @@ def main():
         except ValueError:
             print('Date must be in the format of yyyy-mm-dd.')
             exit(1)
-        mongodb = MongoDB(args.date, args.mongodb_cert)
-        mongodb.remove_league()
+        storage = get_storage(args)
+        if args.execute:
+            storage.backup()
+            if storage.remove_league() is not None:
+                remove_leaderboard_index()
+                print(f'Leagues on "{args.date}" removed.')
+        else:
+            storage.remove_league(dry_run=True)
+            print('No execute flag detected, database will not be updated.')
+    elif args.restore is not None:
+        storage = get_storage(args)
+        backup_file = args.restore
+        if backup_file == '':
+            backups = load_backup_manifest(args.backup_dir)['backups']
+            if len(backups) == 0:
+                print(f'No backups found in {args.backup_dir}.')
+                exit(1)
+            backup_file = backups[-1]['file']
+        if args.execute:
+            storage.backup()
+            if storage.restore(backup_file) is None:
+                exit(1)
+            remove_leaderboard_index()
+            print(f'Restored {backup_file}.')
+        else:
+            storage.restore(backup_file, dry_run=True)
+            print('No execute flag detected, database will not be updated.')
+    elif args.compact_history:
+        storage = get_storage(args)
+        if args.execute:
+            storage.backup()
+            storage.compact_history()
+            remove_leaderboard_index()
+        else:
+            storage.compact_history(dry_run=True)
+            print('No execute flag detected, database will not be updated.')
+    elif args.migrate_history:
+        date_str = datetime.now().strftime('%Y-%m-%d')
+        print('Connecting to MongoDB...')
+        if args.import_json is not None:
+            source = MemoryStorage(date_str, args.import_json)
+        else:
+            source = MongoDB(date_str, args.mongodb_cert)
+        migrate_history(source, BucketedMongoDB(date_str, args.mongodb_cert), args.execute)
+        if not args.execute:
+            print('No execute flag detected, database will not be updated.')
+    elif args.benchmark:
+        sizes = [int(s) for s in args.benchmark_sizes.split(',')]
+        json_file = args.import_json if args.import_json is not None else 'players.json'
+        if run_benchmark(sizes, args.benchmark_output, args.benchmark_baseline, json_file) > 0:
+            exit(1)
+    elif args.serve:
+        serve_ratings(get_storage(args), args.host, args.port, args.active_days, args.cache_ttl)
+    elif args.simulate:
+        if args.roster is None:
+            if args.date is None:
+                print('Must provide a date or a roster to simulate a league night.')
+                exit(1)
+            try:
+                datetime.strptime(args.date, '%Y-%m-%d')
+            except ValueError:
+                print('Date must be in the format of yyyy-mm-dd.')
+                exit(1)
+        if args.seasons < 1 or args.batch_size < 1 or (args.workers is not None and args.workers < 1):
+            print('--seasons, --batch-size and --workers must be positive.')
+            exit(1)
+        simulate_league(args.date, args.google_cred, args.roster, get_storage(args), args.leagues, args.seasons,
+                        args.batch_size, args.workers)
+    elif args.backtest:
+        if args.candidates < 1 or (args.workers is not None and args.workers < 1):
+            print('--candidates and --workers must be positive.')
+            exit(1)
+        run_backtest(get_storage(args), args.search, args.candidates, args.seed, args.workers, args.checkpoint)
     elif args.show_ratings is not None:
         player_list = args.show_ratings.split(',')
         player_list = list(map(str.strip, player_list))
-        show_ratings(args.mongodb_cert, player_list, args.current, args.active_days)
-
-    exit(0)
+        if args.as_of is not None:
+            try:
+                datetime.strptime(args.as_of, '%Y-%m-%d')
+            except ValueError:
+                print('Date must be in the format of yyyy-mm-dd.')
+                exit(1)
+        if (args.limit is not None and args.limit < 1) or args.offset < 0 or (args.last is not None and args.last < 1):
+            print('--limit and --last must be positive, --offset must not be negative.')
+            exit(1)
+        if args.min_rating is not None and not args.active_only and args.as_of is None:
+            print('--min-rating must be paired with --active or --as-of.')
+            exit(1)
+        show_ratings(
+            args.mongodb_cert, player_list, args.current, args.active_days, get_storage(args), args.as_of,
+            args.limit, args.offset, args.last, args.active_only, args.min_rating
+        )
+    return
 
 
 if __name__ == '__main__':